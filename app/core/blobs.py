@@ -0,0 +1,171 @@
+import os, shutil, hashlib, tempfile, threading
+import logging as log
+from contextlib import contextmanager
+from typing import IO
+from .utils import AppDir
+
+
+class BlobStore:
+    """
+    Content-addressed cache of git blobs shared by all apps, laid out as `<root>/<sha[:2]>/<sha>`.\n
+    App `src/` trees are built from it with hardlinks (plain copies where linking is impossible, executables),
+    symlinks are recreated from their target, least recently used blobs are evicted once the store grows over `max_size` bytes.\n
+    Downloads land in `<root>/.incoming` first and enter the store through `ingest`, which checks the sha.
+    Blobs a pull works with are `pinned`: `evict` of a concurrent pull leaves them alone.
+    """
+
+    MAX_SIZE = 2 * 1024 ** 3
+    CHUNK_SIZE = 64 * 1024
+    INCOMING_DIR = '.incoming'
+    FILE_MODE = 0o644                       # blobs are readable by any user of an image built from them
+    EXECUTABLE = '100755'                   # git tree modes, any other blob mode is a regular file
+    SYMLINK = '120000'
+
+    _pins: dict[str, int] = {}              # blob path -> pulls holding it, shared by all stores of the process
+    _pins_lock = threading.Lock()
+
+    def __init__(self, root: str = None, max_size: int = MAX_SIZE):
+        self.root = root or AppDir.BLOBS_DIR
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def blob_sha(data: bytes) -> str:
+        """
+        Git blob id: sha1 of "blob <size>\\0<content>"
+        """
+        return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+    def path(self, sha: str) -> str:
+        return os.path.join(self.root, sha[:2], sha)
+
+    def incoming_path(self, sha: str) -> str:
+        """
+        Where a blob is downloaded before ingest(), outside the buckets, so partial files are never served or evicted
+        """
+        return os.path.join(self.root, self.INCOMING_DIR, sha)
+
+    def ingest(self, sha: str) -> None:
+        """
+        Moves the downloaded blob from incoming_path(sha) into the store.
+        Raises ValueError when its content does not hash to sha
+        """
+        incoming = self.incoming_path(sha)
+        try:
+            with open(incoming, 'rb') as f: got = self.add(f, os.path.getsize(incoming))
+        finally:
+            os.remove(incoming)
+        if got != sha:
+            # stored under its real sha it is still a valid blob, eviction takes care of it
+            raise ValueError(f"Downloaded blob {sha} hashes to {got}")
+
+    def has(self, sha: str) -> bool:
+        return os.path.isfile(self.path(sha))
+
+    def add(self, fileobj: IO[bytes], size: int) -> str:
+        """
+        Copies `size` bytes from fileobj into the store, hashing on the fly.
+        Returns blob sha
+        """
+        digest = hashlib.sha1(b'blob %d\0' % size)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while chunk := fileobj.read(self.CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+            sha = digest.hexdigest()
+            os.chmod(tmp_path, self.FILE_MODE)
+            os.makedirs(os.path.dirname(self.path(sha)), exist_ok=True)
+            os.replace(tmp_path, self.path(sha))
+        except BaseException:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            raise
+        return sha
+
+    @contextmanager
+    def pinned(self, shas: set[str]):
+        """
+        Keeps shas in the store while the block runs, they are marked as recently used at once
+        """
+        paths = [self.path(sha) for sha in shas]
+        with self._pins_lock:
+            for path in paths: self._pins[path] = self._pins.get(path, 0) + 1
+        for sha in shas: self.touch(sha)
+        try: yield
+        finally:
+            with self._pins_lock:
+                for path in paths:
+                    self._pins[path] -= 1
+                    if not self._pins[path]: del self._pins[path]
+
+    def touch(self, sha: str):
+        """
+        Marks blob as recently used
+        """
+        try: os.utime(self.path(sha))
+        except FileNotFoundError: pass
+
+    def link(self, sha: str, dest: str, mode: str = None):
+        """
+        Places blob at dest as the git tree mode says: regular files are hardlinked,
+        executables are copied with 0755 and symlinks point to the blob's content.
+        Existing dest is replaced, never written through, so a hardlinked file can't corrupt the store.
+        """
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_dest = dest + '.link'
+        if os.path.lexists(tmp_dest): os.remove(tmp_dest)
+        if mode == self.SYMLINK and self._symlink(sha, tmp_dest): pass
+        elif mode == self.EXECUTABLE:
+            # a hardlink shares the mode with the store and every other app
+            shutil.copyfile(self.path(sha), tmp_dest)
+            os.chmod(tmp_dest, 0o755)
+        else:
+            # blobs of older stores were created 0600
+            if os.stat(self.path(sha)).st_mode & 0o777 != self.FILE_MODE: os.chmod(self.path(sha), self.FILE_MODE)
+            try:
+                os.link(self.path(sha), tmp_dest)
+            except OSError:
+                # other filesystem or no hardlink support
+                shutil.copyfile(self.path(sha), tmp_dest)
+        os.replace(tmp_dest, dest)
+        self.touch(sha)
+
+    def _symlink(self, sha: str, dest: str) -> bool:
+        """
+        False when symlinks can't be created (Windows without the privilege),
+        the link is then a file holding its target, like git does with core.symlinks=false
+        """
+        with open(self.path(sha), 'rb') as f: target = os.fsdecode(f.read())
+        try: os.symlink(target, dest)
+        except OSError: return False
+        return True
+
+    def size(self) -> int:
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+        for bucket in os.scandir(self.root):
+            if not bucket.is_dir() or bucket.name == self.INCOMING_DIR: continue
+            for entry in os.scandir(bucket.path):
+                if entry.is_file(): yield entry
+
+    def evict(self) -> int:
+        """
+        Deletes least recently used blobs until the store fits into max_size, pinned blobs are skipped.
+        Blobs still linked into an app's src/ stay on disk there, they only leave the cache.
+        Returns freed bytes
+        """
+        # under the pin lock, a pull can't pin a blob that is being deleted
+        with self._pins_lock:
+            entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in self._entries()]
+            total = sum(size for _, size, _ in entries)
+            freed = 0
+            for _, size, path in sorted(entries):
+                if total - freed <= self.max_size: break
+                if path in self._pins: continue
+                try: os.remove(path)
+                except FileNotFoundError: continue
+                freed += size
+        if freed: log.info(f'Blob store: evicted {freed} bytes, {total - freed} bytes left')
+        return freed
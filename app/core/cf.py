@@ -1,5 +1,7 @@
-import json, os, requests
-from .utils import JsonEditor, DB_DIR, BaseJsonFile
+import json, os, time, threading
+import logging as log
+from .utils import JsonStore, DB_DIR, BaseJsonFile, ApiResponseError
+from .net import HttpClient
 from typing import TypedDict
 
 class CloudflareAPIException(Exception):
@@ -19,6 +21,8 @@ class CloudflareAPIException(Exception):
 
 
 class CloudFlareAPI:
+    PER_PAGE = 100
+
     def __init__(self, api_token: str):
         self.headers = {
             "Authorization": f"Bearer {api_token}",
@@ -37,15 +41,28 @@ class CloudFlareAPI:
             raise ValueError(f"Account not found for such api_token")
         return accounts[0]
 
-    def request(self, method: str, url: str, json: dict = None) -> dict:
-        try:
-            res = requests.request(method, url, headers=self.headers, json=json)
-            res_data = res.json()
-            res.raise_for_status()
-            return res_data["result"]
-        except Exception as e:
-            if not res_data.get("success"):
-                raise CloudflareAPIException(res_data.get('errors'))
+    def _send(self, method: str, url: str, json: dict = None, params: dict = None) -> dict:
+        res = HttpClient.shared().request(method, url, headers=self.headers, json=json, params=params)
+        try: res_data = res.json()
+        except ValueError: raise ApiResponseError(res)
+        if not res.ok or not res_data.get("success"):
+            raise CloudflareAPIException(res_data.get('errors') or [])
+        return res_data
+
+    def request(self, method: str, url: str, json: dict = None, params: dict = None) -> dict:
+        return self._send(method, url, json=json, params=params)["result"]
+
+    def request_pages(self, url: str, params: dict = None, per_page: int = PER_PAGE) -> list:
+        """
+        GET of a paginated list endpoint, results of all pages
+        """
+        results, page = [], 1
+        while True:
+            res_data = self._send('GET', url, params={ **(params or {}), 'page': page, 'per_page': per_page })
+            results += res_data["result"]
+            info = res_data.get('result_info') or {}
+            if page >= info.get('total_pages', 1) or not res_data["result"]: return results
+            page += 1
 
 
 class Config(BaseJsonFile):
@@ -56,7 +73,8 @@ class Config(BaseJsonFile):
         """
         Checks for the existence of the created tunnel and account
         """
-        config = JsonEditor.read(Config.FILE_PATH)
+        try: config = JsonStore.read(Config.FILE_PATH)
+        except (FileNotFoundError, json.JSONDecodeError): return False
         if not config.get('tunnel') or not config.get('account'): return False
         return True
 
@@ -70,10 +88,12 @@ class CFClient:
 
     _initialized = False
     _instance = None
-    
+    _instance_lock = threading.Lock()
+
     def __new__(cls, *args, **kwargs):
-        if not cls._instance:
-            cls._instance = super().__new__(cls)
+        with cls._instance_lock:
+            if not cls._instance:
+                cls._instance = super().__new__(cls)
         return cls._instance
 
     def _init_subclasses(self, api: "CloudFlareAPI", config: "Config"):
@@ -83,12 +103,15 @@ class CFClient:
         self.route = self.Route(api=api, config=config)
 
     def __init__(self):
-        self.config = Config()
-        if self.config.is_data():
-            self._initialized = True
-            api_token = self.config('account', 'api_token')
-            api = CloudFlareAPI(api_token)
-            self._init_subclasses(api=api, config=self.config)
+        # runs on every CFClient() call: the api, the batching route and the dns index are built once
+        with self._instance_lock:
+            if self._initialized: return
+            self.config = Config()
+            if self.config.is_data():
+                api_token = self.config('account', 'api_token')
+                api = CloudFlareAPI(api_token)
+                self._init_subclasses(api=api, config=self.config)
+                self._initialized = True
 
     def __getattr__(self, name):
         print('method:', name)
@@ -144,36 +167,91 @@ class CFClient:
 
 
     class Dns:
+        """
+        DNS records of the zone, indexed locally by (type, name).\n
+        Lookups ask Cloudflare only for the records of one name (`?name=`, all pages) and keep them for TTL seconds,
+        so checking a record costs one small request however big the zone is.
+        """
+
         class DNSRecord(TypedDict):
             type: str
             proxied: str
             name: str
             content: str
 
+        TTL = 300
+
         def __init__(self, api: "CloudFlareAPI", config: "Config"):
             self.api = api
             self.config = config
+            self._lock = threading.Lock()
             self.zone_id = config('tunnel', 'zone', 'id')
 
-        def get_records(self) -> tuple[DNSRecord]:
-            url = f'https://api.cloudflare.com/client/v4/zones/{self.zone_id}/dns_records'
-            records = self.api.request(method='GET', url=url)
-            self.config = records
+        @property
+        def zone_id(self) -> str:
+            return self._zone_id
+
+        @zone_id.setter
+        def zone_id(self, zone_id: str):
+            # the index belongs to one zone
+            self._zone_id = zone_id
+            self.clear()
+
+        @property
+        def url(self) -> str:
+            return f'https://api.cloudflare.com/client/v4/zones/{self.zone_id}/dns_records'
+
+        def clear(self):
+            with self._lock:
+                self._index: dict[tuple[str, str], list[DNSRecord]] = {}    # (type, name) -> records
+                self._fetched: dict[str, float] = {}                        # name -> time its records were fetched
+
+        def _store(self, records: list[DNSRecord], names: list[str]):
+            with self._lock:
+                now = time.monotonic()
+                for key in [key for key in self._index if key[1] in names]: del self._index[key]
+                for name in names: self._fetched[name] = now
+                for record in records:
+                    self._index.setdefault((record['type'], record['name'].lower()), []).append(record)
+
+        def find(self, name: str, type: str = None, refresh: bool = False) -> list[DNSRecord]:
+            """
+            Records of name (of any type if type is None), fetched again after TTL seconds
+            """
+            name = name.lower()
+            with self._lock:
+                fetched = self._fetched.get(name)
+            if refresh or fetched is None or time.monotonic() - fetched > self.TTL:
+                self._store(self.api.request_pages(self.url, params={ 'name': name }), [name])
+            with self._lock:
+                return [
+                    record for (record_type, record_name), records in self._index.items()
+                    if record_name == name and type in (None, record_type) for record in records
+                ]
+
+        def get_records(self, name: str = None, type: str = None) -> list[DNSRecord]:
+            """
+            Records of name, all records of the zone when name is None (the whole index is refreshed)
+            """
+            if name: return self.find(name, type)
+            records = self.api.request_pages(self.url, params={ 'type': type } if type else None)
+            if not type:
+                self.clear()
+                self._store(records, sorted({ record['name'].lower() for record in records }))
             return records
 
-        def check_record(self, record_name: str) -> DNSRecord:
-            records = self.get_records()
-            if len(records) < 1: return None
-            for record in records:
-                if record['name'] == record_name: return record
-            return None
+        def check_record(self, record_name: str, type: str = None) -> DNSRecord | None:
+            records = self.find(record_name, type)
+            return records[0] if records else None
 
         def create_record(self, data: DNSRecord) -> DNSRecord:
             exists_zone = self.check_record(data['name'])
             if exists_zone: return exists_zone
-            
-            url = f'https://api.cloudflare.com/client/v4/zones/{self.zone_id}/dns_records'
-            return self.api.request(method='POST', url=url, json=data)
+
+            record = self.api.request(method='POST', url=self.url, json=data)
+            with self._lock:
+                self._index.setdefault((record['type'], record['name'].lower()), []).append(record)
+            return record
 
 
     class Tunnel:
@@ -227,49 +305,121 @@ class CFClient:
 
 
     class Route:
+        """
+        Tunnel ingress rules, modelled locally.\n
+        Changes are collected for DEBOUNCE seconds and written with one GET + PUT of the tunnel configuration:
+        the remote copy is read right before the PUT and the changes are applied on top of it, so edits made
+        elsewhere are kept. `rules` and `version` are the ingress and the config version of the last write.
+        Exactly one catch-all rule is kept at the end.
+        """
+
         class IngressRoute(TypedDict):
             hostname: str
             service: str
 
+        DEBOUNCE = 0.3
+        CATCH_ALL = { "service": "http_status:404" }
+
         def __init__(self, api: "CloudFlareAPI", config: "Config"):
             self.api = api
             self.config = config
             self.account_id = config('account', 'id')
             self.tunnel_id = config('tunnel', 'id')
-        
-        def add(self, route: "IngressRoute") -> None:
-            url = f'https://api.cloudflare.com/client/v4/accounts/{self.account_id}/cfd_tunnel/{self.tunnel_id}/configurations'
-            res = self.api.request(method='GET', url=url)
-
-            ingress: list = res['ingress']
-            ingress.insert(0, route)
-            ingress.append({ "service": "http_status:404" })
-
+            self.rules: list[dict] | None = None        # hostname rules, None until the first write
+            self.version: int | None = None
+            self._pending: dict[str, dict | None] = {}  # hostname -> new rule, None - remove
+            self._batch = self._new_batch()
+            self._timer: threading.Timer | None = None
+            self._lock = threading.Lock()
+            self._write_lock = threading.Lock()
+
+        @property
+        def url(self) -> str:
+            return f'https://api.cloudflare.com/client/v4/accounts/{self.account_id}/cfd_tunnel/{self.tunnel_id}/configurations'
+
+        def add(self, route: "IngressRoute", wait: bool = True) -> None:
+            """
+            Same as set(): a hostname has one rule
+            """
+            self.set(route, wait=wait)
+
+        def set(self, route: "IngressRoute", wait: bool = True) -> None:
+            """
+            Points route['hostname'] to route['service'], the route is added if it does not exist yet
+
+            :param wait: return once the change is written (errors are raised), otherwise at once
+            """
+            self._change(route['hostname'], dict(route), wait)
+
+        def delete(self, hostname: str, wait: bool = True) -> None:
+            self._change(hostname, None, wait)
+
+        @staticmethod
+        def _new_batch() -> dict:
+            # set once the pending changes are written, error - what the write raised
+            return { 'done': threading.Event(), 'error': None }
+
+        def _change(self, hostname: str, rule: dict | None, wait: bool):
+            with self._lock:
+                self._pending[hostname] = rule
+                batch = self._batch
+                if not self._timer:
+                    self._timer = threading.Timer(self.DEBOUNCE, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+            if not wait: return
+            batch['done'].wait()
+            if batch['error']: raise batch['error']
+
+        def flush(self) -> None:
+            """
+            Writes the pending changes now
+            """
+            with self._lock:
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                changes, self._pending = self._pending, {}
+                batch, self._batch = self._batch, self._new_batch()
+            try:
+                if changes:
+                    with self._write_lock: self._write(changes)
+            except Exception as e:
+                log.error(f'Failed to update tunnel ingress ({", ".join(changes)}): {e}')
+                batch['error'] = e
+            finally:
+                batch['done'].set()
+
+        def _write(self, changes: dict[str, dict | None]):
+            res = self.api.request(method='GET', url=self.url)
+            version = res.get('version')
+            if self.version is not None and version != self.version:
+                log.info(f'Tunnel config changed remotely (version {self.version} -> {version}), changes applied on top')
+            ingress: list = (res.get('config') or res).get('ingress') or []
+            rules = [rule for rule in ingress if rule.get('hostname')]
+            catch_all = next((rule for rule in reversed(ingress) if not rule.get('hostname')), self.CATCH_ALL)
+
+            updated = [dict(rule) for rule in rules if rule['hostname'] not in changes or changes[rule['hostname']]]
+            for hostname, rule in changes.items():
+                if not rule: continue
+                for current in updated:
+                    if current['hostname'] == hostname:
+                        current.update(rule)
+                        break
+                else:
+                    updated.insert(0, rule)
+
+            if updated == rules and ingress and ingress[-1] is catch_all and len(ingress) == len(rules) + 1:
+                # nothing to change
+                self.rules, self.version = rules, version
+                return
             data = {
                 "config": {
-                    "ingress": ingress
+                    "ingress": [*updated, catch_all]
                 }
             }
-
-            url = f'https://api.cloudflare.com/client/v4/accounts/{self.account_id}/cfd_tunnel/{self.tunnel_id}/configurations'
-            self.api.request(method='PUT', url=url, json=data)
- 
-        def delete(self, hostname: str):
-            url = f'https://api.cloudflare.com/client/v4/accounts/{self.account_id}/cfd_tunnel/{self.tunnel_id}/configurations'
-            res = self.api.request(method='GET', url=url)
-
-            ingress: list = res['ingress']
-            if len(ingress) > 0:
-                ingress = [route for route in ingress if route['hostname'] != hostname]
-            ingress.append({ "service": "http_status:404" })
-
-            data = {
-                "config": {
-                    "ingress": ingress
-                }
-            }
-
-            url = f'https://api.cloudflare.com/client/v4/accounts/{self.account_id}/cfd_tunnel/{self.tunnel_id}/configurations'
-            self.api.request(method='PUT', url=url, json=data)
-
+            res = self.api.request(method='PUT', url=self.url, json=data)
+            self.rules = updated
+            self.version = res.get('version')
+            log.info(f'Tunnel ingress updated ({len(changes)} changes, version {self.version})')
 
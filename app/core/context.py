@@ -0,0 +1,179 @@
+import os, re, tarfile, threading
+import logging as log
+from typing import IO
+
+
+class DockerIgnore:
+    """
+    .dockerignore matcher: `*`, `?`, `**`, `[...]`, `!` exceptions, the last matching pattern wins.
+    A pattern matching a directory excludes everything inside it.
+    """
+
+    def __init__(self, patterns: list[str]):
+        self.rules: list[tuple[bool, re.Pattern, str]] = []      # (is exception, regex, pattern)
+        for line in patterns:
+            pattern = line.strip()
+            if not pattern or pattern.startswith('#'): continue
+            exception = pattern.startswith('!')
+            pattern = os.path.normpath(pattern.removeprefix('!').strip()).replace('\\', '/').strip('/')
+            if pattern in ('', '.'): continue
+            self.rules.append((exception, re.compile(self._to_regex(pattern)), pattern))
+
+    @staticmethod
+    def file_names(dockerfile: str) -> list[str]:
+        """
+        Ignore files by priority, paths relative to the context root:
+        `<dockerfile>.dockerignore` next to the Dockerfile wins over `.dockerignore`
+        """
+        return [f"{dockerfile.replace('\\', '/')}.dockerignore", '.dockerignore']
+
+    @classmethod
+    def from_dir(cls, context_dir: str, dockerfile: str = 'Dockerfile') -> "DockerIgnore":
+        for name in cls.file_names(dockerfile):
+            path = os.path.join(context_dir, name)
+            if os.path.isfile(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    return cls(f.read().splitlines())
+        return cls([])
+
+    @staticmethod
+    def _to_regex(pattern: str) -> str:
+        regex, i = '', 0
+        while i < len(pattern):
+            char = pattern[i]
+            if pattern.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+                continue
+            if pattern.startswith('**', i):
+                regex += '.*'
+                i += 2
+                continue
+            if char == '*': regex += '[^/]*'
+            elif char == '?': regex += '[^/]'
+            elif char == '[':
+                end = pattern.find(']', i)
+                if end == -1: regex += re.escape(char)
+                else:
+                    regex += '[' + pattern[i + 1:end].replace('!', '^', 1) + ']'
+                    i = end
+            else: regex += re.escape(char)
+            i += 1
+        # a matched directory excludes its whole subtree
+        return f'^{regex}(?:/.*)?$'
+
+    def is_excluded(self, path: str) -> bool:
+        """
+        :param path: path relative to the context root with "/" separators
+        """
+        excluded = False
+        for exception, regex, _ in self.rules:
+            if regex.match(path): excluded = not exception
+        return excluded
+
+    def may_include_below(self, dir_path: str) -> bool:
+        """
+        Whether an exception pattern could re-include something inside an excluded directory
+        """
+        for exception, _, pattern in self.rules:
+            if not exception: continue
+            literal_prefix = re.split(r'[*?\[]', pattern, maxsplit=1)[0]
+            if literal_prefix.startswith(dir_path + '/') or (dir_path + '/').startswith(literal_prefix):
+                return True
+        return False
+
+
+class BuildContext:
+    """
+    Docker build context packed in-process: `.dockerignore` is applied while walking,
+    so excluded directories (node_modules, .git, ...) are never even read.
+    The Dockerfile and its ignore file are always sent, like docker CLI does.\n
+    File modes in the tar come from `modes` (path -> git mode, see RepoSnapshot.modes) when it is known:
+    100755 -> 0755, anything else 0644. Without it they come from the filesystem, except on Windows,
+    which has no exec bit: there every entry gets 0755, like docker CLI does.
+    """
+
+    def __init__(self, context_dir: str, dockerfile: str, modes: dict[str, str] = None):
+        self.context_dir = context_dir
+        self.dockerfile = dockerfile.replace('\\', '/')
+        self.modes = modes
+        self.ignore = DockerIgnore.from_dir(context_dir, self.dockerfile)
+        self.files = 0
+        self.ignored = 0
+        self.size = 0                       # bytes of tar stream
+
+    def iter_files(self):
+        """
+        Yields paths relative to context root ("/" separators) that go into the context
+        """
+        always = { self.dockerfile, *DockerIgnore.file_names(self.dockerfile) }
+        for root, dirs, files in os.walk(self.context_dir):
+            rel_root = os.path.relpath(root, self.context_dir).replace('\\', '/')
+            rel_root = '' if rel_root == '.' else rel_root + '/'
+            kept_dirs = []
+            for name in sorted(dirs):
+                rel_path = rel_root + name
+                if (self.ignore.is_excluded(rel_path) and not self.ignore.may_include_below(rel_path)
+                        and not self.dockerfile.startswith(rel_path + '/')):
+                    self.ignored += 1
+                    continue
+                kept_dirs.append(name)
+            dirs[:] = kept_dirs
+            for name in sorted(files):
+                rel_path = rel_root + name
+                if rel_path not in always and self.ignore.is_excluded(rel_path):
+                    self.ignored += 1
+                    continue
+                yield rel_path
+
+    def write_tar(self, fileobj: IO[bytes]):
+        """
+        Writes uncompressed tar of the context into fileobj as a stream
+        """
+        counter = _CountingWriter(fileobj)
+        with tarfile.open(fileobj=counter, mode='w|') as tar:
+            for rel_path in self.iter_files():
+                tar.add(os.path.join(self.context_dir, rel_path), arcname=rel_path, recursive=False, filter=self._set_mode)
+                self.files += 1
+        self.size = counter.count
+        log.info(f'Build context: {self.files} files, {self.size / 1024 ** 2:.2f} MiB, {self.ignored} entries ignored')
+
+    def _set_mode(self, info: tarfile.TarInfo) -> tarfile.TarInfo:
+        if self.modes is not None and info.isfile():
+            info.mode = 0o755 if self.modes.get(info.name) == '100755' else 0o644
+        elif os.name == 'nt':
+            info.mode = 0o755
+        return info
+
+    def pipe(self) -> tuple[IO[bytes], threading.Thread]:
+        """
+        Starts writing the tar into a pipe from a background thread. Returns (read end, writer thread)
+        """
+        read_fd, write_fd = os.pipe()
+        reader, writer = os.fdopen(read_fd, 'rb'), os.fdopen(write_fd, 'wb')
+
+        def _write():
+            try: self.write_tar(writer)
+            except BrokenPipeError: log.warning('Build context reader closed the pipe')
+            finally:
+                try: writer.close()
+                except BrokenPipeError: pass
+
+        thread = threading.Thread(target=_write, daemon=True)
+        thread.start()
+        return reader, thread
+
+
+class _CountingWriter:
+    def __init__(self, fileobj: IO[bytes]):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data: bytes) -> int:
+        self.fileobj.write(data)
+        self.count += len(data)
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
@@ -0,0 +1,159 @@
+import time, threading
+import logging as log
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypedDict
+from .dk import DockerApp
+
+
+class StageReport(TypedDict):
+    count: int              # apps that passed the stage
+    failed: int
+    busy: float             # seconds spent in the stage, summed over apps
+    wait: float             # seconds apps waited for a free slot of the stage
+    avg: float
+    max: float
+
+
+class AppReport(TypedDict):
+    status: str             # done | failed | cancelled
+    stage: str | None       # stage that failed, 'init' when the app could not be created
+    error: str | None
+    pc_port: int | None
+    timings: dict[str, float]
+
+
+class DeployReport(TypedDict):
+    duration: float
+    apps_per_minute: float
+    stages: dict[str, StageReport]
+    apps: dict[str, AppReport]
+
+
+class DeployPipeline:
+    """
+    Deploys many apps at once with pull, build, run and tunnel as separate stages.\n
+    Every stage has its own concurrency limit, an app moves to the next stage as soon as it is done
+    with the previous one, so the next app downloads while this one builds.
+    A failed app stops at its stage, the others go on. An app starts at its DockerApp.resume_stage(),
+    so stages completed before a restart (or an unchanged image) are not repeated.
+    """
+
+    STAGES = ('pull', 'build', 'run', 'tunnel')
+    # ingress changes of apps tunneled together are written as one config update (see CFClient.Route)
+    LIMITS = { 'pull': 4, 'build': 2, 'run': 4, 'tunnel': 4 }
+
+    def __init__(self, limits: dict[str, int] = None, tunnel: Callable[[DockerApp], None] = None,
+                 on_line: Callable[[str], None] = None):
+        """
+        :param limits: max apps per stage at the same time, missing stages use LIMITS
+        :param tunnel: publishes a running app (adds its ingress route), the stage is skipped if not set
+        :param on_line: receives progress lines (`<app>: <message>`)
+        """
+        self.limits = { **self.LIMITS, **(limits or {}) }
+        self.tunnel = tunnel
+        self.on_line = on_line
+        self._slots = { stage: threading.BoundedSemaphore(self.limits[stage]) for stage in self.STAGES }
+        self._stats: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def _emit(self, app: DockerApp, message: str):
+        log.info(f'Deploy {app.name}: {message}')
+        if self.on_line: self.on_line(f'{app.name}: {message}')
+
+    def _stage(self, stage: str, app: DockerApp, cancel: threading.Event, unchanged: bool = False):
+        if stage == 'pull': app.pull()
+        elif stage == 'build':
+            on_line = (lambda line: self.on_line(f'{app.name}: {line}')) if self.on_line else None
+            app.build(on_line=on_line, cancel=cancel)
+        elif stage == 'run':
+            # the live container of an unchanged app is kept, like DockerApp.launch() does
+            if unchanged and app._start_unchanged(): return
+            app._set_pcport()
+            app.run()
+        elif stage == 'tunnel':
+            self.tunnel(app)
+            app.checkpoint('tunneled')
+
+    def _deploy_app(self, name: str, create: Callable[[], DockerApp], cancel: threading.Event) -> AppReport:
+        report: AppReport = { 'status': 'done', 'stage': None, 'error': None, 'pc_port': None, 'timings': {} }
+        try: app = create()
+        except Exception as e:
+            log.error(f'Deploy {name}: failed to create the app: {e}', exc_info=True)
+            report.update(status='failed', stage='init', error=str(e))
+            return report
+        try:
+            first = app.resume_stage()
+            # an unchanged app without its image is built again
+            if first == 'run' and not app.has_image(): first = 'build'
+        except Exception as e:
+            log.error(f'Deploy {app.name}: failed to check the repository: {e}', exc_info=True)
+            report.update(status='failed', stage='pull', error=str(e))
+            return report
+        if first != 'pull': self._emit(app, f'resuming from {first}')
+        for stage in self.STAGES[self.STAGES.index(first):]:
+            if stage == 'tunnel' and not self.tunnel: continue
+            if cancel.is_set():
+                report['status'] = 'cancelled'
+                break
+            queued = time.monotonic()
+            with self._slots[stage]:
+                started = time.monotonic()
+                self._emit(app, f'{stage} started')
+                try:
+                    self._stage(stage, app, cancel, unchanged=first == 'run')
+                except Exception as e:
+                    log.error(f'Deploy {app.name}: {stage} failed: {e}', exc_info=True)
+                    report.update(status='failed', stage=stage, error=str(e))
+                finally:
+                    duration = time.monotonic() - started
+                    report['timings'][stage] = round(duration, 2)
+                    self._record(stage, started - queued, duration, failed=report['status'] == 'failed')
+            if report['status'] == 'failed':
+                self._emit(app, f'{stage} failed: {report["error"]}')
+                break
+            self._emit(app, f'{stage} done in {duration:.1f}s')
+        report['pc_port'] = getattr(app, 'pc_port', None)
+        return report
+
+    def _record(self, stage: str, wait: float, duration: float, failed: bool = False):
+        with self._lock:
+            stats = self._stats[stage]
+            stats['failed' if failed else 'count'] += 1
+            stats['wait'] += wait
+            stats['busy'] += duration
+            stats['max'] = max(stats['max'], duration)
+
+    def deploy(self, apps: list[DockerApp] | dict[str, Callable[[], DockerApp]], cancel: threading.Event = None) -> DeployReport:
+        """
+        Runs all apps through the stages, returns per app results and per stage timings
+
+        :param apps: apps, or app name -> function creating the app (repository checks, Dockerfile lookup),
+                     an app failing to be created is reported as failed at 'init'
+        """
+        cancel = cancel or threading.Event()
+        self._stats = { stage: { 'count': 0, 'failed': 0, 'busy': 0.0, 'wait': 0.0, 'max': 0.0 } for stage in self.STAGES }
+        started = time.monotonic()
+        # one thread per app, stage slots decide who actually works
+        with ThreadPoolExecutor(max_workers=max(len(apps), 1), thread_name_prefix='deploy') as executor:
+            factories = apps if isinstance(apps, dict) else { app.name: (lambda app=app: app) for app in apps }
+            futures = { name: executor.submit(self._deploy_app, name, create, cancel) for name, create in factories.items() }
+            apps_report = { name: future.result() for name, future in futures.items() }
+        duration = time.monotonic() - started
+
+        stages: dict[str, StageReport] = {}
+        for stage, stats in self._stats.items():
+            runs = stats['count'] + stats['failed']
+            stages[stage] = {
+                'count': stats['count'], 'failed': stats['failed'],
+                'busy': round(stats['busy'], 2), 'wait': round(stats['wait'], 2),
+                'avg': round(stats['busy'] / runs, 2) if runs else 0.0, 'max': round(stats['max'], 2),
+            }
+        done = sum(1 for report in apps_report.values() if report['status'] == 'done')
+        report: DeployReport = {
+            'duration': round(duration, 2),
+            'apps_per_minute': round(done / duration * 60, 2) if duration else 0.0,
+            'stages': stages,
+            'apps': apps_report,
+        }
+        log.info(f'Deployed {done}/{len(apps)} apps in {duration:.1f}s ({report["apps_per_minute"]} apps/min)')
+        return report
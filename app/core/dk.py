@@ -1,10 +1,82 @@
-import json, os, requests, shutil, random
+import io, json, os, re, hashlib, requests, shutil, tarfile, time, threading
 import logging as log
-from .utils import ApiResponseError, ExecuterError, Executer, JsonEditor, AppDir
-from typing import TypedDict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .utils import ApiResponseError, JsonEditor, AppDir
+from .fetch import Downloader, DownloadTask
+from .blobs import BlobStore
+from .net import HttpCache, HttpClient
+from .engine import ContainerBackend, CliBackend, BACKEND_ERRORS, validate_resources
+from .context import BuildContext, DockerIgnore
+from .cf import CFClient
+from .ports import PortAllocator
+from .registry import AppRegistry
+from typing import Callable, TypedDict
 from typing import Self, Type
 
 
+class RepoSnapshot:
+    """
+    Repository state at one commit: fetched once per launch by GitHubRepo.probe()
+    and reused by pull and Dockerfile lookup.\n
+    `candidates` is the index of build files ranked by `rank()`: best candidate first.
+    """
+
+    COMPOSE_FILES = ('compose.yaml', 'compose.yml', 'docker-compose.yaml', 'docker-compose.yml')
+    NOISE_DIRS = ('doc', 'docs', 'example', 'examples', 'sample', 'samples', 'test', 'tests',
+                  'fixtures', 'vendor', 'node_modules', '.github', '.devcontainer')
+
+    def __init__(self, commit: str, tree: list[dict], truncated: bool = False):
+        self.commit = commit
+        self.tree = tree
+        self.truncated = truncated
+        self.candidates = sorted(
+            (item['path'] for item in tree if item['type'] == 'blob' and self.kind(item['path']) is not None),
+            key=self.rank
+        )
+
+    @property
+    def dockerfiles(self) -> list[str]:
+        return [path for path in self.candidates if self.kind(path) < 2]
+
+    @property
+    def blobs(self) -> dict[str, str]:
+        """
+        path -> blob sha
+        """
+        return { item['path']: item['sha'] for item in self.tree if item['type'] == 'blob' }
+
+    @property
+    def modes(self) -> dict[str, str]:
+        """
+        path -> git mode of blobs that are not regular files: executables (100755) and symlinks (120000)
+        """
+        return {
+            item['path']: item['mode'] for item in self.tree
+            if item['type'] == 'blob' and item.get('mode', '100644') != '100644'
+        }
+
+    @classmethod
+    def kind(cls, path: str) -> int | None:
+        """
+        0 - Dockerfile, 1 - Dockerfile.<suffix> / <prefix>.Dockerfile, 2 - compose file, None - not a build file
+        """
+        name = path.rsplit('/', 1)[-1].lower()
+        if name == 'dockerfile': return 0
+        if name.startswith('dockerfile.') or name.endswith('.dockerfile'): return 1
+        if name in cls.COMPOSE_FILES: return 2
+        return None
+
+    @classmethod
+    def rank(cls, path: str) -> tuple:
+        """
+        Sort key: files outside docs/examples/tests first, then by kind, depth and path
+        """
+        dirs = path.lower().split('/')[:-1]
+        in_noise_dir = any(part in cls.NOISE_DIRS for part in dirs)
+        return (in_noise_dir, cls.kind(path), len(dirs), path)
+
+
 class GitHubRepo:
     page_url: str
     branch: str
@@ -17,11 +89,40 @@ class GitHubRepo:
     full_name: str          # 1IQcoder/Second-PC-Server
     commit: str             # sha of downloaded commit
     api_headers: dict       # Authorization headers for GitHub API
+
+    MANIFEST_FILE = 'manifest.json'         # path -> blob sha (and git modes) of the last pull, stored in app directory
+    PARTIAL_DIR = '.partial'                # interrupted downloads of contents pulls, next to src/
+    INCREMENTAL_MAX_CHANGES = 200           # above this amount of uncached blobs a full archive download is cheaper
+    API_URL = 'https://api.github.com'
+    SNAPSHOT_TTL = 60                       # seconds a RepoSnapshot is trusted without asking GitHub again
+    TREE_WORKERS = 8                        # concurrent subtree requests when GitHub truncates a tree
+
+    _snapshots = OrderedDict()              # "<api url>@<commit>" -> RepoSnapshot, shared by all instances
+    _snapshots_size = 32
+    _snapshots_lock = threading.Lock()
     
+    def _get(self, url: str, headers: dict = None) -> requests.Response:
+        """
+        GET for metadata calls, revalidated against HttpCache so unchanged answers cost a 304.
+        Slows down once the token is close to its rate limit (see HttpCache.throttle), bulk redeploys don't run into 403
+        """
+        HttpCache.shared().throttle(self.api_headers)
+        return HttpCache.shared().get(url, headers={ **self.api_headers, **(headers or {}) })
+
+    def rate_limit_remaining(self) -> int | None:
+        """
+        Requests left for this access token as reported by the last GitHub answer
+        """
+        return HttpCache.shared().rate_limit_remaining(self.api_headers)
+
+    @classmethod
+    def _api_url(cls, url: str) -> str:
+        return url.replace("https://github.com/", f"{cls.API_URL}/repos/").removesuffix(".git")
+
     def _getRepoData(self, url: str) -> dict:
-        req_url = url.replace("https://github.com/", "https://api.github.com/repos/").removesuffix(".git")
+        req_url = self._api_url(url)
         log.info(f'Checking repository URL: {req_url}')
-        res = requests.get(req_url, headers=self.api_headers)
+        res = self._get(req_url)
         res_data = res.json()
         if res.status_code != 200:
             if res.status_code == 404:
@@ -40,86 +141,344 @@ class GitHubRepo:
         self.name = res_data['name']
         self.full_name = res_data['full_name']
 
-    def _getRepoBranch(self, branch) -> str:
-        if branch == 'default':
-            self.branch = self.default_branch
-            del self.default_branch
-            return True
-        req_url = f'{self.url}/branches/{branch}'
-        res = requests.get(req_url, headers=self.api_headers)
+    def _isDkfileExists(self):
+        dockerfiles = self.probe().dockerfiles
+        if dockerfiles:
+            dk_file_path = dockerfiles[0]
+            log.info(f'Found Dockerfile at {dk_file_path}')
+            return dk_file_path
+        log.warning('Dockerfile not found in repository.')
+        return False
+
+    def _getHeadCommit(self, ref: str = None) -> str:
+        """
+        Sha of the commit ref points to (current branch by default)
+        """
+        ref = ref or self.branch
+        req_url = f'{self.url}/commits/{ref}'
+        res = self._get(req_url, headers={ "Accept": "application/vnd.github.sha" })
         if res.status_code != 200:
-            if res.status_code == 404:
-                raise ValueError("Repository dont exists branch with name "+branch)
+            if res.status_code in (404, 422):
+                raise ValueError("Repository dont exists branch with name "+ref)
+            log.error(f'Failed to fetch head commit of {ref}: {res.status_code}')
             raise ApiResponseError(res)
-        return branch
+        return res.text.strip()
 
-    def _isDkfileExists(self):
-        req_url = f'{self.url}/git/trees/{self.branch}?recursive=1'
-        log.info(f'Checking Dockerfile existence in repository: {req_url}')
-        res = requests.get(req_url, headers=self.api_headers)
+    def _getTree(self, ref: str) -> dict:
+        req_url = f'{self.url}/git/trees/{ref}?recursive=1'
+        res = self._get(req_url)
         if res.status_code != 200:
             log.error(f'Failed to fetch repository tree: {res.status_code}')
             raise ApiResponseError(res)
-        fileTree = res.json()['tree']
-        for file in fileTree:
-            path = file['path']
-            if path.endswith('Dockerfile'):
-                dk_file_path = path
-                log.info(f'Found Dockerfile at {dk_file_path}')
-                return dk_file_path
-        log.warning('Dockerfile not found in repository.')
-        return False
+        return res.json()
+
+    def _getSubtree(self, sha: str, prefix: str, recursive: bool = True) -> tuple[list[dict], list[tuple[str, str]]]:
+        """
+        Returns (entries with full paths, subtrees still to walk as (sha, path)).
+        A subtree is split into its direct children only when GitHub truncates it too.
+        """
+        req_url = f'{self.url}/git/trees/{sha}' + ('?recursive=1' if recursive else '')
+        res = self._get(req_url)
+        if res.status_code != 200:
+            log.error(f'Failed to fetch repository subtree {prefix or "/"}: {res.status_code}')
+            raise ApiResponseError(res)
+        data = res.json()
+        if recursive and data.get('truncated'):
+            return self._getSubtree(sha, prefix, recursive=False)
+
+        entries = [{ **item, 'path': f"{prefix}{item['path']}" } for item in data['tree']]
+        subtrees = [] if recursive else [(item['sha'], f"{item['path']}/") for item in entries if item['type'] == 'tree']
+        return entries, subtrees
+
+    def _walkTree(self, commit: str) -> list[dict]:
+        """
+        Rebuilds the complete recursive tree of a commit GitHub truncated,
+        walking subtrees concurrently
+        """
+        items = []
+        with ThreadPoolExecutor(max_workers=self.TREE_WORKERS) as pool:
+            pending = { pool.submit(self._getSubtree, commit, '', recursive=False) }
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entries, subtrees = future.result()
+                    items.extend(entries)
+                    pending |= { pool.submit(self._getSubtree, sha, path) for sha, path in subtrees }
+        items.sort(key=lambda item: item['path'])
+        log.info(f'Repository tree walked: {len(items)} entries')
+        return items
+
+    def probe(self, refresh: bool = False, commit: str = None) -> RepoSnapshot:
+        """
+        Returns RepoSnapshot of the branch head. The head is asked again after SNAPSHOT_TTL seconds,
+        snapshots are cached per commit, so an unchanged head costs no tree request.
 
-    def pull(self, dir_path):
-        def _download(file_list, output_dir):
+        :param refresh: ignore cached head commit
+        :param commit: head sha when it is already known
+        """
+        snapshot: RepoSnapshot = getattr(self, '_snapshot', None)
+        if snapshot and not refresh and time.monotonic() - self._probed < self.SNAPSHOT_TTL:
+            return snapshot
+        commit = commit or self._getHeadCommit()
+
+        key = f'{self.url}@{commit}'
+        with self._snapshots_lock:
+            snapshot = self._snapshots.get(key)
+        if not snapshot:
+            tree = self._getTree(commit)
+            items, truncated = tree['tree'], tree.get('truncated', False)
+            if truncated:
+                log.warning(f'Repository tree of {commit} is truncated, walking subtrees')
+                try: items, truncated = self._walkTree(commit), False
+                except (ApiResponseError, requests.RequestException) as e:
+                    log.error(f'Failed to walk repository tree: {e}')
+            snapshot = RepoSnapshot(commit, items, truncated)
+            if not truncated:
+                with self._snapshots_lock:
+                    self._snapshots[key] = snapshot
+                    while len(self._snapshots) > self._snapshots_size: self._snapshots.popitem(last=False)
+
+        self._snapshot = snapshot
+        self._probed = time.monotonic()
+        return snapshot
+
+    def _iter_archive(self, ref: str = None):
+        """
+        Streams the tarball of ref (branch by default) and yields (tar, member) pairs
+        with paths relative to the repository root. The archive is never held in memory.
+        """
+        req_url = f'{self.url}/tarball/{ref or self.branch}'
+        log.info(f'Downloading repository archive from {req_url}')
+        with HttpClient.shared().get(req_url, headers=self.api_headers, stream=True) as res:
+            if res.status_code != 200:
+                log.error(f'Failed to fetch repository archive: {res.status_code}')
+                raise ApiResponseError(res)
+            res.raw.decode_content = True
+            with tarfile.open(fileobj=res.raw, mode='r|*') as tar:
+                for member in tar:
+                    # GitHub wraps everything into "<owner>-<repo>-<sha>/" root folder
+                    rel_path = self._strip_archive_root(member.name)
+                    if not rel_path: continue
+                    member.name = rel_path
+                    if member.islnk():
+                        member.linkname = self._strip_archive_root(member.linkname)
+                    yield tar, member
+
+    def _pull_archive(self, src_path: str, ref: str = None):
+        """
+        Unpacks the repository tarball straight into src_path (one request for the whole repository)
+        """
+        for tar, member in self._iter_archive(ref):
+            target = os.path.join(src_path, member.name)
+            # replace instead of writing into the old file, it may be a hardlink into BlobStore
+            if member.isfile() and os.path.isfile(target): os.remove(target)
+            tar.extract(member, src_path, filter='data')
+        log.info('Repository archive unpacked.')
+
+    def _archive_to_store(self, store: BlobStore, ref: str = None, paths: set[str] = None) -> int:
+        """
+        Streams the repository tarball into the blob store. Returns amount of stored blobs
+
+        :param paths: store only these files
+        """
+        count = 0
+        for tar, member in self._iter_archive(ref):
+            if not (member.isfile() or member.issym()) or (paths is not None and member.name not in paths): continue
+            if member.issym():
+                # the blob of a symlink is its target
+                target = os.fsencode(member.linkname)
+                store.add(io.BytesIO(target), len(target))
+            else:
+                store.add(tar.extractfile(member), member.size)
+            count += 1
+        log.info(f'Repository archive stored: {count} blobs')
+        return count
+
+    @staticmethod
+    def _strip_archive_root(path: str) -> str:
+        parts = path.split('/', 1)
+        return parts[1] if len(parts) > 1 else ''
+
+    def _pull_contents(self, src_path: str, workers: int = Downloader.WORKERS, ref: str = None):
+        """
+        Walks the repository through /contents API (one request per directory),
+        then downloads the collected files concurrently
+        """
+        def _collect(file_list, output_dir, tasks: list[DownloadTask]):
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
 
             for file in file_list:
                 if file['type'] == 'file':
-                    file_name = file['name']
                     download_url = file['download_url']
-
                     if download_url:
-                        # print(f"Downloading {file_name}...")
-                        response = requests.get(download_url, headers=self.api_headers)
-                        if response.status_code == 200:
-                            with open(os.path.join(output_dir, file_name), 'wb') as f:
-                                f.write(response.content)
-                            # print(f"File {file_name} downloaded.")
-                        else:
-                            print(f"Failed to download {file_name}. HTTP {response.status_code}")
-                    # else: print(f"No download URL for {file_name}. Skipping.")
+                        tasks.append({ 'url': download_url, 'path': os.path.join(output_dir, file['name']) })
 
                 elif file['type'] == 'dir':
                     dir_name = file['name']
-                    dir_url = file['url']
-                    # print(f"Entering directory {dir_name}...")
-                    response = requests.get(dir_url, headers=self.api_headers)
+                    response = self._get(file['url'])
                     if response.status_code == 200:
-                        sub_files = response.json()
-                        sub_dir = os.path.join(output_dir, dir_name)
-                        _download(sub_files, sub_dir)
+                        _collect(response.json(), os.path.join(output_dir, dir_name), tasks)
                     else:
                         log.error(f"Failed to access directory {dir_name}. HTTP {response.status_code}")
+            return tasks
 
-        req_url = f'{self.url}/contents/?ref={self.branch}'
+        req_url = f'{self.url}/contents/?ref={ref or self.branch}'
         log.info(f'Downloading repository contents from {req_url}')
-        res = requests.get(req_url, headers=self.api_headers)
+        res = self._get(req_url)
         if res.status_code != 200:
             log.error(f'Failed to fetch repository contents: {res.json()["message"]}')
             raise ApiResponseError(res)
-        files = res.json()
+        tasks = _collect(res.json(), src_path, [])
+        # partial files stay out of src/, the build context never sees them
+        part_dir = os.path.join(os.path.dirname(os.path.abspath(src_path)), self.PARTIAL_DIR)
+        stats = Downloader(headers=self.api_headers, workers=workers, part_dir=part_dir).download_all(tasks)
+        log.info(f'Repository contents downloaded: {stats}')
+
+    def _pull_full(self, src_path: str, workers: int = Downloader.WORKERS, ref: str = None):
+        try:
+            self._pull_archive(src_path, ref)
+        except (ApiResponseError, requests.RequestException, tarfile.TarError) as e:
+            log.warning(f'Archive download failed, falling back to per-file download: {e}')
+            self._pull_contents(src_path, workers, ref)
+
+    def _sparse_blobs(self, blobs: dict[str, str], dockerfile: str, store: BlobStore) -> dict[str, str]:
+        """
+        Drops files the Docker build never sees: the ignore file of the build context
+        (repository root, see DockerIgnore.file_names) is fetched first and applied to the tree
+        """
+        ignore_files = DockerIgnore.file_names(dockerfile)
+        ignore_file = next((path for path in ignore_files if path in blobs), None)
+        if not ignore_file: return blobs
+
+        sha = blobs[ignore_file]
+        if not store.has(sha):
+            res = self._get(f'{self.url}/git/blobs/{sha}', headers={ "Accept": "application/vnd.github.raw" })
+            if res.status_code != 200:
+                log.error(f'Failed to fetch {ignore_file}: {res.status_code}')
+                raise ApiResponseError(res)
+            if store.add(io.BytesIO(res.content), len(res.content)) != sha:
+                raise ValueError(f"Downloaded {ignore_file} does not match blob {sha}")
+        with open(store.path(sha), 'r', encoding='utf-8') as f:
+            ignore = DockerIgnore(f.read().splitlines())
+
+        keep = { dockerfile, *ignore_files }
+        sparse = { path: sha for path, sha in blobs.items() if path in keep or not ignore.is_excluded(path) }
+        log.info(f'{ignore_file}: {len(blobs) - len(sparse)} of {len(blobs)} files are not downloaded')
+        return sparse
+
+    def _pull_incremental(self, dir_path: str, src_path: str, workers: int = Downloader.WORKERS,
+                          store: BlobStore = None, dockerfile: str = None):
+        """
+        Compares the recursive tree of the head commit with the manifest of the previous pull
+        and updates only added or changed files; files removed from the repository are deleted.\n
+        Blobs come from the shared BlobStore, only blobs missing there are downloaded.
+        With dockerfile set, files excluded by .dockerignore are skipped (sparse checkout of the build context).
+        """
+        store = store or BlobStore()
+        snapshot = self.probe()
+        commit = snapshot.commit
+        manifest_path = os.path.join(dir_path, self.MANIFEST_FILE)
+
+        if snapshot.truncated:
+            # tree listing is incomplete, neither manifest nor blob store can describe it
+            log.warning(f'Repository tree is truncated, full download of commit {commit}')
+            if os.path.isdir(src_path): shutil.rmtree(src_path)
+            self._pull_full(src_path, workers, commit)
+            if os.path.exists(manifest_path): os.remove(manifest_path)
+            self.commit = commit
+            return
+
+        # pinned and touched before anything is checked: evict() of a concurrent pull must not drop them
+        with store.pinned(set(snapshot.blobs.values())):
+            blobs = snapshot.blobs
+            if dockerfile: blobs = self._sparse_blobs(blobs, dockerfile, store)
+            modes = { path: mode for path, mode in snapshot.modes.items() if path in blobs }
+            manifest = JsonEditor.read(manifest_path) if JsonEditor.validate_file(manifest_path) else {}
+            old_blobs: dict = manifest.get('files', {})
+            old_modes: dict = manifest.get('modes', {})
+
+            changed = [
+                path for path, sha in blobs.items()
+                if old_blobs.get(path) != sha or old_modes.get(path) != modes.get(path)
+                or not os.path.lexists(os.path.join(src_path, path))
+            ]
+            removed = [path for path in old_blobs if path not in blobs]
+            missing = { blobs[path] for path in changed if not store.has(blobs[path]) }
+            log.info(f'Pull of commit {commit}: {len(changed)} changed, {len(removed)} removed, {len(missing)} not cached')
+
+            if len(missing) > self.INCREMENTAL_MAX_CHANGES or len(missing) * 2 > len(blobs):
+                try: self._archive_to_store(store, commit, paths=set(blobs))
+                except (ApiResponseError, requests.RequestException, tarfile.TarError) as e:
+                    log.warning(f'Archive download failed, falling back to per-file download: {e}')
+                missing = { sha for sha in missing if not store.has(sha) }
+
+            if missing:
+                tasks: list[DownloadTask] = [
+                    { 'url': f'{self.url}/git/blobs/{sha}', 'path': store.incoming_path(sha) } for sha in missing
+                ]
+                headers = { **self.api_headers, "Accept": "application/vnd.github.raw" }
+                HttpCache.shared().throttle(self.api_headers, min_remaining=len(tasks) + 100)
+                stats = Downloader(headers=headers, workers=workers).download_all(tasks)
+                if stats.failed:
+                    raise ValueError(f"Failed to download {len(stats.failed)} of {len(tasks)} changed files")
+                # hashed on the way in, a corrupted download never reaches the store
+                corrupted = []
+                for sha in missing:
+                    try: store.ingest(sha)
+                    except ValueError as e: corrupted.append(str(e))
+                if corrupted:
+                    raise ValueError('; '.join(corrupted))
+
+            for path in changed:
+                store.link(blobs[path], os.path.join(src_path, path), modes.get(path))
+            for path in removed:
+                file_path = os.path.join(src_path, path)
+                if os.path.islink(file_path) or os.path.isfile(file_path): os.remove(file_path)
+                # drop directories left empty
+                parent = os.path.dirname(file_path)
+                while parent != src_path and os.path.isdir(parent) and not os.listdir(parent):
+                    os.rmdir(parent)
+                    parent = os.path.dirname(parent)
+
+        store.evict()
+
+        self.commit = commit
+        JsonEditor.overwrite(manifest_path, { 'commit': commit, 'files': blobs, 'modes': modes })
+
+    def pull(self, dir_path, mode: str = 'incremental', workers: int = Downloader.WORKERS,
+             store: BlobStore = None, dockerfile: str = None):
+        """
+        Downloads repository files into <dir_path>/src
+
+        :param mode: 'incremental' - downloads only blobs changed since the previous pull (see MANIFEST_FILE);
+                     'archive' - single tarball download, falls back to 'contents' on failure;
+                     'contents' - per-file walk through /contents API
+        :param workers: size of the thread pool used for per-file downloads
+        :param store: blob cache used by 'incremental' mode, shared `db/blobs` store by default
+        :param dockerfile: Dockerfile path (see _isDkfileExists); 'incremental' mode then skips .dockerignore'd files
+        """
+        if mode not in ('incremental', 'archive', 'contents'):
+            raise ValueError(f"Unknown pull mode ({mode})")
         src_path = os.path.join(dir_path, 'src')
-        _download(files, src_path)
+        match mode:
+            case 'incremental': self._pull_incremental(dir_path, src_path, workers, store, dockerfile)
+            case 'archive': self._pull_full(src_path, workers)
+            case 'contents': self._pull_contents(src_path, workers)
 
     def __init__(self, url: str, access_token: str, branch: str = 'default'):
         self.page_url = url
         self.api_headers = { "Authorization": f"token {access_token}" }
+        self.url = self._api_url(url)
 
-        data = self._getRepoData(url)
-        self._setRepoData(data)
-        self.branch = self._getRepoBranch(branch)
+        # repo metadata and branch head don't depend on each other, HEAD resolves to the default branch
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            data_future = pool.submit(self._getRepoData, url)
+            commit_future = pool.submit(self._getHeadCommit, 'HEAD' if branch == 'default' else branch)
+            self._setRepoData(data_future.result())
+            self.branch = self.default_branch if branch == 'default' else branch
+            commit = commit_future.result()
+        self.probe(commit=commit)
 
 
 class DockerApp:
@@ -129,17 +488,38 @@ class DockerApp:
 
     pc_port: int                    # localhost:port on which app available
     dk_file_path: str               # file path relative to repository root
-    dir_path: str                   # directory that includes app's info.json
+    dir_path: str                   # directory with app's sources (its state is kept in AppRegistry)
+    build_metrics: dict             # BuildMetrics of the last build
+    container: str                  # name of the live container (blue/green name after redeploy)
+    commit: str                     # commit the current image was built from
+    build_hash: str                 # hash of the other build inputs, see _build_hash()
+    resources: dict                 # ResourceProfile: cpu/memory limits and cpu pinning of container and builds
+    status: str                     # last completed stage: pulled | built | running | tunneled
+    pulled_commit: str              # commit src/ was pulled at, a build resumes from it after a restart
+    run_config: dict                # port and runtime limits the live container was started with, see _run_config()
+
+    KEEP_IMAGES = 3                 # build images kept per app, older ones are removed after a build
+    HEALTH_TIMEOUT = 60             # seconds a redeployed container has to start answering
+    HEALTH_INTERVAL = 1.0
+    DRAIN_SECONDS = 10              # old container keeps running after the route switch
+    RUN_LIMITS = ('cpus', 'memory', 'cpuset')
+
+    @property
+    def backend(self) -> ContainerBackend:
+        """
+        Container backend of this app, ContainerBackend.from_env() unless passed to __init__
+        """
+        if not getattr(self, '_backend', None):
+            self._backend = ContainerBackend.from_env()
+        return self._backend
 
     @classmethod
     def load(cls, app_name: str):
-        path = os.path.join(AppDir.APPS_DIR, app_name, 'info.json')
-        if not os.path.exists(path):
+        attrs = AppRegistry.shared().get(app_name)
+        if attrs is None:
             raise ValueError(f"App with name ({app_name}) not found")
-        
-        info_data = JsonEditor.read(path)
+
         app = cls.__new__(cls)
-        attrs = info_data['attrs']
 
         def set_attributes(obj, attr_data, cls_type):
             for attr, value in attr_data.items():
@@ -157,60 +537,63 @@ class DockerApp:
 
     @classmethod
     def to_wsl_path(cls, win_path: str):
-        drive, path = win_path.split(":", 1)
-        wsl_path = f"/mnt/{drive.lower()}{path.replace('\\', '/')}"
-        return wsl_path
-
-    def _set_pcport(self):
-        def is_port_free(port) -> bool:
-            res = Executer.run_cmd(f'netstat -an | findstr "127.0.0.1:{port}"')
-            if res.returncode != 1: return False
-            else: return True
-
-        def generate_port(attempts) -> int:
-            if attempts < 1: raise ValueError("Failed to generate port for localhost")
-            port = random.randint(1025, 49150)
-            if not is_port_free(port): return generate_port(attempts-1)
-            return port
-
-        if is_port_free(self.port):
-            self.pc_port = self.port
-        else:
-            port = generate_port(3)
-            self.pc_port = port
-
-    def _del_image(self):
-        res = Executer.run_cmd(f'wsl docker image prune -f')
-        if res.returncode != 0:
-            log.error(f'Failed to delete <none> docker images: {res.stderr}')
-        res = Executer.run_cmd(f'wsl docker rmi --force {self.name}:latest')
-        if res.returncode != 0:
-            log.error(f'Failed to delete old Docker image: {res.stderr}')
-
-    def _del_container(self):
-        res = Executer.run_cmd(f'wsl docker stop {self.name}')
-        if res.returncode != 0:
-            log.warning(f'Docker stop container error: {res.stderr}', exc_info=True)
-        res = Executer.run_cmd(f'wsl docker rm {self.name}')
-        if res.returncode != 0:
-            log.warning(f'Docker remove container error: {res.stderr}', exc_info=True)
-
-    def __init__(self, name: str, port: int, repo: "GitHubRepo"):
+        return CliBackend.to_wsl_path(win_path)
+
+    def _set_pcport(self, fresh: bool = False):
+        """
+        Leases localhost port for the container, self.port if it is free
+
+        :param fresh: lease another port even if the app already has one (blue/green switch)
+        """
+        self.pc_port = PortAllocator.shared().lease(self.name, preferred=self.port, keep=not fresh)
+        # a fresh port is saved by switch() once the new container took over
+        if not fresh: self.save()
+
+    def _del_container(self, container: str = None):
+        container = container or getattr(self, 'container', None) or self.name
+        try: self.backend.stop(container)
+        except BACKEND_ERRORS as e:
+            log.warning(f'Docker stop container error: {e}')
+        try: self.backend.remove_container(container)
+        except BACKEND_ERRORS as e:
+            log.warning(f'Docker remove container error: {e}')
+
+    def _read_info(self) -> dict:
+        """
+        App attributes saved by the previous launch, {} for a new app
+        """
+        return AppRegistry.shared().get(self.name) or {}
+
+    def __init__(self, name: str, port: int, repo: "GitHubRepo", backend: ContainerBackend = None, resources: dict = None):
         self.name = name
         self.port = port
         self.repo = repo
+        self._backend = backend
         path = repo._isDkfileExists()
         if not path: raise ValueError("Dockerfile not found")
         self.dk_file_path = path
         self.dir_path = AppDir.new_app_dir(name)
-
-    def __del__(self):
-        # Saving project data before destruction
-        if hasattr(self, 'isDeleted') or not hasattr(self, 'name'): return
-        data_obj = {}
+        # live container of the previous launch, redeploy() replaces it without downtime
+        previous = self._read_info()
+        self.container = previous.get('container')
+        if previous.get('pc_port'): self.pc_port = previous['pc_port']
+        # what the current image was built from, an unchanged app is not rebuilt
+        self.commit = previous.get('commit')
+        self.build_hash = previous.get('build_hash')
+        self.resources = validate_resources(resources) if resources is not None else previous.get('resources') or {}
+        # stage an interrupted launch got to, see resume_stage()
+        self.status = previous.get('status')
+        self.pulled_commit = previous.get('pulled_commit')
+        self.save()
+
+    def _attrs(self) -> dict:
+        """
+        Public attributes of the app, nested objects (repo) as dicts
+        """
         attrs = {}
         def save_obj(obj, obj_key=None):
             for key, value in obj.__dict__.items():
+                if key.startswith('_'): continue
                 if hasattr(value, '__dict__'):
                     save_obj(value, obj_key=key)
                 else:
@@ -218,37 +601,300 @@ class DockerApp:
                     else: attrs[key] = value
 
         save_obj(self)
-        data_obj.update({ 'app': attrs })
-        path = os.path.join(self.dir_path, 'info.json')
-        JsonEditor.overwrite(path, data_obj)
+        return attrs
+
+    def save(self, durable: bool = False):
+        """
+        Stores the app state in AppRegistry. Updates are coalesced (see AppRegistry.update) unless durable
+        """
+        if getattr(self, 'isDeleted', False): return
+        registry = AppRegistry.shared()
+        if durable: registry.save(self.name, self._attrs())
+        else: registry.update(self.name, self._attrs())
+
+    def checkpoint(self, status: str):
+        """
+        Marks a stage as completed and saves the state at once, a restarted launch goes on from here
+        """
+        self.status = status
+        self.save(durable=True)
+        log.info(f'{self.name}: {status}')
+
+    def resume_stage(self) -> str:
+        """
+        First stage a launch has to run: 'run' when the image is built from the branch head,
+        'build' when an interrupted launch already pulled the head, otherwise 'pull'
+        """
+        if self.is_unchanged(): stage = 'run'
+        elif (getattr(self, 'status', None) == 'pulled' and getattr(self, 'pulled_commit', None)
+              and os.path.isdir(os.path.join(self.dir_path, 'src'))
+              and self.repo.probe().commit == self.pulled_commit):
+            stage = 'build'
+        else: return 'pull'
+        # build() records the commit of the snapshot src/ is at
+        self._pulled = self.repo.probe()
+        return stage
+
+    def delete(self):
+        """
+        Removes the app: container, images, port leases and app directory
+        """
+        self._del_container()
+        try: tags = self.backend.list_tags(self.name)
+        except BACKEND_ERRORS as e:
+            log.error(f'Failed to list Docker images of {self.name}: {e}')
+            tags = []
+        for tag in tags:
+            try: self.backend.remove_image(f'{self.name}:{tag}')
+            except BACKEND_ERRORS as e:
+                log.error(f'Failed to delete Docker image {self.name}:{tag}: {e}')
+        PortAllocator.shared().release(self.name)
+        AppRegistry.shared().delete(self.name)
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+        self.isDeleted = True
+        log.info(f'App {self.name} deleted')
+
+    def _prune_images(self, keep: int = None):
+        """
+        Retention policy: keeps `keep` newest build images of the app (tags `b<timestamp>`)
+        """
+        keep = self.KEEP_IMAGES if keep is None else keep
+        try: tags = self.backend.list_tags(self.name)
+        except BACKEND_ERRORS as e:
+            return log.error(f'Failed to list Docker images of {self.name}: {e}')
+        build_tags = sorted((tag for tag in tags if re.fullmatch(r'b\d{14}', tag)), reverse=True)
+        for tag in build_tags[keep:]:
+            try: self.backend.remove_image(f'{self.name}:{tag}', force=False)
+            except BACKEND_ERRORS as e:
+                log.warning(f'Failed to delete old Docker image {self.name}:{tag}: {e}')
+
+    def build(self, no_cache: bool = False, on_line: Callable[[str], None] = None, cancel: threading.Event = None):
+        """
+        Builds the image keeping the layer cache
+
+        :param no_cache: rebuild every layer from scratch
+        :param on_line: receives builder output lines while the build runs
+        :param cancel: aborts the build once set
+        """
+        log.info(f'Starting Docker image build for {self.name}' + (' without cache' if no_cache else ''))
+        src_path = os.path.join(self.dir_path, 'src')
+        build_tag = time.strftime('b%Y%m%d%H%M%S')
+        manifest_path = os.path.join(self.dir_path, GitHubRepo.MANIFEST_FILE)
+        # src/ pulled without a manifest (truncated tree) keeps the modes of the filesystem
+        modes = JsonEditor.read(manifest_path).get('modes') if JsonEditor.validate_file(manifest_path) else None
+        context = BuildContext(src_path, self.dk_file_path, modes)
+        # builds of all apps share ContainerBackend.BUILD_SLOTS
+        with ContainerBackend.build_slot(cancel):
+            started = time.monotonic()
+            metrics = self.backend.build(
+                [f'{self.name}:latest', f'{self.name}:{build_tag}'], context, no_cache=no_cache, on_line=on_line, cancel=cancel,
+                resources=getattr(self, 'resources', None)
+            )
+        metrics.update(
+            duration=round(time.monotonic() - started, 2), context_files=context.files, context_size=context.size
+        )
+        self.build_metrics = metrics
+        pulled: RepoSnapshot = getattr(self, '_pulled', None)
+        if pulled: self.commit, self.build_hash = pulled.commit, self._build_hash(pulled)
+        self.checkpoint('built')
+        log.info(
+            f'Docker image {self.name} built successfully in {metrics["duration"]}s, '
+            f'{metrics["cached"]}/{metrics["steps"]} steps from cache.'
+        )
+        self._prune_images()
+
+    def pull(self):
+        """
+        Brings src/ to the repo's current commit
+        """
+        self._pulled = None
+        self.repo.pull(self.dir_path, dockerfile=self.dk_file_path)
+        # snapshot the pull worked with, build() records its commit
+        self._pulled = getattr(self.repo, '_snapshot', None)
+        self.pulled_commit = self._pulled.commit if self._pulled else None
+        self.checkpoint('pulled')
+
+    def _build_hash(self, snapshot: RepoSnapshot) -> str:
+        """
+        Hash of the build inputs besides the commit: Dockerfile path, Dockerfile and ignore file blobs
+        """
+        blobs = snapshot.blobs
+        inputs = [self.dk_file_path] + [
+            f'{path}:{blobs.get(path)}' for path in (self.dk_file_path, *DockerIgnore.file_names(self.dk_file_path))
+        ]
+        return hashlib.sha256('\n'.join(inputs).encode()).hexdigest()
+
+    def is_unchanged(self) -> bool:
+        """
+        Whether the branch head and build inputs are the ones the current image was built from
+        """
+        if not getattr(self, 'commit', None) or not getattr(self, 'build_hash', None): return False
+        snapshot = self.repo.probe()
+        return snapshot.commit == self.commit and self._build_hash(snapshot) == self.build_hash
 
-    def build(self):
-        self._del_image()
-        log.info(f'Starting Docker image build for {self.name}')
-        dkfile_full_path = os.path.join(self.dir_path, 'src', self.dk_file_path)
+    def _run_config(self) -> dict:
+        """
+        What a container is started with besides the image: app port and runtime limits
+        """
+        resources = getattr(self, 'resources', None) or {}
+        return { 'port': self.port, 'limits': { key: resources[key] for key in self.RUN_LIMITS if resources.get(key) } }
 
-        run_command = f'wsl docker build -t {self.name}:latest -f {self.to_wsl_path(dkfile_full_path)} {self.to_wsl_path(self.dir_path)}/src --no-cache'
-        res = Executer.run_cmd(run_command)
-        res.check_returncode()
-        log.info(f'Docker image {self.name} built successfully.')
+    def _sync_run_config(self, container: str) -> bool:
+        """
+        Applies changed limits to the running container. False when it has to be started again:
+        the port changed or a limit was removed (docker update can't unset one)
+        """
+        started, current = getattr(self, 'run_config', None), self._run_config()
+        if started == current: return True
+        # unknown for containers started before run_config was recorded, the limits are applied again
+        if started and (started['port'] != current['port'] or set(started['limits']) - set(current['limits'])):
+            return False
+        if current['limits']: self.backend.update(container, self.resources)
+        self.run_config = current
+        self.save()
+        return True
+
+    def has_image(self) -> bool:
+        return 'latest' in self.backend.list_tags(self.name)
+
+    def _start_unchanged(self, restart: bool = False) -> int | None:
+        """
+        Starts the app from its current image. Returns pc_port, None when the image is gone
+        """
+        container = self.container or self.name
+        if self.backend.is_running(container):
+            if self._sync_run_config(container):
+                if restart:
+                    log.info(f'Restarting {container}')
+                    self.backend.restart(container)
+                return self.pc_port
+            log.info(f'Port or limits of {self.name} changed, {container} is started again')
+        if not self.has_image(): return None
+        self._set_pcport()
+        self.run()
+        return self.pc_port
 
     def run(self):
         self._del_container()
         log.info(f'Starting container for {self.name}')
-        run_command = f'wsl docker run --name {self.name} -d -p {self.pc_port}:{self.port} {self.name}:latest'
-        res = Executer.run_cmd(run_command)
-        if res.returncode != 0:
-            log.error(f'Failed to start Docker container: {res.stderr}')
-            raise ExecuterError(res)
+        try: self.backend.run(self.name, f'{self.name}:latest', { self.pc_port: self.port }, getattr(self, 'resources', None))
+        except BACKEND_ERRORS as e:
+            log.error(f'Failed to start Docker container: {e}')
+            raise
+        self.container = self.name
+        self.run_config = self._run_config()
         log.info(f'Container {self.name} started successfully.')
+        self.checkpoint('running')
 
-    def launch(self) -> int:
+    def set_resources(self, resources: dict):
+        """
+        Replaces the resource profile (see ResourceProfile). Runtime limits are applied to the running container at once,
+        build limits take effect with the next build
         """
-        Build & Run
+        self.resources = validate_resources(resources)
+        container = getattr(self, 'container', None) or self.name
+        if self.backend.is_running(container) and not self._sync_run_config(container):
+            log.warning(f'A limit of {self.name} was removed, it takes effect when the container is started again')
+        self.save(durable=True)
+        log.info(f'Resources of {self.name}: {self.resources}')
+
+    def _wait_healthy(self, port: int, path: str, timeout: float, cancel: threading.Event = None) -> bool:
+        """
+        Polls http://localhost:port/path until it answers with a non 5xx status
+        """
+        url = f'http://localhost:{port}/{path.lstrip("/")}'
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if cancel and cancel.is_set(): return False
+            try:
+                if requests.get(url, timeout=self.HEALTH_INTERVAL * 2).status_code < 500: return True
+            except requests.RequestException: pass
+            time.sleep(self.HEALTH_INTERVAL)
+        return False
+
+    def switch(self, health_path: str = '/', health_timeout: float = HEALTH_TIMEOUT, drain: float = DRAIN_SECONDS,
+               route: Callable[[int], None] = None, cancel: threading.Event = None) -> int:
+        """
+        Blue/green switch to the built image: the new container starts next to the live one on a fresh port,
+        traffic is moved only when it passes the health check, then the old container is drained and stopped.
+        If the health check or the route switch fails the new container is removed and the old one keeps serving.\n
+        Returns the new localhost port
+
+        :param route: points the app's public route to the given port (Cloudflare ingress)
+        """
+        old_container, old_port = self.container, getattr(self, 'pc_port', None)
+        new_container = f'{self.name}-green' if (old_container or '').endswith('-blue') else f'{self.name}-blue'
+        self._del_container(new_container)          # left by a failed redeploy
+        # the old container still holds its port, so a different one is leased
+        self._set_pcport(fresh=True)
+        new_port = self.pc_port
+        log.info(f'Starting {new_container} on port {new_port} next to {old_container}')
+        switched = False
+        try:
+            self.backend.run(new_container, f'{self.name}:latest', { new_port: self.port }, getattr(self, 'resources', None))
+            if not self._wait_healthy(new_port, health_path, health_timeout, cancel):
+                raise ValueError(f"{new_container} failed the health check, {old_container or 'nothing'} keeps serving")
+            if route: route(new_port)
+            switched = True
+        finally:
+            # the old container keeps serving until traffic is actually moved
+            if not switched:
+                self._del_container(new_container)
+                PortAllocator.shared().release(self.name, new_port)
+                self.pc_port = old_port
+                self.save()
+        self.container = new_container
+        self.run_config = self._run_config()
+        log.info(f'{self.name} switched to {new_container} (port {new_port})')
+        self.checkpoint('tunneled' if route else 'running')
+        if old_container:
+            time.sleep(drain)
+            self._del_container(old_container)
+        if old_port and old_port != new_port: PortAllocator.shared().release(self.name, old_port)
+        return new_port
+
+    def redeploy(self, hostname: str = None, health_path: str = '/', health_timeout: float = HEALTH_TIMEOUT,
+                 drain: float = DRAIN_SECONDS, no_cache: bool = False,
+                 on_line: Callable[[str], None] = None, cancel: threading.Event = None) -> int:
+        """
+        Zero-downtime launch: pull, build, then switch() with the Cloudflare route of hostname moved to the new port
+
+        :param hostname: public hostname of the app in the tunnel ingress, the route is not touched if None
+        """
+        stage = self.resume_stage()
+        container = self.container or self.name
+        if not no_cache and stage == 'run' and self.backend.is_running(container) and self._sync_run_config(container):
+            log.info(f'{self.name} is up to date with {self.commit[:7]}, redeploy skipped')
+            return self.pc_port
+        if stage == 'pull': self.pull()
+        self.build(no_cache=no_cache, on_line=on_line, cancel=cancel)
+
+        def route(port: int):
+            CFClient().route.set({ 'hostname': hostname, 'service': f'http://localhost:{port}' })
+
+        return self.switch(health_path, health_timeout, drain, route=route if hostname else None, cancel=cancel)
+
+    def launch(self, no_cache: bool = False, on_line: Callable[[str], None] = None, cancel: threading.Event = None,
+               restart: bool = False) -> int:
+        """
+        Build & Run. If the branch head and build inputs didn't change since the last build,
+        nothing is pulled or built, the container is only started when it is not running.
+        A launch interrupted after the pull goes on with the build, see resume_stage()
+
+        :param no_cache: build without Docker layer cache
+        :param on_line: receives build output lines, see build()
+        :param restart: restart the container of an unchanged app
         """
-        self.repo.pull(self.dir_path)
+        stage = self.resume_stage()
+        if not no_cache and stage == 'run':
+            log.info(f'{self.name} is up to date with {self.commit[:7]}, build skipped')
+            if on_line: on_line(f'Up to date with {self.commit[:7]}, build skipped')
+            pc_port = self._start_unchanged(restart)
+            if pc_port: return pc_port
+        if stage == 'pull': self.pull()
+        elif on_line: on_line(f'Sources are at {self._pulled.commit[:7]} already, pull skipped')
         self._set_pcport()
-        self.build()
+        self.build(no_cache=no_cache, on_line=on_line, cancel=cancel)
         self.run()
         return self.pc_port
 
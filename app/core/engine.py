@@ -0,0 +1,475 @@
+import os, re, json, queue, socket, threading, http.client
+import logging as log
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Iterator, TypedDict
+from urllib.parse import urlencode, urlsplit, quote
+from .utils import Executer, ExecuterError, ApiResponseError
+from .context import BuildContext
+
+
+class BuildMetrics(TypedDict):
+    duration: float         # seconds
+    steps: int              # build steps (layers)
+    cached: int             # steps taken from the layer cache
+    context_files: int      # files sent to the builder
+    context_size: int       # bytes of build context tar
+
+
+class BuildLog:
+    """
+    Counts steps and cache hits in classic builder (`Step 2/5 :` / `---> Using cache`)
+    or BuildKit plain progress (`#6 [2/5] RUN ...` / `#6 CACHED`) output, fed line by line
+    while the build runs, so the output itself is never kept.
+    """
+
+    CLASSIC_STEP = re.compile(r'^Step \d+/\d+ :')
+    BUILDKIT_STEP = re.compile(r'^#(\d+) \[[^\]]*\d+/\d+\]')
+    BUILDKIT_CACHED = re.compile(r'^#(\d+) CACHED')
+
+    def __init__(self):
+        self.classic_steps = 0
+        self.classic_cached = 0
+        self.steps: set[str] = set()
+        self.cached: set[str] = set()
+
+    def feed(self, line: str):
+        if self.CLASSIC_STEP.match(line): self.classic_steps += 1
+        elif '---> Using cache' in line: self.classic_cached += 1
+        elif match := self.BUILDKIT_STEP.match(line): self.steps.add(match[1])
+        elif match := self.BUILDKIT_CACHED.match(line): self.cached.add(match[1])
+
+    def metrics(self) -> BuildMetrics:
+        """
+        Duration and context fields are left 0, they are filled by the caller
+        """
+        metrics: BuildMetrics = { 'duration': 0.0, 'steps': 0, 'cached': 0, 'context_files': 0, 'context_size': 0 }
+        if self.classic_steps: metrics.update(steps=self.classic_steps, cached=self.classic_cached)
+        else: metrics.update(steps=len(self.steps), cached=len(self.cached & self.steps))
+        return metrics
+
+
+class ResourceProfile(TypedDict, total=False):
+    cpus: float             # CPU quota of the container, 1.5 = one and a half cores
+    memory: int             # memory cap of the container, MiB
+    cpuset: str             # cores the container may use, "0-3" / "0,2"
+    build_cpus: float       # same limits for build steps, so a build can't starve running apps
+    build_memory: int
+    build_cpuset: str
+
+
+CPU_PERIOD = 100_000        # microseconds, docker's default CFS period
+
+
+def validate_resources(data: dict) -> ResourceProfile:
+    """
+    Checks and normalizes a resource profile, empty values are dropped. Raises ValueError
+    """
+    profile: ResourceProfile = {}
+    for key, value in (data or {}).items():
+        if value in (None, ''): continue
+        if key not in ResourceProfile.__annotations__: raise ValueError(f"Unknown resource limit ({key})")
+        try:
+            if key in ('cpus', 'build_cpus'): value = float(value)
+            elif key in ('memory', 'build_memory'): value = int(value)
+            else: value = str(value).replace(' ', '')
+        except ValueError:
+            raise ValueError(f"Invalid value of {key} ({value})")
+        if key in ('cpus', 'build_cpus', 'memory', 'build_memory') and value <= 0:
+            raise ValueError(f"{key} must be positive")
+        if key in ('memory', 'build_memory') and value < 6:
+            raise ValueError(f"{key} must be at least 6 MiB")
+        if key in ('cpuset', 'build_cpuset') and not re.fullmatch(r'\d+(-\d+)?(,\d+(-\d+)?)*', value):
+            raise ValueError(f"Invalid cpuset ({value}), expected e.g. 0-3 or 0,2")
+        profile[key] = value
+    return profile
+
+
+class ContainerBackend(ABC):
+    """
+    What DockerApp needs from Docker. Errors are raised as ExecuterError (CLI)
+    or ApiResponseError (Engine API), see BACKEND_ERRORS.\n
+    At most BUILD_SLOTS builds run on the host at the same time (env SPCS_BUILD_SLOTS), see build_slot().
+    """
+
+    BUILD_SLOTS = 2
+
+    _build_slots = None
+    _build_slots_lock = threading.Lock()
+
+    @classmethod
+    @contextmanager
+    def build_slot(cls, cancel: threading.Event = None):
+        """
+        Waits for a free build slot, shared by all backends. Raises ValueError when cancel is set while waiting
+        """
+        with cls._build_slots_lock:
+            if ContainerBackend._build_slots is None:
+                slots = int(os.environ.get('SPCS_BUILD_SLOTS', cls.BUILD_SLOTS))
+                ContainerBackend._build_slots = threading.BoundedSemaphore(max(slots, 1))
+            build_slots = ContainerBackend._build_slots
+        while not build_slots.acquire(timeout=0.5):
+            if cancel and cancel.is_set(): raise ValueError('Build cancelled while waiting for a build slot')
+        try: yield
+        finally: build_slots.release()
+
+    @abstractmethod
+    def build(self, tags: list[str], context: BuildContext, no_cache: bool = False,
+              on_line: Callable[[str], None] = None, cancel: threading.Event = None,
+              resources: ResourceProfile = None) -> BuildMetrics:
+        """
+        Builds the image keeping the layer cache unless no_cache is set.
+        The context is streamed as a tar, so only files passing .dockerignore reach the builder.
+
+        :param on_line: called with every output line of the builder while it runs
+        :param cancel: the build is aborted once this event is set
+        :param resources: build_* limits of the profile are applied to build steps, the builder has to honor them
+                          (BuildKit does not, the CLI backend then uses the classic builder)
+        :return: steps and cache hits, see BuildLog
+        """
+
+    @abstractmethod
+    def run(self, name: str, image: str, ports: dict[int, int], resources: ResourceProfile = None) -> str:
+        """
+        Creates and starts a detached container. Returns container id
+
+        :param ports: host port -> container port
+        :param resources: cpus, memory and cpuset limits of the container
+        """
+
+    @abstractmethod
+    def update(self, name: str, resources: ResourceProfile) -> None:
+        """
+        Applies cpus, memory and cpuset limits to a running container
+        """
+
+    @abstractmethod
+    def stop(self, name: str) -> None: ...
+
+    @abstractmethod
+    def restart(self, name: str) -> None: ...
+
+    @abstractmethod
+    def is_running(self, name: str) -> bool:
+        """
+        False also when the container does not exist
+        """
+
+    @abstractmethod
+    def remove_container(self, name: str) -> None: ...
+
+    @abstractmethod
+    def remove_image(self, image: str, force: bool = True) -> None:
+        """
+        Without force only removes the tag while the image is still used
+        """
+
+    @abstractmethod
+    def list_tags(self, repository: str) -> list[str]:
+        """
+        Tags of local images named repository
+        """
+
+    @staticmethod
+    def from_env() -> "ContainerBackend":
+        """
+        Engine API only when enabled with SPCS_DOCKER_ENGINE=1 and DOCKER_HOST is a plain unix:// or tcp:// host,
+        docker CLI otherwise (through WSL on Windows), which also handles npipe://, ssh:// and TLS hosts
+        """
+        docker_host = os.environ.get('DOCKER_HOST', 'unix:///var/run/docker.sock')
+        scheme = urlsplit(docker_host).scheme
+        tls = scheme == 'tcp' and os.environ.get('DOCKER_TLS_VERIFY')
+        if os.environ.get('SPCS_DOCKER_ENGINE') == '1' and scheme in ('unix', 'tcp') and not tls:
+            return EngineBackend(docker_host)
+        return CliBackend(wsl=os.name == 'nt')
+
+
+class CliBackend(ContainerBackend):
+    """
+    Shells out to `docker` (`wsl docker` on Windows) through Executer
+    """
+
+    BUILD_TIMEOUT = 60 * 60
+
+    def __init__(self, wsl: bool = True, build_timeout: float = BUILD_TIMEOUT):
+        self.wsl = wsl
+        self.docker = 'wsl docker' if wsl else 'docker'
+        self.build_timeout = build_timeout
+
+    @staticmethod
+    def to_wsl_path(win_path: str) -> str:
+        drive, path = win_path.split(":", 1)
+        return f"/mnt/{drive.lower()}{path.replace('\\', '/')}"
+
+    def _run(self, args: str):
+        res = Executer.run_cmd(f'{self.docker} {args}')
+        if res.returncode != 0: raise ExecuterError(res)
+        return res
+
+    @staticmethod
+    def _limit_args(resources: ResourceProfile, prefix: str = '') -> str:
+        resources = resources or {}
+        args = []
+        if resources.get(f'{prefix}cpus'):
+            # docker build has no --cpus, the quota form works for both commands
+            args.append(f'--cpu-period {CPU_PERIOD} --cpu-quota {int(resources[f"{prefix}cpus"] * CPU_PERIOD)}')
+        if resources.get(f'{prefix}memory'):
+            # no swap on top of the cap, same as the Engine backend
+            args.append(f'--memory {resources[f"{prefix}memory"]}m --memory-swap {resources[f"{prefix}memory"]}m')
+        if resources.get(f'{prefix}cpuset'):
+            args.append(f'--cpuset-cpus {resources[f"{prefix}cpuset"]}')
+        return ' '.join(args)
+
+    def build(self, tags: list[str], context: BuildContext, no_cache: bool = False,
+              on_line: Callable[[str], None] = None, cancel: threading.Event = None,
+              resources: ResourceProfile = None) -> BuildMetrics:
+        tag_args = ' '.join(f'-t {tag}' for tag in tags)
+        limit_args = self._limit_args(resources, 'build_')
+        # BuildKit ignores --cpu-quota, --memory and --cpuset-cpus, limited builds use the classic builder.
+        # WSLENV passes the variable on to docker inside WSL
+        env = None
+        if limit_args:
+            env = { 'DOCKER_BUILDKIT': '0', 'WSLENV': ':'.join(filter(None, (os.environ.get('WSLENV'), 'DOCKER_BUILDKIT'))) }
+        # "-" reads the context tar from stdin, -f is then a path inside that tar
+        command = (
+            f'{self.docker} build {tag_args}{"" if limit_args else " --progress=plain"} -f {context.dockerfile} -'
+            + (' --no-cache' if no_cache else '')
+            + (f' {limit_args}' if limit_args else '')
+        )
+        process = Executer.stream(command, feed=context.write_tar, timeout=self.build_timeout, cancel=cancel, env=env)
+        build_log = BuildLog()
+        # BuildKit writes progress to stderr
+        for _, line in process:
+            build_log.feed(line)
+            if on_line: on_line(line)
+        res = process.result()
+        if res.returncode != 0: raise ExecuterError(res)
+        return build_log.metrics()
+
+    def run(self, name: str, image: str, ports: dict[int, int], resources: ResourceProfile = None) -> str:
+        publish = ' '.join(f'-p {host_port}:{port}' for host_port, port in ports.items())
+        limit_args = self._limit_args(resources)
+        return self._run(f'run --name {name} -d {publish} {limit_args + " " if limit_args else ""}{image}').stdout.strip()
+
+    def update(self, name: str, resources: ResourceProfile) -> None:
+        limit_args = self._limit_args(resources)
+        if limit_args: self._run(f'update {limit_args} {name}')
+
+    def stop(self, name: str) -> None:
+        self._run(f'stop {name}')
+
+    def restart(self, name: str) -> None:
+        self._run(f'restart {name}')
+
+    def is_running(self, name: str) -> bool:
+        res = Executer.run_cmd(f'{self.docker} inspect -f "{{{{.State.Running}}}}" {name}')
+        return res.returncode == 0 and res.stdout.strip() == 'true'
+
+    def remove_container(self, name: str) -> None:
+        self._run(f'rm {name}')
+
+    def remove_image(self, image: str, force: bool = True) -> None:
+        self._run(f'rmi {"--force " if force else ""}{image}')
+
+    def list_tags(self, repository: str) -> list[str]:
+        res = self._run(f'images {repository} --format "{{{{.Tag}}}}"')
+        return [tag for tag in res.stdout.split() if tag != '<none>']
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout: self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class EngineClient:
+    """
+    Minimal HTTP client for the Docker Engine API with a pool of keep-alive connections.\n
+    `docker_host`: `unix:///var/run/docker.sock`, `tcp://host:2375` or `http://host:2375`
+    """
+
+    API_VERSION = 'v1.41'
+    POOL_SIZE = 4
+    TIMEOUT = 60
+
+    def __init__(self, docker_host: str = 'unix:///var/run/docker.sock', pool_size: int = POOL_SIZE, timeout: float = TIMEOUT):
+        self.docker_host = docker_host
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self) -> http.client.HTTPConnection:
+        url = urlsplit(self.docker_host)
+        if url.scheme == 'unix':
+            return UnixHTTPConnection(url.path, timeout=self.timeout)
+        if url.scheme in ('tcp', 'http'):
+            return http.client.HTTPConnection(url.hostname, url.port or 2375, timeout=self.timeout)
+        raise ValueError(f"Unsupported DOCKER_HOST ({self.docker_host})")
+
+    def _acquire(self) -> tuple[http.client.HTTPConnection, bool]:
+        """
+        Returns (connection, is reused from pool)
+        """
+        try: return self._pool.get_nowait(), True
+        except queue.Empty: return self._connect(), False
+
+    def _release(self, conn: http.client.HTTPConnection):
+        try: self._pool.put_nowait(conn)
+        except queue.Full: conn.close()
+
+    def request(self, method: str, path: str, params: dict = None, body=None, headers: dict = None) -> tuple[int, bytes]:
+        """
+        Returns (status, body). Body may be bytes, dict (sent as json) or a binary file object
+        """
+        url = f'/{self.API_VERSION}{path}' + (f'?{urlencode(params, doseq=True)}' if params else '')
+        headers = dict(headers or {})
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+
+        conn, reused = self._acquire()
+        try:
+            conn.request(method, url, body=body, headers=headers)
+            res = conn.getresponse()
+            data = res.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            replayable = body is None or isinstance(body, bytes) or (hasattr(body, 'seekable') and body.seekable())
+            if not reused or not replayable: raise
+            # pooled connection may have been closed by the engine, retry once on a fresh one
+            if hasattr(body, 'seek'): body.seek(0)
+            conn = self._connect()
+            conn.request(method, url, body=body, headers=headers)
+            res = conn.getresponse()
+            data = res.read()
+
+        if res.will_close: conn.close()
+        else: self._release(conn)
+        log.debug(f'Docker engine: {method} {url} -> {res.status}')
+        return res.status, data
+
+    @staticmethod
+    def _raise(method: str, path: str, status: int, data: bytes):
+        try: message = json.loads(data).get('message', data.decode())
+        except ValueError: message = data.decode(errors='replace')
+        raise ApiResponseError(None, message=message, requestUrl=f'{method} {path}', status_code=status)
+
+    def check(self, method: str, path: str, ok: tuple = (200, 201, 204), **kwargs) -> bytes:
+        status, data = self.request(method, path, **kwargs)
+        if status not in ok: self._raise(method, path, status, data)
+        return data
+
+    def stream(self, method: str, path: str, params: dict = None, body=None, headers: dict = None) -> Iterator[dict]:
+        """
+        Yields json messages of a streamed answer (build, pull) as they arrive.\n
+        Uses its own connection without read timeout, a build step may be silent for long.
+        Closing the generator drops the connection, which makes the engine abort the operation.
+        """
+        url = f'/{self.API_VERSION}{path}' + (f'?{urlencode(params, doseq=True)}' if params else '')
+        conn = self._connect()
+        conn.timeout = None
+        try:
+            conn.request(method, url, body=body, headers=headers or {})
+            res = conn.getresponse()
+            if res.status != 200: self._raise(method, path, res.status, res.read())
+            while line := res.readline():
+                if line.strip(): yield json.loads(line)
+        finally:
+            conn.close()
+
+
+class EngineBackend(ContainerBackend):
+    """
+    Talks to the Docker Engine HTTP API directly, no process per command
+    """
+
+    def __init__(self, docker_host: str = 'unix:///var/run/docker.sock', client: EngineClient = None):
+        self.client = client or EngineClient(docker_host)
+
+    @staticmethod
+    def _host_limits(resources: ResourceProfile) -> dict:
+        resources = resources or {}
+        limits = {}
+        if resources.get('cpus'): limits['NanoCpus'] = int(resources['cpus'] * 1e9)
+        if resources.get('memory'): limits['Memory'] = limits['MemorySwap'] = resources['memory'] * 1024 ** 2
+        if resources.get('cpuset'): limits['CpusetCpus'] = resources['cpuset']
+        return limits
+
+    def build(self, tags: list[str], context: BuildContext, no_cache: bool = False,
+              on_line: Callable[[str], None] = None, cancel: threading.Event = None,
+              resources: ResourceProfile = None) -> BuildMetrics:
+        params = { 't': tags, 'dockerfile': context.dockerfile, 'rm': 1 }
+        if no_cache: params['nocache'] = 1
+        resources = resources or {}
+        if resources.get('build_cpus'):
+            params.update(cpuperiod=CPU_PERIOD, cpuquota=int(resources['build_cpus'] * CPU_PERIOD))
+        if resources.get('build_memory'): params['memory'] = resources['build_memory'] * 1024 ** 2
+        if resources.get('build_cpuset'): params['cpusetcpus'] = resources['build_cpuset']
+        build_log = BuildLog()
+        # tar is produced while it is being sent (chunked transfer), never held in memory or on disk
+        reader, writer = context.pipe()
+        with reader:
+            messages = self.client.stream('POST', '/build', params=params, body=reader,
+                                          headers={ 'Content-Type': 'application/x-tar' })
+            # build answer is a stream of json lines, an error is reported inside the stream with status 200
+            for message in messages:
+                if 'error' in message:
+                    raise ApiResponseError(None, message=message['error'], requestUrl='POST /build', status_code=200)
+                for line in message.get('stream', '').splitlines():
+                    build_log.feed(line)
+                    if on_line: on_line(line)
+                if cancel and cancel.is_set():
+                    messages.close()
+                    raise ApiResponseError(None, message='Build cancelled', requestUrl='POST /build', status_code=200)
+        writer.join()
+        return build_log.metrics()
+
+    def run(self, name: str, image: str, ports: dict[int, int], resources: ResourceProfile = None) -> str:
+        config = {
+            'Image': image,
+            'ExposedPorts': { f'{port}/tcp': {} for port in ports.values() },
+            'HostConfig': {
+                'PortBindings': { f'{port}/tcp': [{ 'HostPort': str(host_port) }] for host_port, port in ports.items() },
+                **self._host_limits(resources),
+            },
+        }
+        data = self.client.check('POST', '/containers/create', params={ 'name': name }, body=config)
+        container_id = json.loads(data)['Id']
+        self.client.check('POST', f'/containers/{container_id}/start', ok=(204, 304))
+        return container_id
+
+    def stop(self, name: str) -> None:
+        self.client.check('POST', f'/containers/{quote(name)}/stop', ok=(204, 304))
+
+    def restart(self, name: str) -> None:
+        self.client.check('POST', f'/containers/{quote(name)}/restart')
+
+    def update(self, name: str, resources: ResourceProfile) -> None:
+        limits = self._host_limits(resources)
+        if limits: self.client.check('POST', f'/containers/{quote(name)}/update', body=limits)
+
+    def is_running(self, name: str) -> bool:
+        status, data = self.client.request('GET', f'/containers/{quote(name)}/json')
+        if status == 404: return False
+        if status != 200: self.client._raise('GET', f'/containers/{name}/json', status, data)
+        return bool(json.loads(data).get('State', {}).get('Running'))
+
+    def remove_container(self, name: str) -> None:
+        self.client.check('DELETE', f'/containers/{quote(name)}')
+
+    def remove_image(self, image: str, force: bool = True) -> None:
+        self.client.check('DELETE', f'/images/{quote(image)}', params={ 'force': 1 } if force else None)
+
+    def list_tags(self, repository: str) -> list[str]:
+        data = self.client.check('GET', '/images/json', params={ 'filters': json.dumps({ 'reference': [repository] }) })
+        return [
+            repo_tag.split(':', 1)[1] for image in json.loads(data) for repo_tag in image.get('RepoTags') or []
+            if repo_tag.startswith(f'{repository}:')
+        ]
+
+
+BACKEND_ERRORS = (ExecuterError, ApiResponseError)
@@ -0,0 +1,155 @@
+import os, time, hashlib, threading, requests
+import logging as log
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import TypedDict, Callable
+from .net import HttpClient
+
+
+class DownloadTask(TypedDict):
+    url: str
+    path: str               # destination file path
+
+
+class DownloadStats:
+    """
+    Thread-safe progress counters shared by Downloader workers
+    """
+    def __init__(self, total_files: int = 0):
+        self.total_files = total_files
+        self.files = 0
+        self.bytes = 0
+        self.failed: list[DownloadTask] = []
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_bytes(self, count: int):
+        with self._lock: self.bytes += count
+
+    def add_file(self):
+        with self._lock: self.files += 1
+
+    def add_failed(self, task: DownloadTask):
+        with self._lock: self.failed.append(task)
+
+    @property
+    def elapsed(self) -> float:
+        return max(time.monotonic() - self.started, 1e-6)
+
+    @property
+    def bytes_per_sec(self) -> float:
+        return self.bytes / self.elapsed
+
+    @property
+    def files_per_sec(self) -> float:
+        return self.files / self.elapsed
+
+    def __str__(self):
+        return (
+            f"{self.files}/{self.total_files} files, {self.bytes / 1024:.1f} KiB in {self.elapsed:.2f}s "
+            f"({self.bytes_per_sec / 1024:.1f} KiB/s, {self.files_per_sec:.1f} files/s)"
+        )
+
+
+class Downloader:
+    """
+    Downloads files with a thread pool, writing each body to disk in chunks.\n
+    Partial files are kept as `<path>.part` (in `part_dir` when set) together with the ETag / Last-Modified
+    of their answer, and resumed on the next run with Range + If-Range: a file changed in the meantime is sent whole.
+    """
+
+    WORKERS = 8
+    CHUNK_SIZE = 64 * 1024
+    PART_SUFFIX = '.part'
+    VALIDATOR_SUFFIX = '.validator'
+
+    def __init__(self, headers: dict = None, workers: int = WORKERS, chunk_size: int = CHUNK_SIZE,
+                 report_interval: float = 2.0, on_progress: Callable[[DownloadStats], None] = None,
+                 part_dir: str = None):
+        """
+        :param part_dir: where partial files are kept instead of next to their destination,
+                         must be on the same filesystem
+        """
+        if workers < 1: raise ValueError("Downloader needs at least one worker")
+        self.headers = headers or {}
+        self.part_dir = part_dir
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.report_interval = report_interval
+        self.on_progress = on_progress
+
+    def _report(self, stats: DownloadStats):
+        log.info(f'Download progress: {stats}')
+        if self.on_progress: self.on_progress(stats)
+
+    def _part_path(self, path: str) -> str:
+        if not self.part_dir: return path + self.PART_SUFFIX
+        return os.path.join(self.part_dir, hashlib.sha1(os.path.abspath(path).encode()).hexdigest() + self.PART_SUFFIX)
+
+    @staticmethod
+    def _validator(res: requests.Response) -> str | None:
+        """
+        Strong ETag or Last-Modified of the answer, what If-Range accepts
+        """
+        etag = res.headers.get('ETag')
+        if etag and not etag.startswith('W/'): return etag
+        return res.headers.get('Last-Modified')
+
+    def download(self, task: DownloadTask, stats: DownloadStats) -> None:
+        path = task['path']
+        part_path = self._part_path(path)
+        validator_path = part_path + self.VALIDATOR_SUFFIX
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+
+        headers = dict(self.headers)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        validator = None
+        if offset and os.path.exists(validator_path):
+            with open(validator_path, 'r', encoding='utf-8') as f: validator = f.read()
+        # without a validator the .part file can't be told apart from an older version, it is downloaded again
+        if validator: headers.update({ 'Range': f'bytes={offset}-', 'If-Range': validator })
+
+        with HttpClient.shared().get(task['url'], headers=headers, stream=True) as res:
+            if res.status_code == 416:
+                # stale .part file (already complete or longer than the remote file) - start over
+                for stale in (part_path, validator_path):
+                    if os.path.exists(stale): os.remove(stale)
+                return self.download(task, stats)
+            if res.status_code not in (200, 206):
+                raise requests.HTTPError(f'HTTP {res.status_code}', response=res)
+
+            # a changed file or a server ignoring Range sends the whole body
+            mode = 'ab' if res.status_code == 206 else 'wb'
+            if mode == 'wb':
+                validator = self._validator(res)
+                if validator:
+                    with open(validator_path, 'w', encoding='utf-8') as f: f.write(validator)
+                elif os.path.exists(validator_path): os.remove(validator_path)
+            with open(part_path, mode) as f:
+                for chunk in res.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    stats.add_bytes(len(chunk))
+
+        os.replace(part_path, path)
+        if os.path.exists(validator_path): os.remove(validator_path)
+        stats.add_file()
+
+    def _safe_download(self, task: DownloadTask, stats: DownloadStats):
+        try:
+            self.download(task, stats)
+        except (requests.RequestException, OSError) as e:
+            log.error(f"Failed to download {task['url']}: {e}")
+            stats.add_failed(task)
+
+    def download_all(self, tasks: list[DownloadTask]) -> DownloadStats:
+        stats = DownloadStats(total_files=len(tasks))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {pool.submit(self._safe_download, task, stats) for task in tasks}
+            last_report = time.monotonic()
+            while pending:
+                _, pending = wait(pending, timeout=self.report_interval, return_when=FIRST_COMPLETED)
+                if pending and time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    self._report(stats)
+        self._report(stats)
+        return stats
@@ -0,0 +1,182 @@
+import os, json, time, uuid, queue, threading
+import logging as log
+from collections import deque
+from typing import Callable, TypedDict
+from .utils import AppDir
+
+
+class Job(TypedDict):
+    id: str
+    kind: str               # handler name, e.g. 'launch'
+    app: str                # shown name, e.g. 'demo' or 'deploy:a,b'
+    apps: list[str]         # apps the job works on, two active jobs never share one
+    params: dict            # handler arguments, dropped once the job is finished
+    status: str             # queued | running | done | failed | cancelled
+    created: float
+    started: float | None
+    finished: float | None
+    result: object
+    error: str | None
+
+
+class JobQueue:
+    """
+    Persistent queue of long operations (launches) run by a pool of worker threads.\n
+    `submit` returns at once with a job id, at most `workers` jobs run at the same time.
+    A job submitted while another one of the same kind and apps is queued or running is not added,
+    the id of the existing job is returned. A job sharing only some apps with an active one is refused.\n
+    Jobs are kept in `db/jobs.json`: queued and interrupted (running) jobs are queued again on start.
+    """
+
+    WORKERS = 2
+    KEEP_FINISHED = 100
+    LOG_LINES = 200
+    ACTIVE = ('queued', 'running')
+    FINISHED = ('done', 'failed', 'cancelled')
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, path: str = None, workers: int = WORKERS):
+        self.path = path or AppDir.JOBS_FILE
+        self.workers = workers
+        self.handlers: dict[str, Callable] = {}
+        self.jobs: dict[str, Job] = {}
+        self.logs: dict[str, deque] = {}
+        self._cancel: dict[str, threading.Event] = {}
+        self._queue = queue.Queue()
+        self._lock = threading.RLock()
+        self._threads: list[threading.Thread] = []
+        self._load()
+
+    @classmethod
+    def shared(cls) -> "JobQueue":
+        if not cls._instance:
+            with cls._instance_lock:
+                if not cls._instance: cls._instance = cls(workers=int(os.environ.get('SPCS_JOB_WORKERS', cls.WORKERS)))
+        return cls._instance
+
+    def register(self, kind: str, handler: Callable[[dict, Callable[[str], None], threading.Event], object]):
+        """
+        :param handler: handler(params, on_line, cancel) -> json serializable result
+        """
+        self.handlers[kind] = handler
+
+    def start(self):
+        """
+        Starts the workers and queues jobs left from the previous run. Handlers must be registered before
+        """
+        with self._lock:
+            if self._threads: return
+            for job in sorted(self.jobs.values(), key=lambda job: job['created']):
+                if job['status'] not in self.ACTIVE: continue
+                if job['status'] == 'running': log.warning(f"Job {job['id']} ({job['app']}) was interrupted, queued again")
+                job.update(status='queued', started=None)
+                self._queue.put(job['id'])
+            self._save()
+            self._threads = [
+                threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True) for i in range(self.workers)
+            ]
+            for thread in self._threads: thread.start()
+
+    def submit(self, kind: str, app: str, params: dict, apps: list[str] = None) -> str:
+        """
+        Queues a job, returns its id (or the id of the active job doing the same).
+        Raises ValueError when one of the apps is busy with another job
+
+        :param apps: apps the job works on, [app] if not set
+        """
+        if kind not in self.handlers: raise ValueError(f"Unknown job kind ({kind})")
+        apps = sorted(set(apps or [app]))
+        with self._lock:
+            for job in self.jobs.values():
+                if job['status'] not in self.ACTIVE: continue
+                job_apps = job.get('apps') or [job['app']]
+                if job['kind'] == kind and job_apps == apps:
+                    log.info(f"Job for {app} is already {job['status']} ({job['id']})")
+                    return job['id']
+                busy = set(job_apps) & set(apps)
+                if busy: raise ValueError(f"{', '.join(sorted(busy))} busy with job {job['id']} ({job['kind']} {job['app']})")
+            job: Job = {
+                'id': uuid.uuid4().hex, 'kind': kind, 'app': app, 'apps': apps, 'params': params, 'status': 'queued',
+                'created': time.time(), 'started': None, 'finished': None, 'result': None, 'error': None,
+            }
+            self.jobs[job['id']] = job
+            self._save()
+        self._queue.put(job['id'])
+        return job['id']
+
+    def get(self, job_id: str) -> dict:
+        """
+        Job without params, with the last output lines
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if not job: raise ValueError(f"Job ({job_id}) not found")
+            info = { key: value for key, value in job.items() if key != 'params' }
+            info['log'] = list(self.logs.get(job_id, ()))
+            return info
+
+    def list(self) -> list[dict]:
+        with self._lock:
+            return [self.get(job_id) for job_id in self.jobs]
+
+    def cancel(self, job_id: str) -> dict:
+        """
+        A queued job is dropped, a running one is asked to stop (its handler gets the cancel event)
+        """
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if not job: raise ValueError(f"Job ({job_id}) not found")
+            if job['status'] == 'queued':
+                self._finish(job, 'cancelled')
+            elif job['status'] == 'running':
+                self._cancel[job_id].set()
+            return self.get(job_id)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self.jobs.get(job_id)
+                if not job or job['status'] != 'queued': continue
+                job.update(status='running', started=time.time())
+                cancel = self._cancel[job_id] = threading.Event()
+                lines = self.logs[job_id] = deque(maxlen=self.LOG_LINES)
+                self._save()
+
+            log.info(f"Job {job_id} started: {job['kind']} {job['app']}")
+            try:
+                result = self.handlers[job['kind']](job['params'], lines.append, cancel)
+            except Exception as e:
+                log.error(f'Job {job_id} failed: {e}', exc_info=True)
+                with self._lock: self._finish(job, 'cancelled' if cancel.is_set() else 'failed', error=str(e))
+            else:
+                with self._lock: self._finish(job, 'done', result=result)
+            log.info(f"Job {job_id} {job['status']} in {job['finished'] - job['started']:.1f}s")
+
+    def _finish(self, job: Job, status: str, result=None, error: str = None):
+        # params may hold access tokens, they are not needed after the job
+        job.update(status=status, finished=time.time(), result=result, error=error, params={})
+        self._cancel.pop(job['id'], None)
+        finished = [other for other in self.jobs.values() if other['status'] in self.FINISHED]
+        for old_job in sorted(finished, key=lambda other: other['finished'])[:-self.KEEP_FINISHED]:
+            del self.jobs[old_job['id']]
+            self.logs.pop(old_job['id'], None)
+        self._save()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.jobs = { job['id']: job for job in json.load(f) }
+        except FileNotFoundError:
+            self.jobs = {}
+        except (json.JSONDecodeError, KeyError, TypeError):
+            log.error(f'Jobs file ({self.path}) is broken, starting with an empty queue')
+            self.jobs = {}
+
+    def _save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(list(self.jobs.values()), f, indent=4, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,321 @@
+import os, re, json, time, random, hashlib, threading, requests
+import logging as log
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import TypedDict
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from .utils import AppDir
+
+
+class LatencyStats:
+    """
+    Latency of one endpoint, keeps last SAMPLES durations for percentiles
+    """
+
+    SAMPLES = 256
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=self.SAMPLES)
+
+    def add(self, duration: float, error: bool = False):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.samples.append(duration)
+        if error: self.errors += 1
+
+    def percentile(self, p: float) -> float:
+        if not self.samples: return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'retries': self.retries,
+            'avg': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'max': self.max,
+        }
+
+
+class HttpClient:
+    """
+    Shared HTTP transport for Cloudflare and GitHub calls.\n
+    One requests.Session with keep-alive connection pools per host, default timeouts,
+    retries with exponential backoff and jitter on 429/5xx (Retry-After is honoured)
+    and per-endpoint latency stats.
+    """
+
+    TIMEOUT = (5, 30)                       # (connect, read) seconds
+    RETRIES = 3
+    BACKOFF = 0.5                           # first retry delay, doubled every attempt
+    BACKOFF_MAX = 30.0
+    RETRY_AFTER_MAX = 120.0
+    POOL_SIZE = 16                          # connections kept alive per host
+    RETRY_STATUSES = { 429, 500, 502, 503, 504 }
+    IDEMPOTENT_METHODS = { 'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS' }
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, timeout: float | tuple = TIMEOUT, retries: int = RETRIES,
+                 backoff: float = BACKOFF, pool_size: int = POOL_SIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.stats: dict[str, LatencyStats] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls) -> "HttpClient":
+        if not cls._instance:
+            with cls._instance_lock:
+                if not cls._instance: cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def endpoint(method: str, url: str) -> str:
+        """
+        Stats key: ids (numbers, hex hashes, uuids) in the path are replaced with {id}
+        """
+        parts = urlsplit(url)
+        path = re.sub(r'/(\d+|[0-9a-fA-F-]{16,})(?=/|$)', '/{id}', parts.path)
+        return f'{method.upper()} {parts.netloc}{path}'
+
+    def _record(self, endpoint: str, duration: float, error: bool = False, retry: bool = False):
+        with self._lock:
+            stats = self.stats.setdefault(endpoint, LatencyStats())
+            stats.add(duration, error)
+            if retry: stats.retries += 1
+
+    def latency_stats(self) -> dict[str, dict]:
+        with self._lock:
+            return { endpoint: stats.to_dict() for endpoint, stats in self.stats.items() }
+
+    def _delay(self, attempt: int, res: requests.Response = None) -> float:
+        retry_after = res.headers.get('Retry-After') if res is not None else None
+        if retry_after:
+            try: delay = float(retry_after)
+            except ValueError:
+                try: delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError): delay = None
+            if delay is not None: return min(max(delay, 0), self.RETRY_AFTER_MAX)
+        # full jitter
+        return random.uniform(0, min(self.BACKOFF_MAX, self.backoff * 2 ** attempt))
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        method = method.upper()
+        kwargs.setdefault('timeout', self.timeout)
+        endpoint = self.endpoint(method, url)
+        idempotent = method in self.IDEMPOTENT_METHODS
+
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            started = time.monotonic()
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                retry = idempotent and not last_attempt
+                self._record(endpoint, time.monotonic() - started, error=True, retry=retry)
+                if not retry: raise
+                delay = self._delay(attempt)
+                log.warning(f'{endpoint} failed ({e}), retry in {delay:.1f}s')
+            else:
+                # 429 is never processed by the server, other statuses are retried only when repeating is safe
+                retry = not last_attempt and res.status_code in self.RETRY_STATUSES and (idempotent or res.status_code == 429)
+                self._record(endpoint, time.monotonic() - started, error=res.status_code >= 500, retry=retry)
+                if not retry: return res
+                delay = self._delay(attempt, res)
+                log.warning(f'{endpoint} answered {res.status_code}, retry in {delay:.1f}s')
+                res.close()
+            time.sleep(delay)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+
+class RateLimit(TypedDict):
+    limit: int
+    remaining: int
+    reset: int              # unix time when the limit window resets
+
+
+class HttpCache:
+    """
+    Persistent conditional-request cache for GET calls (GitHub metadata).\n
+    Stores ETag / Last-Modified per URL and credentials, revalidates with
+    If-None-Match / If-Modified-Since and serves the body from disk on 304
+    (304 answers don't count against GitHub rate limit).\n
+    Also keeps the last seen X-RateLimit-* values per credentials.\n
+    Bodies over MAX_BODY bytes are not cached, least recently used entries are evicted
+    once the cache grows over `max_size` bytes.
+    """
+
+    MAX_SIZE = 64 * 1024 ** 2
+    MAX_BODY = 1024 ** 2
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, root: str = None, max_size: int = MAX_SIZE):
+        self.root = root or AppDir.HTTP_CACHE_DIR
+        self.max_size = max_size
+        os.makedirs(self.root, exist_ok=True)
+        self.rate_limits: dict[str, RateLimit] = {}
+        self._lock = threading.Lock()
+        self._size = self.size()
+
+    @classmethod
+    def shared(cls) -> "HttpCache":
+        if not cls._instance:
+            with cls._instance_lock:
+                if not cls._instance: cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def _key(*parts) -> str:
+        return hashlib.sha256('\n'.join(str(part) for part in parts).encode()).hexdigest()
+
+    def _paths(self, url: str, headers: dict) -> tuple[str, str]:
+        key = self._key(url, headers.get('Authorization'), headers.get('Accept'))
+        return os.path.join(self.root, f'{key}.json'), os.path.join(self.root, f'{key}.body')
+
+    def _load(self, url: str, headers: dict) -> dict | None:
+        meta_path, body_path = self._paths(url, headers)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f: meta = json.load(f)
+            with open(body_path, 'rb') as f: meta['body'] = f.read()
+        except (OSError, json.JSONDecodeError):
+            return None
+        # recently used, see evict()
+        try: os.utime(body_path)
+        except OSError: pass
+        return meta
+
+    def _entries(self):
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.endswith('.body'): yield entry
+
+    def size(self) -> int:
+        total = 0
+        for entry in os.scandir(self.root):
+            if entry.is_file(): total += entry.stat().st_size
+        return total
+
+    def evict(self) -> int:
+        """
+        Deletes least recently used entries until the cache fits into max_size. Returns freed bytes
+        """
+        with self._lock:
+            entries = []
+            for entry in self._entries():
+                meta_path = entry.path.removesuffix('.body') + '.json'
+                try: size = entry.stat().st_size + os.path.getsize(meta_path)
+                except OSError: size = entry.stat().st_size
+                entries.append((entry.stat().st_mtime, size, entry.path, meta_path))
+            total = sum(size for _, size, _, _ in entries)
+            freed = 0
+            for _, size, body_path, meta_path in sorted(entries):
+                if total - freed <= self.max_size: break
+                # meta first, an entry without meta is never served
+                for path in (meta_path, body_path):
+                    try: os.remove(path)
+                    except FileNotFoundError: pass
+                freed += size
+            self._size = total - freed
+        if freed: log.info(f'HTTP cache: evicted {freed} bytes, {total - freed} bytes left')
+        return freed
+
+    def _store(self, url: str, headers: dict, res: requests.Response):
+        meta_path, body_path = self._paths(url, headers)
+        meta = {
+            'url': url,
+            'etag': res.headers.get('ETag'),
+            'last_modified': res.headers.get('Last-Modified'),
+            'headers': { 'Content-Type': res.headers.get('Content-Type', '') },
+        }
+        # body first, so meta never points to a missing or half-written body
+        for path, mode, content in ((body_path, 'wb', res.content), (meta_path, 'w', json.dumps(meta))):
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, mode) as f: f.write(content)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._size += len(res.content) + len(json.dumps(meta))
+            over = self._size > self.max_size
+        if over: self.evict()
+
+    def _track_rate_limit(self, headers: dict, res: requests.Response):
+        if 'X-RateLimit-Remaining' not in res.headers: return
+        rate_limit: RateLimit = {
+            'limit': int(res.headers.get('X-RateLimit-Limit', 0)),
+            'remaining': int(res.headers['X-RateLimit-Remaining']),
+            'reset': int(res.headers.get('X-RateLimit-Reset', 0)),
+        }
+        with self._lock:
+            self.rate_limits[self._key(headers.get('Authorization'))] = rate_limit
+
+    def rate_limit(self, headers: dict = None) -> RateLimit | None:
+        """
+        Last known rate limit for the credentials in headers
+        """
+        return self.rate_limits.get(self._key((headers or {}).get('Authorization')))
+
+    def rate_limit_remaining(self, headers: dict = None) -> int | None:
+        rate_limit = self.rate_limit(headers)
+        return rate_limit['remaining'] if rate_limit else None
+
+    def throttle(self, headers: dict = None, min_remaining: int = 100) -> float:
+        """
+        Sleeps when less than min_remaining requests are left, spreading the rest of them
+        evenly until the limit resets. Returns slept seconds
+        """
+        rate_limit = self.rate_limit(headers)
+        if not rate_limit or rate_limit['remaining'] >= min_remaining: return 0
+        delay = max(rate_limit['reset'] - time.time(), 0) / max(rate_limit['remaining'], 1)
+        log.warning(f"GitHub rate limit is low ({rate_limit['remaining']} left), waiting {delay:.1f}s")
+        time.sleep(delay)
+        return delay
+
+    def get(self, url: str, headers: dict = None) -> requests.Response:
+        headers = dict(headers or {})
+        cached = self._load(url, headers)
+        req_headers = dict(headers)
+        if cached:
+            if cached['etag']: req_headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']: req_headers['If-Modified-Since'] = cached['last_modified']
+
+        res = HttpClient.shared().get(url, headers=req_headers)
+        self._track_rate_limit(headers, res)
+
+        if res.status_code == 304 and cached:
+            log.debug(f'HTTP cache hit: {url}')
+            return self._cached_response(url, cached)
+        if (res.status_code == 200 and (res.headers.get('ETag') or res.headers.get('Last-Modified'))
+                and len(res.content) <= self.MAX_BODY):
+            self._store(url, headers, res)
+        return res
+
+    @staticmethod
+    def _cached_response(url: str, cached: dict) -> requests.Response:
+        res = requests.Response()
+        res.status_code = 200
+        res.url = url
+        res.headers = CaseInsensitiveDict(cached['headers'])
+        res.headers['X-From-Cache'] = '1'
+        res.encoding = 'utf-8'
+        res._content = cached['body']
+        return res
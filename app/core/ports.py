@@ -0,0 +1,111 @@
+import os, json, time, random, socket, threading
+import logging as log
+from typing import TypedDict
+from .utils import AppDir
+
+
+class Lease(TypedDict):
+    app: str
+    leased: float           # unix time
+
+
+class PortAllocator:
+    """
+    Hands out localhost ports for app containers.\n
+    A port is free when it can be bound in-process and is not leased to another app.
+    Leases are kept in `db/ports.json` (port -> app), so two launches never get the same port
+    even before their containers are started. Leases of apps without an app directory are reclaimed on load.
+    """
+
+    PORT_RANGE = (1025, 49150)
+    ATTEMPTS = 200
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, path: str = None, port_range: tuple[int, int] = PORT_RANGE, apps_dir: str = None):
+        self.path = path or AppDir.PORTS_FILE
+        self.port_range = port_range
+        self.apps_dir = apps_dir or AppDir.APPS_DIR
+        self.leases: dict[int, Lease] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def shared(cls) -> "PortAllocator":
+        if not cls._instance:
+            # double-checked, concurrent first calls must not create two instances
+            with cls._instance_lock:
+                if not cls._instance: cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def is_free(port: int) -> bool:
+        """
+        Tries to bind the port on all interfaces, like a published container port does
+        """
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            try: sock.bind(('', port))
+            except OSError: return False
+        return True
+
+    def ports(self, app: str) -> list[int]:
+        with self._lock:
+            return sorted(port for port, lease in self.leases.items() if lease['app'] == app)
+
+    def lease(self, app: str, preferred: int = None, keep: bool = True) -> int:
+        """
+        Leases a port to app and returns it.\n
+        With keep the port already leased to app is returned as is (its own container may hold it),
+        otherwise an additional port is leased, e.g. for a blue/green switch.
+
+        :param preferred: tried first, a random port of PORT_RANGE is taken when it is busy
+        """
+        with self._lock:
+            own = sorted(port for port, lease in self.leases.items() if lease['app'] == app)
+            if keep and own: return own[0]
+
+            candidates = [preferred] if preferred else []
+            candidates += random.sample(range(*self.port_range), self.ATTEMPTS)
+            for port in candidates:
+                if port in self.leases or not self.is_free(port): continue
+                self.leases[port] = { 'app': app, 'leased': time.time() }
+                self._save()
+                log.info(f'Port {port} leased to {app}')
+                return port
+        raise ValueError(f"Failed to find a free port for {app}")
+
+    def release(self, app: str, port: int = None):
+        """
+        Releases one port of app, all of them when port is None
+        """
+        with self._lock:
+            released = [
+                leased_port for leased_port, lease in self.leases.items()
+                if lease['app'] == app and port in (None, leased_port)
+            ]
+            for leased_port in released: del self.leases[leased_port]
+            if released:
+                self._save()
+                log.info(f'Ports {released} of {app} released')
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.leases = { int(port): lease for port, lease in json.load(f).items() }
+        except FileNotFoundError:
+            self.leases = {}
+        except (json.JSONDecodeError, ValueError, AttributeError):
+            log.error(f'Port leases file ({self.path}) is broken, starting with no leases')
+            self.leases = {}
+        stale = [port for port, lease in self.leases.items() if not os.path.isdir(os.path.join(self.apps_dir, lease['app']))]
+        for port in stale:
+            log.info(f"Port {port} reclaimed, app {self.leases[port]['app']} no longer exists")
+            del self.leases[port]
+        if stale: self._save()
+
+    def _save(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({ str(port): lease for port, lease in sorted(self.leases.items()) }, f, indent=4)
+        os.replace(tmp_path, self.path)
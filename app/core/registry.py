@@ -0,0 +1,190 @@
+import os, json, time, atexit, sqlite3, threading
+import logging as log
+from .utils import AppDir
+
+
+class AppRegistry:
+    """
+    Apps state in one SQLite database (`db/apps.sqlite3`, WAL mode) instead of a `info.json` per app.\n
+    Name is the primary key, port, pc_port, repo and status are indexed, so lookups don't scan all apps.
+    Every thread gets its own connection. Existing `info.json` files are imported once.\n
+    `update` coalesces writes: the last state of every app changed within DEBOUNCE seconds is written
+    in one transaction. `save` writes at once with a full fsync, it is used at stage boundaries.
+    """
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS apps (
+            name TEXT PRIMARY KEY,
+            port INTEGER,
+            pc_port INTEGER,
+            repo TEXT,
+            status TEXT,
+            data TEXT NOT NULL,
+            updated REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS apps_port ON apps (port)',
+        'CREATE INDEX IF NOT EXISTS apps_pc_port ON apps (pc_port)',
+        'CREATE INDEX IF NOT EXISTS apps_repo ON apps (repo)',
+        'CREATE INDEX IF NOT EXISTS apps_status ON apps (status)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    )
+    COLUMNS = ('port', 'pc_port', 'repo', 'status')
+    UPSERT = (
+        'INSERT INTO apps (name, port, pc_port, repo, status, data, updated) VALUES (?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT (name) DO UPDATE SET port=excluded.port, pc_port=excluded.pc_port, repo=excluded.repo, '
+        'status=excluded.status, data=excluded.data, updated=excluded.updated'
+    )
+    DEBOUNCE = 0.5                  # seconds updates are collected before they are written
+    SECRETS = ('api_headers', 'access_token', 'token')     # never stored, apps are listed over HTTP
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, path: str = None, apps_dir: str = None):
+        self.path = path or AppDir.REGISTRY_DB
+        self.apps_dir = apps_dir or AppDir.APPS_DIR
+        self._local = threading.local()
+        # pending updates and writes share the lock, so a flush never overwrites a newer save
+        self._lock = threading.RLock()
+        self._pending: dict[str, dict] = {}
+        self._timer: threading.Timer | None = None
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            for statement in self.SCHEMA: db.execute(statement)
+        self._migrate()
+        atexit.register(self.flush)
+
+    @classmethod
+    def shared(cls) -> "AppRegistry":
+        if not cls._instance:
+            with cls._instance_lock:
+                if not cls._instance: cls._instance = cls()
+        return cls._instance
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _int(value) -> int | None:
+        try: return int(value)
+        except (TypeError, ValueError): return None
+
+    @classmethod
+    def _public(cls, attrs: dict) -> dict:
+        """
+        attrs without credentials, nested dicts (repo) included
+        """
+        return {
+            key: cls._public(value) if isinstance(value, dict) else value
+            for key, value in attrs.items() if key not in cls.SECRETS
+        }
+
+    def _row(self, name: str, attrs: dict) -> tuple:
+        attrs = self._public(attrs)
+        repo = attrs.get('repo')
+        return (
+            name, self._int(attrs.get('port')), self._int(attrs.get('pc_port')),
+            repo.get('page_url') if isinstance(repo, dict) else repo, attrs.get('status'),
+            json.dumps(attrs, ensure_ascii=False), time.time(),
+        )
+
+    def _write(self, rows: list[tuple], durable: bool = False):
+        db = self._connect()
+        # WAL with synchronous=NORMAL survives a crash of the process, FULL also a power loss
+        if durable: db.execute('PRAGMA synchronous=FULL')
+        try:
+            with db: db.executemany(self.UPSERT, rows)
+        finally:
+            if durable: db.execute('PRAGMA synchronous=NORMAL')
+
+    def save(self, name: str, attrs: dict) -> None:
+        """
+        Inserts or replaces the app's attributes at once, a pending update of the app is dropped
+        """
+        with self._lock:
+            self._pending.pop(name, None)
+            self._write([self._row(name, attrs)], durable=True)
+
+    def update(self, name: str, attrs: dict) -> None:
+        """
+        Debounced save: written by flush() at most DEBOUNCE seconds later, together with other pending updates
+        """
+        with self._lock:
+            self._pending[name] = self._public(attrs)
+            if self._timer: return
+            self._timer = threading.Timer(self.DEBOUNCE, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self) -> int:
+        """
+        Writes pending updates in one transaction, returns their count
+        """
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending: return 0
+            rows = [self._row(name, attrs) for name, attrs in self._pending.items()]
+            self._write(rows)
+            self._pending.clear()
+        return len(rows)
+
+    def get(self, name: str) -> dict | None:
+        with self._lock:
+            if name in self._pending: return self._pending[name]
+        row = self._connect().execute('SELECT data FROM apps WHERE name = ?', (name,)).fetchone()
+        # rows written before SECRETS existed may still hold credentials
+        return self._public(json.loads(row['data'])) if row else None
+
+    def find(self, **filters) -> list[dict]:
+        """
+        Apps matching all filters, e.g. `find(pc_port=8001)`, `find(status='running')`. No filters - all apps
+        """
+        unknown = set(filters) - set(self.COLUMNS)
+        if unknown: raise ValueError(f"Unknown filters ({', '.join(unknown)})")
+        self.flush()
+        where = ' AND '.join(f'{column} = ?' for column in filters)
+        rows = self._connect().execute(
+            f'SELECT data FROM apps{f" WHERE {where}" if where else ""} ORDER BY name', tuple(filters.values())
+        ).fetchall()
+        return [self._public(json.loads(row['data'])) for row in rows]
+
+    def names(self) -> list[str]:
+        self.flush()
+        return [row['name'] for row in self._connect().execute('SELECT name FROM apps ORDER BY name')]
+
+    def delete(self, name: str) -> None:
+        with self._lock:
+            self._pending.pop(name, None)
+            with self._connect() as db:
+                db.execute('DELETE FROM apps WHERE name = ?', (name,))
+
+    def _migrate(self):
+        """
+        One-time import of db/apps/<name>/info.json files
+        """
+        db = self._connect()
+        if db.execute("SELECT 1 FROM meta WHERE key = 'info_json_migrated'").fetchone(): return
+        rows = []
+        if os.path.isdir(self.apps_dir):
+            for name in sorted(os.listdir(self.apps_dir)):
+                path = os.path.join(self.apps_dir, name, 'info.json')
+                if not os.path.isfile(path): continue
+                try:
+                    with open(path, 'r', encoding='utf-8') as f: info = json.load(f)
+                    attrs = info.get('app') or info['attrs']
+                except (OSError, ValueError, KeyError, AttributeError) as e:
+                    log.error(f'Skipping broken {path}: {e}')
+                    continue
+                if self.get(name) is None: rows.append(self._row(name, attrs))
+        if rows: self._write(rows, durable=True)
+        with db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('info_json_migrated', ?)", (str(time.time()),))
+        if rows: log.info(f'App registry: imported {len(rows)} apps from info.json files')
@@ -1,6 +1,9 @@
-import json, subprocess, os, sys
+import json, subprocess, os, sys, time, uuid, queue, signal, tempfile, threading
 import logging as log
+from collections import deque
+from types import MappingProxyType
 from subprocess import CompletedProcess
+from typing import IO, Callable
 
 def get_app_dir():
     if getattr(sys, 'frozen', False):
@@ -19,7 +22,12 @@ class AppDir:
     CURRENT_DIR = APP_DIR
     DB_DIR = os.path.join(CURRENT_DIR, 'db')
     APPS_DIR = os.path.join(DB_DIR, 'apps')
+    BLOBS_DIR = os.path.join(DB_DIR, 'blobs')                        # git blobs cache shared by all apps (see BlobStore)
+    HTTP_CACHE_DIR = os.path.join(DB_DIR, 'http_cache')              # conditional GET cache for GitHub metadata (see HttpCache)
     CF_CONFIG = os.path.join(DB_DIR, 'cloudflare.json')             # Cloudflare config (account data, zones list, tunnels data)
+    JOBS_FILE = os.path.join(DB_DIR, 'jobs.json')                   # background jobs queue (see JobQueue)
+    PORTS_FILE = os.path.join(DB_DIR, 'ports.json')                 # localhost ports leased to apps (see PortAllocator)
+    REGISTRY_DB = os.path.join(DB_DIR, 'apps.sqlite3')              # apps state (see AppRegistry)
 
     @classmethod
     def create_db_folder(cls):
@@ -38,7 +46,8 @@ class AppDir:
         """
         Checks the cloudflare.json file for account and tunnel info
         """
-        config = cls.cf_config()
+        try: config = JsonStore.read(cls.CF_CONFIG)
+        except (FileNotFoundError, json.JSONDecodeError): return False
         if not config.get('account', False) or not config.get('tunnel', False):
             return False
         return True
@@ -78,14 +87,36 @@ class ExecuterError(Exception):
 
 
 class Executer:
-    @staticmethod
-    def run_cmd(command: str) -> CompletedProcess:
+    SESSIONS = 4                    # shells kept open by enable_sessions()
+
+    _sessions = None
+
+    @classmethod
+    def enable_sessions(cls, size: int = SESSIONS, shell: list[str] = None, prefix: str = None):
+        """
+        Routes run_cmd through long-lived shells (see ShellSession) instead of starting a process per command
+        """
+        if cls._sessions: cls._sessions.close()
+        cls._sessions = ShellPool(size, shell, prefix)
+
+    @classmethod
+    def disable_sessions(cls):
+        if cls._sessions: cls._sessions.close()
+        cls._sessions = None
+
+    @classmethod
+    def run_cmd(cls, command: str) -> CompletedProcess:
         """
         Executes a shell command and returns the result.
         
         :param command: The command to execute as a string.
         :return: A CompletedProcess object containing the execution result.
         """
+        if cls._sessions and isinstance(command, str):
+            result = cls._sessions.run(command)
+            if result:
+                log.info(f'running command in shell session: ({command}); code: {result.returncode}')
+                return result
         result = subprocess.run(
             command,
             stdout=subprocess.PIPE, 
@@ -96,6 +127,42 @@ class Executer:
         log.info(f'running command: ({command}); code: {result.returncode}')
         return result
 
+    @staticmethod
+    def stream(command: str, feed: Callable[[IO[bytes]], None] = None, timeout: float = None,
+               cancel: threading.Event = None, tail_size: int = None, env: dict[str, str] = None) -> "ExecStream":
+        """
+        Starts a shell command whose output is read line by line while it runs, see ExecStream.
+
+        :param feed: writes the input into the given binary stream, stdin is closed after it returns
+        :param timeout: seconds after which the command is killed
+        :param cancel: the command is killed once this event is set
+        :param env: variables added to the environment of the command
+        """
+        return ExecStream(command, feed, timeout, cancel, tail_size or ExecStream.TAIL_SIZE, env)
+
+    @staticmethod
+    def group_args() -> dict:
+        """
+        Popen arguments starting the process in its own process group, so kill_tree() reaches what it started
+        """
+        if os.name == 'nt': return { 'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP }
+        return { 'start_new_session': True }
+
+    @staticmethod
+    def kill_tree(process: subprocess.Popen):
+        """
+        Kills the process with all its children. On Windows process.kill() ends only the cmd.exe of shell=True,
+        `wsl docker build` started by it would keep running and hold the pipes open, so taskkill /T is used
+        """
+        if os.name == 'nt':
+            subprocess.run(
+                ['taskkill', '/T', '/F', '/PID', str(process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            if process.poll() is None: process.kill()
+            return
+        try: os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError: pass
+
     @staticmethod
     def run_batch(scriptName: str, *args) -> CompletedProcess:
         """
@@ -112,13 +179,340 @@ class Executer:
         return result
 
 
+class ShellSession:
+    """
+    One long-lived bash (inside WSL on Windows) running many commands, so a command costs no process start.\n
+    Every command runs in a subshell with stdin from /dev/null, its output is framed by a marker line
+    carrying the exit code, written to stdout and stderr after it. Commands run one at a time.
+    """
+
+    def __init__(self, shell: list[str] = None, prefix: str = None):
+        """
+        :param prefix: only commands starting with it are accepted, it is cut off ('wsl ' for the WSL shell)
+        """
+        if shell is None: shell, prefix = self.default_shell()
+        self.shell = shell
+        self.prefix = prefix
+        self.process = subprocess.Popen(
+            shell, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **Executer.group_args()
+        )
+        self._lines = { 'stdout': queue.Queue(), 'stderr': queue.Queue() }
+        for name, pipe in (('stdout', self.process.stdout), ('stderr', self.process.stderr)):
+            threading.Thread(target=self._read, args=(name, pipe), daemon=True).start()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def default_shell() -> tuple[list[str], str | None]:
+        if os.name == 'nt': return ['wsl', '-e', 'bash', '--noprofile', '--norc'], 'wsl '
+        return ['bash', '--noprofile', '--norc'], None
+
+    def _read(self, name: str, pipe: IO[bytes]):
+        for line in iter(pipe.readline, b''):
+            self._lines[name].put(line.decode(errors='replace').rstrip('\r\n'))
+        self._lines[name].put(None)
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def accepts(self, command: str) -> str | None:
+        """
+        Command as it is run inside the session, None if it has to run outside of it
+        """
+        return self.cut_prefix(command, self.prefix)
+
+    @staticmethod
+    def cut_prefix(command: str, prefix: str | None) -> str | None:
+        if not prefix: return command
+        return command[len(prefix):] if command.startswith(prefix) else None
+
+    def run(self, command: str, timeout: float = None) -> CompletedProcess:
+        """
+        Runs command (already accepted) in the session. If it times out or the shell dies,
+        the session is closed and returncode is -1
+        """
+        marker = f'__spcs_{uuid.uuid4().hex}__'
+        script = (
+            f'( {command}\n) < /dev/null\n'
+            f'__rc=$?; printf "%s %d\\n" {marker} $__rc; printf "%s\\n" {marker} >&2\n'
+        )
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            try:
+                self.process.stdin.write(script.encode())
+                self.process.stdin.flush()
+                stdout, returncode = self._collect('stdout', marker, deadline)
+                stderr, _ = self._collect('stderr', marker, deadline)
+            except (OSError, ValueError) as e:
+                self.kill()
+                return CompletedProcess(command, -1, '', f'shell session failed: {e}')
+        return CompletedProcess(command, returncode, stdout, stderr)
+
+    def _collect(self, name: str, marker: str, deadline: float = None) -> tuple[str, int]:
+        output = []
+        while True:
+            remaining = deadline - time.monotonic() if deadline else None
+            if remaining is not None and remaining <= 0: raise OSError('command timeout')
+            try: line = self._lines[name].get(timeout=remaining)
+            except queue.Empty: continue
+            if line is None: raise OSError('shell exited')
+            end = line.find(marker)
+            if end == -1:
+                output.append(line + '\n')
+                continue
+            # output without a trailing newline ends on the marker line
+            if end: output.append(line[:end])
+            code = line[end + len(marker):].strip()
+            return ''.join(output), int(code) if code else None
+
+    def kill(self):
+        """
+        Kills the shell with everything it runs
+        """
+        Executer.kill_tree(self.process)
+        self.process.wait()
+
+    def close(self):
+        if not self.alive: return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+
+class ShellPool:
+    """
+    Up to `size` ShellSessions, so concurrent launches don't wait for each other's commands
+    """
+
+    def __init__(self, size: int, shell: list[str] = None, prefix: str = None):
+        if shell is None: shell, prefix = ShellSession.default_shell()
+        self.size = size
+        self.shell = shell
+        self.prefix = prefix
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_session(self) -> ShellSession:
+        return ShellSession(self.shell, self.prefix)
+
+    def _acquire(self) -> ShellSession:
+        try: return self._idle.get_nowait()
+        except queue.Empty: pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try: return self._new_session()
+                except OSError:
+                    self._created -= 1
+                    raise
+        return self._idle.get()
+
+    def _release(self, session: ShellSession):
+        if session.alive: return self._idle.put(session)
+        with self._lock: self._created -= 1
+
+    def run(self, command: str, timeout: float = None) -> CompletedProcess | None:
+        """
+        None if the command can't run in a session (see ShellSession.accepts)
+        """
+        # checked before a session is taken, a foreign command neither starts a shell nor waits for one
+        session_command = ShellSession.cut_prefix(command, self.prefix)
+        if session_command is None: return None
+        session = self._acquire()
+        try:
+            result = session.run(session_command, timeout)
+            result.args = command
+            return result
+        finally:
+            self._release(session)
+
+    def close(self):
+        while True:
+            try: self._idle.get_nowait().close()
+            except queue.Empty: break
+
+
+class ExecStream:
+    """
+    A running command. Iterating yields `(stream, line)` pairs ('stdout' / 'stderr')
+    as soon as they are printed, only the last `tail_size` lines are kept in memory.\n
+    After the iteration `returncode` is set, `error` is 'timeout' or 'cancelled' when the command was killed.
+    """
+
+    TAIL_SIZE = 200
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, command: str, feed: Callable[[IO[bytes]], None] = None, timeout: float = None,
+                 cancel: threading.Event = None, tail_size: int = TAIL_SIZE, env: dict[str, str] = None):
+        self.command = command
+        self.timeout = timeout
+        self.cancel = cancel or threading.Event()
+        self.tail: deque[tuple[str, str]] = deque(maxlen=tail_size)
+        self.returncode: int = None
+        self.error: str = None
+        self._lines = queue.Queue()
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE if feed else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=isinstance(command, str),
+            env={ **os.environ, **env } if env else None,
+            # own process group, so the shell and everything it started can be killed together
+            **Executer.group_args()
+        )
+        self._started = time.monotonic()
+        self._readers = [
+            threading.Thread(target=self._read, args=(name, pipe), daemon=True)
+            for name, pipe in (('stdout', self.process.stdout), ('stderr', self.process.stderr))
+        ]
+        for reader in self._readers: reader.start()
+        if feed: threading.Thread(target=self._feed, args=(feed,), daemon=True).start()
+
+    def _read(self, name: str, pipe: IO[bytes]):
+        with pipe:
+            for line in iter(pipe.readline, b''):
+                self._lines.put((name, line.decode(errors='replace').rstrip('\r\n')))
+        self._lines.put((name, None))
+
+    def _feed(self, feed: Callable[[IO[bytes]], None]):
+        try:
+            feed(self.process.stdin)
+        except BrokenPipeError:
+            log.warning(f'command ({self.command}) closed stdin before all input was written')
+        except ValueError:
+            pass                            # stdin closed by kill()
+        finally:
+            try: self.process.stdin.close()
+            except BrokenPipeError: pass
+
+    def kill(self, reason: str = 'cancelled'):
+        if self.error or self.process.poll() is not None: return
+        self.error = reason
+        log.warning(f'killing command ({self.command}): {reason}')
+        Executer.kill_tree(self.process)
+
+    def __iter__(self):
+        deadline = self._started + self.timeout if self.timeout else None
+        open_pipes = len(self._readers)
+        while open_pipes:
+            if self.cancel.is_set(): self.kill('cancelled')
+            elif deadline and time.monotonic() > deadline: self.kill('timeout')
+            try: name, line = self._lines.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty: continue
+            if line is None:
+                open_pipes -= 1
+                continue
+            self.tail.append((name, line))
+            yield name, line
+        self.returncode = self.process.wait()
+        log.info(f'running command: ({self.command}); code: {self.returncode}')
+
+    def result(self) -> CompletedProcess:
+        """
+        CompletedProcess with the tail of the output, call after the iteration
+        """
+        stdout = '\n'.join(line for name, line in self.tail if name == 'stdout')
+        stderr = '\n'.join(line for name, line in self.tail if name == 'stderr')
+        if self.error: stderr += f'\ncommand {self.error}'
+        return CompletedProcess(self.command, self.returncode, stdout, stderr)
+
+    def wait(self) -> CompletedProcess:
+        for _ in self: pass
+        return self.result()
+
+
+class JsonStore:
+    """
+    Process-wide cache of json files.\n
+    `read` checks the file's mtime, size and inode and parses it only when it changed,
+    data is given out as a read-only view (dicts -> MappingProxyType, lists -> tuples).
+    `write` goes to a temp file, fsync and rename, so readers never see a half-written file,
+    and drops the cached copy, the next `read` parses the file again.
+    """
+
+    _cache: dict = {}                       # path -> (stat key, frozen data)
+    _lock = threading.RLock()
+
+    @staticmethod
+    def _stat_key(path: str) -> tuple:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    @classmethod
+    def freeze(cls, data):
+        if isinstance(data, dict): return MappingProxyType({ key: cls.freeze(value) for key, value in data.items() })
+        if isinstance(data, (list, tuple)): return tuple(cls.freeze(value) for value in data)
+        return data
+
+    @classmethod
+    def thaw(cls, data):
+        """
+        Mutable deep copy of a read-only view
+        """
+        if isinstance(data, (dict, MappingProxyType)): return { key: cls.thaw(value) for key, value in data.items() }
+        if isinstance(data, (list, tuple)): return [cls.thaw(value) for value in data]
+        return data
+
+    @classmethod
+    def read(cls, path: str) -> MappingProxyType:
+        """
+        Raises FileNotFoundError / json.JSONDecodeError like json.load
+        """
+        path = os.path.abspath(path)
+        with cls._lock:
+            key = cls._stat_key(path)
+            cached = cls._cache.get(path)
+            if cached and cached[0] == key: return cached[1]
+            with open(path, 'r', encoding='utf-8') as file:
+                data = cls.freeze(json.load(file) or {})
+            cls._cache[path] = (key, data)
+            return data
+
+    @classmethod
+    def write(cls, path: str, data) -> None:
+        path = os.path.abspath(path)
+        dir_path = os.path.dirname(path)
+        with cls._lock:
+            fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                    json.dump(cls.thaw(data), file, indent=4, ensure_ascii=False)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+                raise
+            if os.name != 'nt':
+                # the rename itself is durable only once the directory is synced
+                dir_fd = os.open(dir_path, os.O_RDONLY)
+                try: os.fsync(dir_fd)
+                finally: os.close(dir_fd)
+            # only files that are read get cached, written manifests and such don't pile up here
+            cls._cache.pop(path, None)
+
+    @classmethod
+    def update(cls, path: str, change: Callable[[dict], None]) -> MappingProxyType:
+        """
+        Read-modify-write under the store lock: change gets a mutable copy of the data
+        """
+        with cls._lock:
+            data = cls.thaw(cls.read(path))
+            change(data)
+            cls.write(path, data)
+            return cls.read(path)
+
+
 class JsonEditor:
     @staticmethod
     def overwrite(jsonFilePath: str, dataToWrite: dict) -> None:
         dirPath = os.path.dirname(jsonFilePath)
         if not os.path.exists(dirPath): raise ValueError("json file not found in the specified directory")
-        with open(jsonFilePath, 'w') as file:
-            json.dump(dataToWrite, file, indent=4, ensure_ascii=False)
+        JsonStore.write(jsonFilePath, dataToWrite)
         log.info(f"Файл {jsonFilePath} успешно перезаписан.")
 
     @staticmethod
@@ -157,36 +551,44 @@ class JsonEditor:
 class BaseJsonFile:
     """
     Usage for read: `data = config('account', 'id')`\n
-    Usage for write: `config.set('account', 'id', value='734985984')`
+    Usage for write: `config.set('account', 'id', value='734985984')`\n
+    Backed by JsonStore: reads are served from memory until the file changes and return read-only views,
+    `set` writes the file at once.
     """
 
     FILE_PATH: str
 
     def __init__(self):
         JsonEditor.check_file(self.FILE_PATH)
-        self.data = JsonEditor.read(self.FILE_PATH)
+
+    @property
+    def data(self) -> MappingProxyType:
+        return JsonStore.read(self.FILE_PATH)
 
     def __call__(self, *args):
+        data = self.data
         for arg in args:
-            if isinstance(self.data, dict) and arg in self.data:
-                self.data = self.data[arg]
+            if isinstance(data, MappingProxyType) and arg in data:
+                data = data[arg]
             else:
                 return None
-        return self.data
+        return data
 
     def set(self, *args, value):
         if not args:
             return
-        data = self.data
-        for arg in args[:-1]:
-            if arg not in data or not isinstance(data[arg], dict):
-                data[arg] = {}
-            data = data[arg]
-        data[args[-1]] = value
+
+        def _set(data: dict):
+            for arg in args[:-1]:
+                if arg not in data or not isinstance(data[arg], dict):
+                    data[arg] = {}
+                data = data[arg]
+            data[args[-1]] = JsonStore.thaw(value)
+
+        JsonStore.update(self.FILE_PATH, _set)
 
     def save(self, obj: dict = None):
-        print('Save method')
-        print(obj)
-        JsonEditor.overwrite(self.FILE_PATH, obj if obj else self.data)
-        if obj: self.data = obj
-        print(self.data)
+        """
+        Overwrites the file with obj. Without obj there is nothing to do, set() already wrote its change
+        """
+        if obj is not None: JsonStore.write(self.FILE_PATH, obj)
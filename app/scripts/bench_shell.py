@@ -0,0 +1,41 @@
+"""
+Compares Executer.run_cmd with a process per command against shell sessions.
+
+Run from app/:
+    python -m scripts.bench_shell [commands] [command]
+
+On Windows the command should start with "wsl " (e.g. "wsl docker version"), the session then runs inside WSL.
+"""
+
+import sys, time
+from core.utils import Executer
+
+
+def bench(count: int, command: str) -> float:
+    started = time.perf_counter()
+    for _ in range(count):
+        res = Executer.run_cmd(command)
+        if res.returncode != 0: raise SystemExit(f'({command}) failed: {res.stderr}')
+    return time.perf_counter() - started
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    command = sys.argv[2] if len(sys.argv) > 2 else 'true'
+
+    per_process = bench(count, command)
+    Executer.enable_sessions(size=1)
+    try:
+        bench(1, command)               # session start is paid once
+        session = bench(count, command)
+    finally:
+        Executer.disable_sessions()
+
+    print(f'{count} x ({command})')
+    print(f'process per command: {per_process:.3f}s, {per_process / count * 1000:.2f} ms/command')
+    print(f'shell session:       {session:.3f}s, {session / count * 1000:.2f} ms/command')
+    print(f'speedup:             {per_process / session:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
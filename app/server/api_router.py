@@ -2,6 +2,7 @@ from flask import jsonify, request, Response, Blueprint
 from core import DockerApp, GitHubRepo, TunnelBuilder
 from utils import SSEEvents
 import logging as log
+import threading
 
 api_bp = Blueprint('api', __name__)
 
@@ -45,7 +46,8 @@ def project_launch(username, project_name):
         yield from SSEEvents.info("Repository downloaded")
 
         yield from SSEEvents.info("Building docker image")
-        try: project.build()
+        cancel = threading.Event()
+        try: yield from SSEEvents.forward(lambda on_line: project.build(on_line=on_line, cancel=cancel), cancel)
         except Exception as e:
             yield from SSEEvents.fatal(str(e))
             return log.error(e, exc_info=True)
@@ -2,6 +2,11 @@ from flask import jsonify, render_template, request, Blueprint
 import requests
 import logging as log
 from core import GitHubRepo, TunnelBuilder, CloudflareController, DockerApp
+from core import CFClient
+from core.deploy import DeployPipeline
+from core.jobs import JobQueue
+from core.registry import AppRegistry
+from core.engine import validate_resources
 
 cf_bp = Blueprint('cf', __name__)
 dk_bp = Blueprint('dk', __name__)
@@ -11,27 +16,132 @@ dk_bp = Blueprint('dk', __name__)
 def dk():
     return render_template('dk.html')
 
+def launch_job(params: dict, on_line, cancel) -> dict:
+    repo = GitHubRepo(
+        url = params['url'],
+        access_token = params['token'],
+        branch = params.get('branch', 'default')
+    )
+    app = DockerApp(
+        name = params['name'],
+        port = params['port'],
+        repo = repo,
+        resources = params.get('resources')
+    )
+    if params.get('zero_downtime'):
+        pc_port = app.redeploy(
+            hostname=params.get('hostname'), health_path=params.get('health_path', '/'),
+            health_timeout=params.get('health_timeout', DockerApp.HEALTH_TIMEOUT),
+            no_cache=params.get('no_cache', False), on_line=on_line, cancel=cancel
+        )
+    else:
+        pc_port = app.launch(
+            no_cache=params.get('no_cache', False), on_line=on_line, cancel=cancel, restart=params.get('restart', False)
+        )
+    return { 'pc_port': pc_port, 'url': f'http://localhost:{pc_port}' }
+
+def deploy_job(params: dict, on_line, cancel) -> dict:
+    def new_app(item: dict) -> DockerApp:
+        repo = GitHubRepo(url=item['url'], access_token=item['token'], branch=item.get('branch', 'default'))
+        return DockerApp(name=item['name'], port=item['port'], repo=repo, resources=item.get('resources'))
+
+    def tunnel(app: DockerApp):
+        hostname = hostnames.get(app.name)
+        if hostname: CFClient().route.set({ 'hostname': hostname, 'service': f'http://localhost:{app.pc_port}' })
+
+    hostnames = { item['name']: item.get('hostname') for item in params['apps'] }
+    # apps are created by the pipeline, a bad url or token fails only its own app
+    apps = { item['name']: (lambda item=item: new_app(item)) for item in params['apps'] }
+    pipeline = DeployPipeline(
+        limits=params.get('limits'), tunnel=tunnel if any(hostnames.values()) else None, on_line=on_line
+    )
+    return pipeline.deploy(apps, cancel=cancel)
+
+jobs = JobQueue.shared()
+jobs.register('launch', launch_job)
+jobs.register('deploy', deploy_job)
+
 @dk_bp.route('/launch', methods=['POST'])
 def docker_launch():
     data: dict = request.json
 
     try:
-        repo = GitHubRepo(
-            url = data['url'],
-            access_token = data['token'],
-            branch = data.get('branch', 'default')
-        )
+        params = { key: data[key] for key in ('name', 'url', 'token', 'port') }
+        params.update(branch=data.get('branch', 'default'), no_cache=data.get('no_cache', False))
+        # blue/green redeploy: { zero_downtime: true, hostname?, health_path?, health_timeout? },
+        # restart: restart the container when the app is unchanged and not rebuilt
+        params.update({ key: data[key] for key in ('zero_downtime', 'hostname', 'health_path', 'health_timeout', 'restart') if key in data })
+        # resource profile is checked before queuing, see ResourceProfile
+        if data.get('resources'): params['resources'] = validate_resources(data['resources'])
+        job_id = jobs.submit('launch', params['name'], params)
+    except KeyError as e:
+        return jsonify({ 'message': f'{e} is required' }), 400
+    except Exception as e:
+        return jsonify({ 'message': str(e) }), 400
+    return jsonify({ 'message': f'launch queued, job: {job_id}', 'job_id': job_id }), 202
 
-        app = DockerApp(
-            name = data['name'],
-            port = data['port'],
-            repo = repo
-        )
+@dk_bp.route('/deploy', methods=['POST'])
+def docker_deploy():
+    """
+    Body: { apps: [{ name, url, token, port, branch?, hostname? }], limits?: { pull, build, run, tunnel } }
+    """
+    data: dict = request.json
+
+    try:
+        apps = data['apps']
+        for item in apps:
+            missing = [key for key in ('name', 'url', 'token', 'port') if key not in item]
+            if missing: return jsonify({ 'message': f'{", ".join(missing)} required for every app' }), 400
+        names = sorted(item['name'] for item in apps)
+        # per app names, a launch and a deploy of the same app don't run at once
+        job_id = jobs.submit('deploy', f'deploy:{",".join(names)}', { 'apps': apps, 'limits': data.get('limits') }, apps=names)
+    except KeyError as e:
+        return jsonify({ 'message': f'{e} is required' }), 400
+    except Exception as e:
+        return jsonify({ 'message': str(e) }), 400
+    return jsonify({ 'message': f'deploy of {len(apps)} apps queued, job: {job_id}', 'job_id': job_id }), 202
+
+@dk_bp.route('/apps', methods=['GET'])
+def docker_apps():
+    """
+    Query: port?, pc_port?, repo? (page url), status? - apps matching all given filters
+    """
+    try: apps = AppRegistry.shared().find(**request.args.to_dict())
+    except ValueError as e:
+        return jsonify({ 'message': str(e) }), 400
+    return jsonify({ 'apps': apps }), 200
 
-        pc_port = app.launch()
+@dk_bp.route('/app/<name>', methods=['DELETE'])
+def docker_delete(name):
+    try: DockerApp.load(name).delete()
+    except Exception as e:
+        return jsonify({ 'message': str(e) }), 400
+    return jsonify({ 'message': f'App ({name}) deleted' }), 200
+
+@dk_bp.route('/app/<name>/resources', methods=['GET', 'POST'])
+def docker_resources(name):
+    try:
+        app = DockerApp.load(name)
+        if request.method == 'POST': app.set_resources(request.json or {})
     except Exception as e:
         return jsonify({ 'message': str(e) }), 400
-    return jsonify({ 'message': f'app running on: http://localhost:{pc_port}' })
+    return jsonify({ 'resources': getattr(app, 'resources', {}) }), 200
+
+@dk_bp.route('/jobs', methods=['GET'])
+def docker_jobs():
+    return jsonify({ 'jobs': jobs.list() }), 200
+
+@dk_bp.route('/jobs/<job_id>', methods=['GET'])
+def docker_job(job_id):
+    try: return jsonify(jobs.get(job_id)), 200
+    except ValueError as e:
+        return jsonify({ 'message': str(e) }), 404
+
+@dk_bp.route('/jobs/<job_id>/cancel', methods=['POST'])
+def docker_job_cancel(job_id):
+    try: return jsonify(jobs.cancel(job_id)), 200
+    except ValueError as e:
+        return jsonify({ 'message': str(e) }), 404
 
 
 # Cloudflare routes
@@ -1,3 +1,14 @@
+const RESOURCE_FIELDS = ['cpus', 'memory', 'cpuset', 'build_cpus', 'build_memory', 'build_cpuset'];
+
+function readResources(form) {
+    const resources = {};
+    for (const field of RESOURCE_FIELDS) {
+        const value = form.querySelector(`input[name="${field}"]`).value;
+        if (value !== '') resources[field] = value;
+    }
+    return resources;
+}
+
 class NewDkForm {
     constructor() {
         this.form = document.getElementById('newDk');
@@ -27,19 +38,85 @@ class NewDkForm {
                 url: this.urlInput.value,
                 token: this.tokenInput.value,
                 branch: this.branchInput.value,
-                port: this.portInput.value
+                port: this.portInput.value,
+                resources: readResources(this.form)
             })
         })
         .then(async res => {
             const resData = await res.json();
-            if (res.ok) return this.showError(resData?.message);
             this.showError(resData?.message);
+            if (res.ok && resData?.job_id) this.watchJob(resData.job_id);
+        })
+        .catch(err => this.showError(err));
+    }
+
+    watchJob(jobId) {
+        fetch(`${window.location.origin}/dk/jobs/${jobId}`)
+        .then(async res => {
+            const job = await res.json();
+            if (!res.ok) return this.showError(job?.message);
+            if (job.status === 'done') return this.showError(`app running on: ${job.result.url}`);
+            if (job.status === 'failed') return this.showError(job.error);
+            if (job.status === 'cancelled') return this.showError('launch cancelled');
+            this.showError(job.log.length ? job.log[job.log.length - 1] : job.status);
+            setTimeout(() => this.watchJob(jobId), 2000);
+        })
+        .catch(err => this.showError(err));
+    }
+}
+
+class ResourcesForm {
+    constructor() {
+        this.form = document.getElementById('dkResources');
+        this.nameInput = this.form.querySelector('input[name="name"]');
+        this.errMsg = this.form.querySelector('.error-msg');
+
+        this.form.addEventListener('submit', this.onSubmit.bind(this));
+        this.form.querySelector('button[name="load"]').addEventListener('click', this.load.bind(this));
+    }
+
+    showError(text) {
+        this.errMsg.textContent = text;
+        if (!this.errMsg.classList.contains('active')) this.errMsg.classList.add('active');
+    }
+
+    fill(resources) {
+        for (const field of RESOURCE_FIELDS) {
+            this.form.querySelector(`input[name="${field}"]`).value = resources[field] ?? '';
+        }
+    }
+
+    load() {
+        fetch(`${window.location.origin}/dk/app/${encodeURIComponent(this.nameInput.value)}/resources`)
+        .then(async res => {
+            const resData = await res.json();
+            if (!res.ok) return this.showError(resData?.message);
+            this.fill(resData.resources);
+            this.showError('');
+        })
+        .catch(err => this.showError(err));
+    }
+
+    onSubmit(e) {
+        e.preventDefault();
+
+        fetch(`${window.location.origin}/dk/app/${encodeURIComponent(this.nameInput.value)}/resources`, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify(readResources(this.form))
+        })
+        .then(async res => {
+            const resData = await res.json();
+            if (!res.ok) return this.showError(resData?.message);
+            this.fill(resData.resources);
+            this.showError('Saved');
         })
         .catch(err => this.showError(err));
     }
 }
 
 const newDkForm = new NewDkForm();
+const resourcesForm = new ResourcesForm();
 
 
 
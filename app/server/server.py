@@ -8,8 +8,9 @@ import logging as log
 
 from flask import Flask, render_template
 from core import AppDir, APP_DIR
+from core.utils import Executer
 # from src.api_router import api_bp
-from app_router import cf_bp, dk_bp
+from app_router import cf_bp, dk_bp, jobs
 
 log.basicConfig(
     level=log.DEBUG,
@@ -42,5 +43,9 @@ if __name__ == "__main__":
     AppDir.create_db_folder()
     log.info("Starting SecondPCServer...")
     threading.Thread(target=open_browser, daemon=True).start()
+    # long-lived shells for docker commands, saves a wsl start per command
+    if os.environ.get('SPCS_SHELL_SESSIONS'): Executer.enable_sessions(int(os.environ['SPCS_SHELL_SESSIONS']))
+    # debug reloader runs this file twice, jobs run only in the serving child process
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true': jobs.start()
     app.run(debug=True, host='0.0.0.0', port=1488)
 
@@ -1,4 +1,5 @@
-import json
+import json, queue, threading
+from typing import Callable
 
 class SSEEvents:
     @staticmethod
@@ -27,4 +28,28 @@ class SSEEvents:
         data = { 'type': 'close' }
         if msg: data['msg'] = msg
         msgToSend = json.dumps(data)
-        yield f'data: {msgToSend} \n\n'
\ No newline at end of file
+        yield f'data: {msgToSend} \n\n'
+
+    @staticmethod
+    def forward(target: Callable[[Callable[[str], None]], object], cancel: threading.Event = None):
+        """
+        Runs target(on_line) in a thread and sends every reported line as an info event
+        while it runs. An exception of target is raised once its lines are sent.
+        If the client disconnects (generator closed) the cancel event is set.
+        """
+        lines = queue.Queue()
+        error = []
+
+        def _run():
+            try: target(lines.put)
+            except Exception as e: error.append(e)
+            finally: lines.put(None)
+
+        threading.Thread(target=_run, daemon=True).start()
+        try:
+            while (line := lines.get()) is not None:
+                yield from SSEEvents.info(line)
+        except GeneratorExit:
+            if cancel: cancel.set()
+            raise
+        if error: raise error[0]
@@ -0,0 +1,128 @@
+# run command: pytest
+
+import threading
+import pytest
+from core.cf import CFClient, CloudFlareAPI
+
+
+class FakeApi:
+    """
+    CloudFlareAPI stand-in keeping one tunnel configuration
+    """
+    def __init__(self, ingress):
+        self.ingress = ingress
+        self.version = 1
+        self.requests = []
+
+    def request(self, method, url, json=None):
+        self.requests.append(method)
+        if method == 'PUT':
+            self.ingress = json['config']['ingress']
+            self.version += 1
+        return { 'version': self.version, 'config': { 'ingress': [dict(rule) for rule in self.ingress] } }
+
+
+def route_client(ingress):
+    api = FakeApi(ingress)
+    route = CFClient.Route(api=api, config=lambda *keys: keys[0])
+    route.DEBOUNCE = 0.05
+    return api, route
+
+
+def test_concurrent_changes_are_one_put():
+    api, route = route_client([{ 'hostname': 'old.example.com', 'service': 'http://localhost:1' }, { 'service': 'http_status:404' }])
+    threads = [
+        threading.Thread(target=route.add, args=({ 'hostname': f'app{i}.example.com', 'service': f'http://localhost:{8000 + i}' },))
+        for i in range(10)
+    ]
+    threads.append(threading.Thread(target=route.delete, args=('old.example.com',)))
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    assert api.requests == ['GET', 'PUT']
+    hostnames = [rule.get('hostname') for rule in api.ingress]
+    assert sorted(hostnames[:-1]) == sorted(f'app{i}.example.com' for i in range(10)) and hostnames[-1] is None
+    assert route.version == 2 and len(route.rules) == 10
+
+
+def test_set_keeps_one_catch_all_and_remote_edits():
+    api, route = route_client([{ 'hostname': 'a.example.com', 'service': 'http://localhost:1' }, { 'service': 'http_status:404' }])
+    route.set({ 'hostname': 'a.example.com', 'service': 'http://localhost:2' })
+    # edited elsewhere in the meantime
+    api.ingress.insert(0, { 'hostname': 'b.example.com', 'service': 'http://localhost:3' })
+    api.version += 1
+    route.add({ 'hostname': 'c.example.com', 'service': 'http://localhost:4' })
+    route.add({ 'hostname': 'c.example.com', 'service': 'http://localhost:4' })
+
+    assert [rule.get('hostname') for rule in api.ingress] == ['c.example.com', 'b.example.com', 'a.example.com', None]
+    assert api.ingress[2]['service'] == 'http://localhost:2'
+    # the last add changed nothing, no PUT
+    assert api.requests == ['GET', 'PUT', 'GET', 'PUT', 'GET']
+
+
+def test_write_errors_reach_waiting_callers():
+    api, route = route_client([])
+    api.request = lambda method, url, json=None: (_ for _ in ()).throw(ValueError('forbidden'))
+    with pytest.raises(ValueError): route.set({ 'hostname': 'a.example.com', 'service': 'http://localhost:1' })
+    route.delete('a.example.com', wait=False)
+    route.flush()
+
+
+class FakeDnsApi(CloudFlareAPI):
+    """
+    CloudFlareAPI answering dns_records requests from a list, PER_PAGE records per page
+    """
+    def __init__(self, records):
+        self.records = records
+        self.requests = []
+
+    def _send(self, method, url, json=None, params=None):
+        self.requests.append((method, dict(params or {})))
+        if method == 'POST':
+            record = { **json, 'id': str(len(self.records)) }
+            self.records.append(record)
+            return { 'success': True, 'result': record }
+        params = params or {}
+        found = [record for record in self.records if params.get('name') in (None, record['name'])]
+        page, per_page = params['page'], params['per_page']
+        return {
+            'success': True, 'result': found[(page - 1) * per_page:page * per_page],
+            'result_info': { 'page': page, 'total_pages': max(1, -(-len(found) // per_page)) },
+        }
+
+
+def test_dns_lookups_are_filtered_by_name_and_cached():
+    records = [{ 'type': 'A', 'name': f'host{i}.example.com', 'content': '10.0.0.1' } for i in range(250)]
+    api = FakeDnsApi(records + [{ 'type': 'CNAME', 'name': 'app.example.com', 'content': 't.cfargotunnel.com' }])
+    dns = CFClient.Dns(api=api, config=lambda *keys: 'zone')
+
+    assert len(dns.get_records()) == 251 and len(api.requests) == 3
+    assert dns.check_record('HOST7.example.com')['content'] == '10.0.0.1' and len(api.requests) == 3
+
+    dns.TTL = 0
+    assert dns.check_record('app.example.com', type='A') is None
+    assert api.requests[-1] == ('GET', { 'name': 'app.example.com', 'page': 1, 'per_page': 100 })
+
+    dns.TTL = 300
+    created = dns.create_record({ 'type': 'CNAME', 'proxied': True, 'name': 'new.example.com', 'content': 't.cfargotunnel.com' })
+    assert [method for method, _ in api.requests[-2:]] == ['GET', 'POST']
+    assert dns.create_record(dict(created)) == created and api.requests[-1][0] == 'POST'
+
+
+def test_client_keeps_one_route_and_dns(tmp_path, monkeypatch):
+    from core import cf
+    path = tmp_path / 'cloudflare.json'
+    path.write_text('{"account": {"id": "a1", "api_token": "t"}, "tunnel": {"id": "t1", "zone": {"id": "z1"}}}')
+    monkeypatch.setattr(cf.Config, 'FILE_PATH', str(path))
+    monkeypatch.setattr(CFClient, '_instance', None)
+    monkeypatch.setattr(CFClient, '_initialized', False)
+    apis = []
+    monkeypatch.setattr(cf, 'CloudFlareAPI', lambda api_token: apis.append(FakeApi([])) or apis[-1])
+
+    clients = []
+    threads = [threading.Thread(target=lambda: clients.append(CFClient())) for _ in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    assert len(apis) == 1 and all(client is clients[0] for client in clients)
+    assert CFClient().route is CFClient().route and CFClient().dns is CFClient().dns
@@ -0,0 +1,103 @@
+# run command: pytest
+
+import time, threading
+from core.deploy import DeployPipeline
+
+
+class FakeApp:
+    """
+    DockerApp stand-in recording when every stage ran
+    """
+
+    def __init__(self, name, timeline, lock, fail_stage=None, first_stage='pull'):
+        self.name = name
+        self.timeline = timeline
+        self.lock = lock
+        self.fail_stage = fail_stage
+        self.first_stage = first_stage
+        self.checkpoints = []
+
+    def _stage(self, stage, duration=0.1):
+        started = time.monotonic()
+        time.sleep(duration)
+        with self.lock: self.timeline.append((self.name, stage, started, time.monotonic()))
+        if stage == self.fail_stage: raise RuntimeError(f'{stage} broke')
+
+    def pull(self): self._stage('pull')
+    def build(self, on_line=None, cancel=None): self._stage('build', 0.2)
+    def _set_pcport(self): self.pc_port = 8000
+    def run(self): self._stage('run', 0.01)
+    def resume_stage(self): return self.first_stage
+    def has_image(self): return True
+    def _start_unchanged(self):
+        self.pc_port = 8000
+        with self.lock: self.timeline.append((self.name, 'kept', 0, 0))
+        return self.pc_port
+    def checkpoint(self, status): self.checkpoints.append(status)
+
+
+def test_stages_overlap_within_limits():
+    timeline, lock = [], threading.Lock()
+    apps = [FakeApp(f'app{i}', timeline, lock) for i in range(4)]
+    tunneled = []
+
+    report = DeployPipeline(limits={ 'pull': 1, 'build': 1 }, tunnel=lambda app: tunneled.append(app.name)).deploy(apps)
+
+    def running_at(stage, moment):
+        return sum(1 for _, name, start, end in timeline if name == stage and start <= moment < end)
+    for _, stage, start, _ in timeline:
+        if stage in ('pull', 'build'): assert running_at(stage, start) <= 1
+    # the second app downloads while the first one builds
+    pulls = sorted(start for _, stage, start, _ in timeline if stage == 'pull')
+    builds = sorted((start, end) for _, stage, start, end in timeline if stage == 'build')
+    assert builds[0][0] <= pulls[1] < builds[0][1]
+    assert sorted(tunneled) == [app.name for app in apps]
+    assert report['stages']['build']['count'] == 4 and report['stages']['pull']['wait'] > 0
+    assert all(app_report['status'] == 'done' and app_report['pc_port'] == 8000 for app_report in report['apps'].values())
+    assert report['apps_per_minute'] > 0
+
+
+def test_failed_app_stops_at_its_stage():
+    timeline, lock = [], threading.Lock()
+    apps = [FakeApp('good', timeline, lock), FakeApp('bad', timeline, lock, fail_stage='build')]
+
+    report = DeployPipeline().deploy(apps)
+
+    assert report['apps']['bad']['status'] == 'failed' and report['apps']['bad']['stage'] == 'build'
+    assert report['apps']['bad']['error'] == 'build broke'
+    assert ('bad', 'run') not in [(name, stage) for name, stage, _, _ in timeline]
+    assert report['apps']['good']['status'] == 'done'
+    assert report['stages']['build']['failed'] == 1 and 'tunnel' not in report['apps']['good']['timings']
+
+
+def test_apps_resume_from_their_stage():
+    timeline, lock = [], threading.Lock()
+    apps = [FakeApp('fresh', timeline, lock), FakeApp('pulled', timeline, lock, first_stage='build')]
+
+    report = DeployPipeline(tunnel=lambda app: None).deploy(apps)
+
+    stages = [(name, stage) for name, stage, _, _ in timeline]
+    assert ('fresh', 'pull') in stages and ('pulled', 'pull') not in stages and ('pulled', 'build') in stages
+    assert all(app.checkpoints == ['tunneled'] for app in apps)
+    assert report['apps']['pulled']['status'] == 'done' and 'pull' not in report['apps']['pulled']['timings']
+
+
+def test_unchanged_apps_keep_their_containers():
+    timeline, lock = [], threading.Lock()
+    apps = [FakeApp('unchanged', timeline, lock, first_stage='run'), FakeApp('changed', timeline, lock)]
+
+    report = DeployPipeline().deploy(apps)
+
+    stages = [(name, stage) for name, stage, _, _ in timeline]
+    assert ('unchanged', 'kept') in stages and ('unchanged', 'run') not in stages and ('changed', 'run') in stages
+    assert report['apps']['unchanged']['status'] == 'done' and report['apps']['unchanged']['pc_port'] == 8000
+
+
+def test_app_failing_to_be_created_does_not_stop_the_others():
+    timeline, lock = [], threading.Lock()
+
+    def bad_token(): raise ValueError('Bad credentials, GitHub access_token is bad')
+    report = DeployPipeline().deploy({ 'bad': bad_token, 'good': lambda: FakeApp('good', timeline, lock) })
+
+    assert report['apps']['bad'] == { 'status': 'failed', 'stage': 'init', 'error': 'Bad credentials, GitHub access_token is bad', 'pc_port': None, 'timings': {} }
+    assert report['apps']['good']['status'] == 'done' and ('good', 'run') in [(name, stage) for name, stage, _, _ in timeline]
@@ -0,0 +1,427 @@
+# run command: pytest
+
+import pytest, os, io, json, time, hashlib, tarfile, requests, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from core.dk import GitHubRepo, RepoSnapshot
+from core.fetch import Downloader
+from core.blobs import BlobStore
+from core.net import HttpCache, HttpClient
+
+
+class FakeGitHub:
+    """
+    Local stand-in for api.github.com / codeload.github.com.
+    `routes` maps request path to (status_code, body bytes),
+    `queued` maps request path to one-shot (status_code, headers) answers sent before the route
+    """
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self.ranges = []
+        self.queued = {}
+        self.not_modified = 0
+        self.rate_limit_remaining = 5000
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.requests.append(self.path)
+                if fake.queued.get(self.path):
+                    status, headers = fake.queued[self.path].pop(0)
+                    self.send_response(status)
+                    for name, value in headers.items(): self.send_header(name, value)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status, body = fake.routes.get(self.path, (404, b'{"message": "Not Found"}'))
+                etag = f'"{hashlib.sha1(body).hexdigest()}"'
+                if status == 200 and self.headers.get('If-None-Match') == etag:
+                    fake.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                fake.rate_limit_remaining -= 1
+                range_header = self.headers.get('Range')
+                if self.headers.get('If-Range') not in (None, etag): range_header = None
+                if status == 200 and range_header:
+                    fake.ranges.append(range_header)
+                    status, body = 206, body[int(range_header.removeprefix('bytes=').split('-')[0]):]
+                self.send_response(status)
+                self.send_header('ETag', etag)
+                self.send_header('X-RateLimit-Limit', '5000')
+                self.send_header('X-RateLimit-Remaining', str(fake.rate_limit_remaining))
+                self.send_header('X-RateLimit-Reset', '0')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def make_tarball(files: dict, root: str = 'owner-repo-abc123') -> bytes:
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for path, content in files.items():
+            info = tarfile.TarInfo(f'{root}/{path}')
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def make_repo(api_url: str, branch: str = 'main') -> GitHubRepo:
+    repo = GitHubRepo.__new__(GitHubRepo)
+    repo.url = api_url
+    repo.branch = branch
+    repo.api_headers = { "Authorization": "token test" }
+    return repo
+
+
+def make_tree(files: dict, modes: dict = None) -> bytes:
+    tree = [
+        { 'path': path, 'mode': (modes or {}).get(path, '100644'), 'type': 'blob', 'sha': BlobStore.blob_sha(content) }
+        for path, content in files.items()
+    ]
+    return json.dumps({ 'tree': tree, 'truncated': False }).encode()
+
+
+@pytest.fixture
+def github(tmp_path, monkeypatch):
+    monkeypatch.setattr(HttpCache, '_instance', HttpCache(str(tmp_path / 'http_cache')))
+    fake = FakeGitHub()
+    yield fake
+    fake.close()
+
+
+def test_pull_archive(github, tmp_path):
+    files = {
+        'Dockerfile': b'FROM python:3.12\n',
+        'app/main.py': b'print("hello")\n',
+    }
+    github.routes['/repos/o/r/tarball/main'] = (200, make_tarball(files))
+    repo = make_repo(f'{github.url}/repos/o/r')
+
+    repo.pull(str(tmp_path), mode='archive')
+
+    assert (tmp_path / 'src' / 'Dockerfile').read_bytes() == files['Dockerfile']
+    assert (tmp_path / 'src' / 'app' / 'main.py').read_bytes() == files['app/main.py']
+    assert github.requests == ['/repos/o/r/tarball/main']
+
+
+def test_pull_archive_fallback_to_contents(github, tmp_path):
+    base = f'{github.url}/repos/o/r'
+    github.routes['/repos/o/r/contents/?ref=main'] = (200, (
+        f'[{{"type": "file", "name": "Dockerfile", "download_url": "{github.url}/raw/Dockerfile"}}]'
+    ).encode())
+    github.routes['/raw/Dockerfile'] = (200, b'FROM alpine\n')
+    repo = make_repo(base)
+
+    repo.pull(str(tmp_path), mode='archive')
+
+    assert (tmp_path / 'src' / 'Dockerfile').read_bytes() == b'FROM alpine\n'
+    assert github.requests[0] == '/repos/o/r/tarball/main'
+
+
+def test_downloader_resumes_partial_file(github, tmp_path):
+    body = bytes(range(256)) * 1024
+    github.routes['/raw/blob.bin'] = (200, body)
+    dest = tmp_path / 'nested' / 'blob.bin'
+    dest.parent.mkdir()
+    (tmp_path / 'nested' / 'blob.bin.part').write_bytes(body[:1000])
+    (tmp_path / 'nested' / 'blob.bin.part.validator').write_text(f'"{hashlib.sha1(body).hexdigest()}"')
+
+    stats = Downloader(workers=2, chunk_size=4096).download_all([
+        { 'url': f'{github.url}/raw/blob.bin', 'path': str(dest) },
+        { 'url': f'{github.url}/raw/missing', 'path': str(tmp_path / 'missing') },
+    ])
+
+    assert dest.read_bytes() == body
+    assert github.ranges == ['bytes=1000-']
+    assert stats.files == 1 and len(stats.failed) == 1
+    assert stats.bytes == len(body) - 1000
+    assert sorted(os.listdir(dest.parent)) == ['blob.bin']
+
+
+def test_downloader_restarts_changed_file(github, tmp_path):
+    old, new = b'old version ' * 100, b'new version ' * 120
+    github.routes['/raw/main.py'] = (200, new)
+    dest = tmp_path / 'src' / 'main.py'
+    downloader = Downloader(part_dir=str(tmp_path / '.partial'))
+    part = downloader._part_path(str(dest))
+    os.makedirs(os.path.dirname(part))
+    with open(part, 'wb') as f: f.write(old[:500])
+    with open(part + Downloader.VALIDATOR_SUFFIX, 'w') as f: f.write(f'"{hashlib.sha1(old).hexdigest()}"')
+
+    downloader.download_all([{ 'url': f'{github.url}/raw/main.py', 'path': str(dest) }])
+
+    # If-Range did not match the new version, the file came back whole
+    assert dest.read_bytes() == new and github.ranges == []
+    assert os.listdir(tmp_path / 'src') == ['main.py'] and os.listdir(tmp_path / '.partial') == []
+
+
+def test_pull_incremental(github, tmp_path):
+    v1 = { 'Dockerfile': b'FROM alpine\n', 'docs/old.md': b'old\n', 'main.py': b'v1\n' }
+    v2 = { 'Dockerfile': b'FROM alpine\n', 'main.py': b'v2\n' }
+    v2_sha = BlobStore.blob_sha(b'v2\n')
+    store = BlobStore(str(tmp_path / 'blobs'))
+    app_dir = tmp_path / 'app'
+    app_dir.mkdir()
+    repo = make_repo(f'{github.url}/repos/o/r')
+
+    github.routes['/repos/o/r/commits/main'] = (200, b'c1')
+    github.routes['/repos/o/r/git/trees/c1?recursive=1'] = (200, make_tree(v1))
+    github.routes['/repos/o/r/tarball/c1'] = (200, make_tarball(v1))
+    repo.pull(str(app_dir), store=store)
+    assert repo.commit == 'c1'
+    assert (app_dir / 'src' / 'docs' / 'old.md').exists()
+    assert '/repos/o/r/tarball/c1' in github.requests
+
+    github.requests.clear()
+    github.routes['/repos/o/r/commits/main'] = (200, b'c2')
+    github.routes['/repos/o/r/git/trees/c2?recursive=1'] = (200, make_tree(v2))
+    github.routes[f'/repos/o/r/git/blobs/{v2_sha}'] = (200, b'v2\n')
+    repo.probe(refresh=True)    # next launch
+    repo.pull(str(app_dir), store=store)
+
+    assert repo.commit == 'c2'
+    assert github.requests == [
+        '/repos/o/r/commits/main', '/repos/o/r/git/trees/c2?recursive=1', f'/repos/o/r/git/blobs/{v2_sha}'
+    ]
+    assert (app_dir / 'src' / 'main.py').read_bytes() == b'v2\n'
+    assert not (app_dir / 'src' / 'docs').exists()
+    manifest = json.loads((app_dir / 'manifest.json').read_text())
+    assert manifest['commit'] == 'c2' and set(manifest['files']) == { 'Dockerfile', 'main.py' }
+
+
+def test_pull_reuses_blob_store_across_apps(github, tmp_path):
+    files = { 'Dockerfile': b'FROM alpine\n', 'main.py': b'print(1)\n' }
+    store = BlobStore(str(tmp_path / 'blobs'))
+    github.routes['/repos/o/r/commits/main'] = (200, b'c1')
+    github.routes['/repos/o/r/git/trees/c1?recursive=1'] = (200, make_tree(files))
+    github.routes['/repos/o/r/tarball/c1'] = (200, make_tarball(files))
+    repo = make_repo(f'{github.url}/repos/o/r')
+
+    repo.pull(str(tmp_path / 'app1'), store=store)
+    github.requests.clear()
+    repo.pull(str(tmp_path / 'app2'), store=store)
+
+    assert '/repos/o/r/tarball/c1' not in github.requests
+    first, second = tmp_path / 'app1' / 'src' / 'main.py', tmp_path / 'app2' / 'src' / 'main.py'
+    assert second.read_bytes() == files['main.py']
+    assert os.path.samefile(first, second)
+
+
+def test_downloaded_blobs_are_verified(github, tmp_path):
+    files = { 'Dockerfile': b'FROM alpine\n', 'main.py': b'print(1)\n' }
+    store = BlobStore(str(tmp_path / 'blobs'))
+    github.routes['/repos/o/r/commits/main'] = (200, b'c1')
+    github.routes['/repos/o/r/git/trees/c1?recursive=1'] = (200, make_tree(files))
+    for content in files.values():
+        github.routes[f'/repos/o/r/git/blobs/{BlobStore.blob_sha(content)}'] = (200, content)
+    # tarball is unavailable, blobs are downloaded one by one
+    main_sha = BlobStore.blob_sha(files['main.py'])
+    github.routes[f'/repos/o/r/git/blobs/{main_sha}'] = (200, b'tampered\n')
+    repo = make_repo(f'{github.url}/repos/o/r')
+
+    with pytest.raises(ValueError, match=main_sha):
+        repo.pull(str(tmp_path / 'app'), store=store)
+
+    assert not store.has(main_sha) and store.has(BlobStore.blob_sha(files['Dockerfile']))
+    assert not os.listdir(store.root + '/.incoming') and store.size() == len(b'FROM alpine\n') + len(b'tampered\n')
+
+
+def test_blob_store_evicts_least_recently_used(tmp_path):
+    store = BlobStore(str(tmp_path), max_size=10)
+    old = store.add(io.BytesIO(b'123456'), 6)
+    new = store.add(io.BytesIO(b'abcdef'), 6)
+    os.utime(store.path(old), (1, 1))
+
+    assert store.evict() == 6
+    assert not store.has(old) and store.has(new)
+
+
+def test_http_cache_evicts_least_recently_used(tmp_path):
+    cache = HttpCache(str(tmp_path), max_size=700)
+
+    def response(body: bytes):
+        res = requests.Response()
+        res.status_code, res._content = 200, body
+        res.headers['ETag'] = '"e"'
+        return res
+    cache._store('https://api.github.com/old', {}, response(b'o' * 200))
+    cache._store('https://api.github.com/new', {}, response(b'n' * 200))
+    os.utime(cache._paths('https://api.github.com/old', {})[1], (1, 1))
+    cache._store('https://api.github.com/newest', {}, response(b'x' * 200))
+
+    assert cache._load('https://api.github.com/old', {}) is None
+    assert cache._load('https://api.github.com/new', {})['body'] == b'n' * 200 and cache.size() <= 700
+
+
+def test_metadata_calls_revalidate_with_etag(github):
+    github.routes['/repos/o/r/commits/main'] = (200, b'c1')
+    github.routes['/repos/o/r/git/trees/c1?recursive=1'] = (200, make_tree({ 'Dockerfile': b'FROM alpine\n' }))
+
+    assert make_repo(f'{github.url}/repos/o/r')._isDkfileExists() == 'Dockerfile'
+    repo = make_repo(f'{github.url}/repos/o/r')
+    assert repo._isDkfileExists() == 'Dockerfile'
+
+    # head revalidated with 304, tree of an already indexed commit is not requested again
+    assert github.not_modified == 1
+    assert github.requests.count('/repos/o/r/git/trees/c1?recursive=1') == 1
+    assert repo.rate_limit_remaining() == 4998
+
+
+def test_metadata_calls_slow_down_near_rate_limit(github, monkeypatch):
+    github.routes['/repos/o/r/commits/main'] = (200, b'c1')
+    repo = make_repo(f'{github.url}/repos/o/r')
+    slept = []
+    monkeypatch.setattr('core.net.time.sleep', slept.append)
+
+    repo._getHeadCommit()
+    assert slept == []
+    HttpCache.shared().rate_limits[HttpCache._key('token test')] = { 'limit': 5000, 'remaining': 10, 'reset': int(time.time()) + 100 }
+    repo._getHeadCommit()
+    assert len(slept) == 1 and 5 < slept[0] <= 10
+
+
+def test_init_probes_repository_once(github, monkeypatch):
+    monkeypatch.setattr(GitHubRepo, 'API_URL', github.url)
+    github.routes['/repos/o/r'] = (200, json.dumps({
+        'url': f'{github.url}/repos/o/r', 'private': False, 'default_branch': 'main',
+        'owner': { 'login': 'o' }, 'name': 'r', 'full_name': 'o/r',
+    }).encode())
+    github.routes['/repos/o/r/commits/HEAD'] = (200, b'c1')
+    github.routes['/repos/o/r/git/trees/c1?recursive=1'] = (200, make_tree({ 'Dockerfile': b'FROM alpine\n' }))
+
+    repo = GitHubRepo('https://github.com/o/r.git', access_token='test')
+
+    assert repo.branch == 'main'
+    assert repo._isDkfileExists() == 'Dockerfile'
+    assert repo.probe().commit == 'c1'
+    assert sorted(github.requests) == sorted([
+        '/repos/o/r', '/repos/o/r/commits/HEAD', '/repos/o/r/git/trees/c1?recursive=1'
+    ])
+
+
+def test_http_client_retries_with_retry_after(github):
+    github.queued['/flaky'] = [(429, { 'Retry-After': '0' }), (503, {})]
+    github.routes['/flaky'] = (200, b'ok')
+    client = HttpClient(backoff=0)
+
+    res = client.get(f'{github.url}/flaky')
+
+    assert res.text == 'ok'
+    stats = client.latency_stats()[f'GET {github.url.removeprefix("http://")}/flaky']
+    assert stats['count'] == 3 and stats['retries'] == 2 and stats['errors'] == 1
+
+
+def test_build_candidates_ranking():
+    tree = [{ 'path': path, 'type': 'blob', 'sha': path } for path in (
+        'docs/Dockerfile', 'service/Dockerfile', 'docker-compose.yml', 'Dockerfile.dev', 'Dockerfile', 'README.md'
+    )]
+    snapshot = RepoSnapshot('c1', tree)
+
+    assert snapshot.candidates == [
+        'Dockerfile', 'service/Dockerfile', 'Dockerfile.dev', 'docker-compose.yml', 'docs/Dockerfile'
+    ]
+    assert snapshot.dockerfiles[0] == 'Dockerfile'
+
+
+def test_truncated_tree_is_walked_by_subtrees(github):
+    github.routes['/repos/o/r/commits/main'] = (200, b'c1')
+    github.routes['/repos/o/r/git/trees/c1?recursive=1'] = (200, json.dumps({
+        'tree': [{ 'path': 'docs/Dockerfile', 'type': 'blob', 'sha': 'd1' }], 'truncated': True
+    }).encode())
+    github.routes['/repos/o/r/git/trees/c1'] = (200, json.dumps({ 'tree': [
+        { 'path': 'docs', 'type': 'tree', 'sha': 't-docs' },
+        { 'path': 'app', 'type': 'tree', 'sha': 't-app' },
+    ], 'truncated': False }).encode())
+    github.routes['/repos/o/r/git/trees/t-docs?recursive=1'] = (200, json.dumps({ 'tree': [
+        { 'path': 'Dockerfile', 'type': 'blob', 'sha': 'd1' },
+    ], 'truncated': False }).encode())
+    github.routes['/repos/o/r/git/trees/t-app?recursive=1'] = (200, json.dumps({ 'tree': [
+        { 'path': 'Dockerfile', 'type': 'blob', 'sha': 'd2' },
+    ], 'truncated': False }).encode())
+    repo = make_repo(f'{github.url}/repos/o/r')
+
+    snapshot = repo.probe()
+
+    assert not snapshot.truncated
+    assert [item['path'] for item in snapshot.tree] == ['app', 'app/Dockerfile', 'docs', 'docs/Dockerfile']
+    assert repo._isDkfileExists() == 'app/Dockerfile'
+
+
+def test_pull_skips_dockerignored_files(github, tmp_path):
+    files = {
+        'Dockerfile': b'FROM alpine\n',
+        '.dockerignore': b'datasets\ndocs/*.md\n',
+        'main.py': b'print(1)\n',
+        'datasets/big.csv': b'1,2,3\n',
+        'docs/guide.md': b'# guide\n',
+    }
+    github.routes['/repos/o/r/commits/main'] = (200, b'c1')
+    github.routes['/repos/o/r/git/trees/c1?recursive=1'] = (200, make_tree(files))
+    github.routes['/repos/o/r/tarball/c1'] = (200, make_tarball(files))
+    ignore_sha = BlobStore.blob_sha(files['.dockerignore'])
+    github.routes[f'/repos/o/r/git/blobs/{ignore_sha}'] = (200, files['.dockerignore'])
+    store = BlobStore(str(tmp_path / 'blobs'))
+    repo = make_repo(f'{github.url}/repos/o/r')
+
+    repo.pull(str(tmp_path / 'app'), store=store, dockerfile='Dockerfile')
+
+    src = tmp_path / 'app' / 'src'
+    assert sorted(p.relative_to(src).as_posix() for p in src.rglob('*') if p.is_file()) == [
+        '.dockerignore', 'Dockerfile', 'main.py'
+    ]
+    assert not store.has(BlobStore.blob_sha(files['datasets/big.csv']))
+    assert [path for path in github.requests if '/git/blobs/' in path] == [f'/repos/o/r/git/blobs/{ignore_sha}']
+
+
+def test_pull_keeps_git_modes(github, tmp_path):
+    files = { 'Dockerfile': b'FROM alpine\n', 'start.sh': b'#!/bin/sh\n', 'run': b'start.sh' }
+    modes = { 'start.sh': '100755', 'run': '120000' }
+    store = BlobStore(str(tmp_path / 'blobs'))
+    github.routes['/repos/o/r/commits/main'] = (200, b'c1')
+    github.routes['/repos/o/r/git/trees/c1?recursive=1'] = (200, make_tree(files, modes))
+    for content in files.values():
+        github.routes[f'/repos/o/r/git/blobs/{BlobStore.blob_sha(content)}'] = (200, content)
+    repo = make_repo(f'{github.url}/repos/o/r')
+
+    repo.pull(str(tmp_path / 'app'), store=store)
+
+    src = tmp_path / 'app' / 'src'
+    assert os.stat(src / 'Dockerfile').st_mode & 0o777 == 0o644
+    assert os.stat(src / 'start.sh').st_mode & 0o777 == 0o755 and not os.path.samefile(src / 'start.sh', store.path(BlobStore.blob_sha(files['start.sh'])))
+    assert os.readlink(src / 'run') == 'start.sh'
+    assert json.loads((tmp_path / 'app' / 'manifest.json').read_text())['modes'] == modes
+
+    # the executable bit is dropped upstream: same blob, new mode
+    github.routes['/repos/o/r/commits/main'] = (200, b'c2')
+    github.routes['/repos/o/r/git/trees/c2?recursive=1'] = (200, make_tree(files, { 'run': '120000' }))
+    repo.probe(refresh=True)
+    repo.pull(str(tmp_path / 'app'), store=store)
+    assert os.stat(src / 'start.sh').st_mode & 0o777 == 0o644
+
+
+def test_pinned_blobs_survive_eviction(tmp_path):
+    store = BlobStore(str(tmp_path / 'blobs'), max_size=0)
+    used, other = (store.add(io.BytesIO(content), len(content)) for content in (b'used\n', b'other\n'))
+
+    with store.pinned({ used }):
+        # a concurrent pull evicts while this one still has to link its blobs
+        store.evict()
+        assert store.has(used) and not store.has(other)
+        with store.pinned({ used }): pass
+        store.evict()
+        assert store.has(used)
+    store.evict()
+    assert not store.has(used) and BlobStore._pins == {}
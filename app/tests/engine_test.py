@@ -0,0 +1,441 @@
+# run command: pytest
+
+import pytest, io, os, json, time, socket, tarfile, threading, socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from core.engine import CliBackend, ContainerBackend, EngineBackend, BuildLog, validate_resources
+from core.dk import DockerApp, RepoSnapshot
+from core.ports import PortAllocator
+from core.registry import AppRegistry
+from core.context import BuildContext, DockerIgnore
+from core.utils import ApiResponseError
+
+
+class FakeEngine:
+    """
+    Local stand-in for dockerd listening on a unix socket.
+    Records (method, path, body) of every request, answers from `routes`: (method, path without query) -> (status, body)
+    """
+    def __init__(self, socket_path: str):
+        self.requests = []
+        self.connections = 0
+        self.routes = {}
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                fake.connections += 1
+                super().setup()
+
+            def _answer(self):
+                if self.headers.get('Transfer-Encoding') == 'chunked':
+                    body = b''
+                    while size := int(self.rfile.readline().strip(), 16):
+                        body += self.rfile.read(size)
+                        self.rfile.readline()
+                    self.rfile.readline()
+                else:
+                    length = int(self.headers.get('Content-Length', 0))
+                    body = self.rfile.read(length) if length else b''
+                fake.requests.append((self.command, self.path, body))
+                path = self.path.split('?')[0].removeprefix('/v1.41')
+                status, answer = fake.routes.get((self.command, path), (204, b''))
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(answer)))
+                self.end_headers()
+                self.wfile.write(answer)
+
+            do_GET = do_POST = do_DELETE = _answer
+
+            def address_string(self):
+                return 'unix'
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self.server = Server(socket_path, Handler)
+        self.docker_host = f'unix://{socket_path}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def engine(tmp_path):
+    fake = FakeEngine(str(tmp_path / 'docker.sock'))
+    yield fake
+    fake.close()
+
+
+def test_build_streams_context_tar(engine, tmp_path):
+    context = tmp_path / 'src'
+    (context / 'app').mkdir(parents=True)
+    (context / 'node_modules' / 'pkg').mkdir(parents=True)
+    (context / 'app' / 'Dockerfile').write_text('FROM alpine\n')
+    (context / 'app' / 'main.py').write_text('print(1)\n')
+    (context / 'node_modules' / 'pkg' / 'index.js').write_text('//\n')
+    (context / '.dockerignore').write_text('node_modules\n')
+    engine.routes[('POST', '/build')] = (200, b'{"stream": "Step 1/1 : FROM alpine"}\r\n{"stream": " ---> Using cache\\n"}\r\n')
+    build_context = BuildContext(str(context), 'app/Dockerfile')
+    lines = []
+
+    metrics = EngineBackend(engine.docker_host).build(
+        ['demo:latest', 'demo:b1'], build_context, no_cache=True, on_line=lines.append
+    )
+
+    method, path, body = engine.requests[0]
+    assert method == 'POST' and path.startswith('/v1.41/build?')
+    assert 't=demo%3Alatest&t=demo%3Ab1' in path and 'nocache=1' in path and 'dockerfile=app%2FDockerfile' in path
+    with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+        assert sorted(tar.getnames()) == ['.dockerignore', 'app/Dockerfile', 'app/main.py']
+        assert tar.extractfile('app/Dockerfile').read() == b'FROM alpine\n'
+    assert build_context.files == 3 and build_context.size == len(body)
+    assert lines == ['Step 1/1 : FROM alpine', ' ---> Using cache']
+    assert metrics['steps'] == 1 and metrics['cached'] == 1
+
+
+def test_context_tar_modes(tmp_path, monkeypatch):
+    (tmp_path / 'Dockerfile').write_text('FROM alpine\n')
+    (tmp_path / 'start.sh').write_text('#!/bin/sh\n')
+    os.chmod(tmp_path / 'Dockerfile', 0o600)
+
+    def tar_modes(context: BuildContext) -> dict:
+        buf = io.BytesIO()
+        context.write_tar(buf)
+        buf.seek(0)
+        with tarfile.open(fileobj=buf) as tar: return { member.name: member.mode for member in tar }
+
+    assert tar_modes(BuildContext(str(tmp_path), 'Dockerfile', { 'start.sh': '100755' })) == { 'Dockerfile': 0o644, 'start.sh': 0o755 }
+    assert tar_modes(BuildContext(str(tmp_path), 'Dockerfile'))['Dockerfile'] == 0o600
+    # Windows reports no exec bit, every file is sent 0755
+    monkeypatch.setattr(os, 'name', 'nt')
+    assert tar_modes(BuildContext(str(tmp_path), 'Dockerfile')) == { 'Dockerfile': 0o755, 'start.sh': 0o755 }
+
+
+def test_build_error_in_stream_raises(engine, tmp_path):
+    engine.routes[('POST', '/build')] = (200, b'{"stream": "Step 1/2"}\n{"error": "RUN failed"}\n')
+
+    with pytest.raises(ApiResponseError) as excinfo:
+        EngineBackend(engine.docker_host).build(['demo:latest'], BuildContext(str(tmp_path), 'Dockerfile'))
+    assert excinfo.value.message == 'RUN failed'
+
+
+def test_run_and_remove_reuse_connection(engine):
+    engine.routes[('POST', '/containers/create')] = (201, b'{"Id": "abc"}')
+    engine.routes[('DELETE', '/containers/demo')] = (404, b'{"message": "No such container: demo"}')
+    backend = EngineBackend(engine.docker_host)
+
+    assert backend.run('demo', 'demo:latest', { 8081: 80 }) == 'abc'
+    backend.stop('demo')
+    with pytest.raises(ApiResponseError) as excinfo:
+        backend.remove_container('demo')
+
+    assert excinfo.value.status_code == 404
+    assert [(method, path.split('?')[0]) for method, path, _ in engine.requests] == [
+        ('POST', '/v1.41/containers/create'),
+        ('POST', '/v1.41/containers/abc/start'),
+        ('POST', '/v1.41/containers/demo/stop'),
+        ('DELETE', '/v1.41/containers/demo'),
+    ]
+    config = json.loads(engine.requests[0][2])
+    assert config['HostConfig']['PortBindings'] == { '80/tcp': [{ 'HostPort': '8081' }] }
+    assert engine.connections == 1
+
+
+def test_build_log_counts_cache_hits():
+    classic = 'Step 1/3 : FROM alpine\n ---> 1a2b\nStep 2/3 : COPY . .\n ---> Using cache\nStep 3/3 : RUN make\n'
+    buildkit = (
+        '#5 [1/3] FROM docker.io/library/alpine\n#5 CACHED\n'
+        '#6 [2/3] COPY . .\n#6 CACHED\n#7 [3/3] RUN make\n#7 DONE 3.1s\n'
+    )
+
+    def metrics(output: str):
+        build_log = BuildLog()
+        for line in output.splitlines(): build_log.feed(line)
+        return build_log.metrics()
+
+    assert metrics(classic)['steps'] == 3 and metrics(classic)['cached'] == 1
+    assert metrics(buildkit)['steps'] == 3 and metrics(buildkit)['cached'] == 2
+
+
+def test_old_build_images_are_pruned(engine):
+    engine.routes[('GET', '/images/json')] = (200, json.dumps([
+        { 'RepoTags': ['demo:latest', 'demo:b20240105000000'] },
+        { 'RepoTags': ['demo:b20240104000000'] },
+        { 'RepoTags': ['demo:b20240103000000'] },
+        { 'RepoTags': ['demo:b20240102000000'] },
+        { 'RepoTags': ['demo:manual'] },
+    ]).encode())
+    app = DockerApp.__new__(DockerApp)
+    app.name = 'demo'
+    app.isDeleted = True        # nothing to persist
+    app._backend = EngineBackend(engine.docker_host)
+
+    app._prune_images(keep=2)
+
+    deleted = [path for method, path, _ in engine.requests if method == 'DELETE']
+    assert deleted == ['/v1.41/images/demo%3Ab20240103000000', '/v1.41/images/demo%3Ab20240102000000']
+
+
+def test_dockerignore_patterns():
+    ignore = DockerIgnore(['# comment', '.git', '**/*.log', 'docs/', '!docs/keep.md', '/build*'])
+
+    assert ignore.is_excluded('.git') and ignore.is_excluded('.git/objects/ab')
+    assert ignore.is_excluded('a/b/debug.log') and ignore.is_excluded('debug.log')
+    assert ignore.is_excluded('docs/index.md') and not ignore.is_excluded('docs/keep.md')
+    assert ignore.is_excluded('build-output/x') and not ignore.is_excluded('src/build.py')
+    assert ignore.may_include_below('docs') and not ignore.may_include_below('.git')
+
+
+def redeploy_app(engine, ports, monkeypatch, tmp_path):
+    monkeypatch.setattr(PortAllocator, '_instance', PortAllocator(str(tmp_path / 'ports.json'), apps_dir=str(tmp_path)))
+    app = DockerApp.__new__(DockerApp)
+    app.name = 'demo'
+    app.port = 80
+    app.isDeleted = True
+    app.container = 'demo'
+    app.pc_port = 8001
+    app._backend = EngineBackend(engine.docker_host)
+    app.HEALTH_INTERVAL = 0.05
+    free_ports = iter(ports)
+    app._set_pcport = lambda fresh=False: setattr(app, 'pc_port', next(free_ports))
+    return app
+
+
+def test_switch_starts_new_container_before_stopping_old(engine, tmp_path, monkeypatch):
+    health = HTTPServer(('localhost', 0), type('Ok', (BaseHTTPRequestHandler,), {
+        'do_GET': lambda self: (self.send_response(200), self.end_headers()),
+        'log_message': lambda self, *args: None,
+    }))
+    threading.Thread(target=health.serve_forever, daemon=True).start()
+    engine.routes[('POST', '/containers/create')] = (201, b'{"Id": "new-id"}')
+    app = redeploy_app(engine, [health.server_port], monkeypatch, tmp_path)
+    routed = []
+
+    try: new_port = app.switch(drain=0, route=routed.append)
+    finally: health.shutdown()
+
+    calls = [(method, path.split('?')[0].removeprefix('/v1.41')) for method, path, _ in engine.requests]
+    started = calls.index(('POST', '/containers/new-id/start'))
+    assert calls.index(('POST', '/containers/demo/stop')) > started
+    assert ('DELETE', '/containers/demo') in calls and 'name=demo-blue' in engine.requests[started - 1][1]
+    assert new_port == health.server_port and routed == [new_port] and app.container == 'demo-blue'
+
+
+def test_switch_rolls_back_when_route_fails(engine, tmp_path, monkeypatch):
+    health = HTTPServer(('localhost', 0), type('Ok', (BaseHTTPRequestHandler,), {
+        'do_GET': lambda self: (self.send_response(200), self.end_headers()),
+        'log_message': lambda self, *args: None,
+    }))
+    threading.Thread(target=health.serve_forever, daemon=True).start()
+    engine.routes[('POST', '/containers/create')] = (201, b'{"Id": "new-id"}')
+    app = redeploy_app(engine, [health.server_port], monkeypatch, tmp_path)
+    PortAllocator.shared().leases[health.server_port] = { 'app': 'demo', 'leased': 0 }
+
+    def route(port): raise ValueError('tunnel is not configured')
+    try:
+        with pytest.raises(ValueError, match='tunnel'): app.switch(drain=0, route=route)
+    finally: health.shutdown()
+
+    assert '/v1.41/containers/demo-blue' in [path for method, path, _ in engine.requests if method == 'DELETE']
+    assert app.container == 'demo' and app.pc_port == 8001 and PortAllocator.shared().ports('demo') == []
+
+
+def test_switch_keeps_old_container_when_unhealthy(engine, tmp_path, monkeypatch):
+    engine.routes[('POST', '/containers/create')] = (201, b'{"Id": "new-id"}')
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        dead_port = sock.getsockname()[1]
+    app = redeploy_app(engine, [dead_port], monkeypatch, tmp_path)
+
+    with pytest.raises(ValueError):
+        app.switch(health_timeout=0.3, drain=0, route=lambda port: pytest.fail('route switched'))
+
+    stopped = [path for method, path, _ in engine.requests if path.endswith('/stop')]
+    assert stopped == ['/v1.41/containers/demo-blue/stop', '/v1.41/containers/demo-blue/stop']
+    assert app.container == 'demo' and app.pc_port == 8001
+
+
+def test_failed_switch_keeps_saved_port(engine, tmp_path, monkeypatch):
+    monkeypatch.setattr(AppRegistry, '_instance', AppRegistry(str(tmp_path / 'apps.sqlite3'), apps_dir=str(tmp_path)))
+    engine.routes[('POST', '/containers/create')] = (201, b'{"Id": "new-id"}')
+    app = redeploy_app(engine, [], monkeypatch, tmp_path)
+    del app.isDeleted, app._set_pcport
+    app.save(durable=True)
+
+    with pytest.raises(ValueError): app.switch(health_timeout=0.3, drain=0)
+
+    assert AppRegistry.shared().get('demo')['pc_port'] == 8001 and PortAllocator.shared().ports('demo') == []
+
+
+class FakeRepo:
+    def __init__(self, commit):
+        self.snapshot = RepoSnapshot(commit, [{ 'path': 'Dockerfile', 'type': 'blob', 'sha': 'd0' }])
+        self.pulls = 0
+
+    def probe(self, refresh=False, commit=None):
+        return self.snapshot
+
+    def pull(self, dir_path, **kwargs):
+        self.pulls += 1
+        raise RuntimeError('pulled')
+
+
+def test_unchanged_app_follows_run_config(engine, tmp_path, monkeypatch):
+    monkeypatch.setattr(PortAllocator, '_instance', PortAllocator(str(tmp_path / 'ports.json'), apps_dir=str(tmp_path)))
+    engine.routes[('GET', '/containers/demo/json')] = (200, b'{"State": {"Running": true}}')
+    engine.routes[('GET', '/images/json')] = (200, json.dumps([{ 'RepoTags': ['demo:latest'] }]).encode())
+    engine.routes[('POST', '/containers/create')] = (201, b'{"Id": "new-id"}')
+    app = DockerApp.__new__(DockerApp)
+    app.name, app.port, app.pc_port, app.container = 'demo', 80, 8001, 'demo'
+    app.dk_file_path, app.dir_path = 'Dockerfile', str(tmp_path)
+    app.isDeleted = True
+    app._backend = EngineBackend(engine.docker_host)
+    app.repo = FakeRepo('c1')
+    app.commit, app.build_hash = 'c1', app._build_hash(app.repo.snapshot)
+    app.run_config = { 'port': 80, 'limits': {} }
+
+    app.resources = { 'cpus': 1.5 }
+    assert app.launch() == 8001
+    paths = [path.split('?')[0] for _, path, _ in engine.requests]
+    assert '/v1.41/containers/demo/update' in paths and '/v1.41/containers/create' not in paths
+
+    app.port = 81
+    app.launch()
+    assert '/v1.41/containers/create' in [path.split('?')[0] for _, path, _ in engine.requests]
+    assert app.run_config == { 'port': 81, 'limits': { 'cpus': 1.5 } } and app.repo.pulls == 0
+
+
+def test_unchanged_app_is_not_rebuilt(engine, tmp_path):
+    engine.routes[('GET', '/containers/demo/json')] = (200, b'{"State": {"Running": true}}')
+    app = DockerApp.__new__(DockerApp)
+    app.name, app.port, app.pc_port, app.container = 'demo', 80, 8001, 'demo'
+    app.dk_file_path, app.dir_path = 'Dockerfile', str(tmp_path)
+    app.isDeleted = True
+    app._backend = EngineBackend(engine.docker_host)
+    app.repo = FakeRepo('c1')
+    app.commit, app.build_hash = 'c1', app._build_hash(app.repo.snapshot)
+
+    started = time.monotonic()
+    assert app.launch(restart=True) == 8001
+    assert time.monotonic() - started < 1 and app.repo.pulls == 0
+    assert ('POST', '/v1.41/containers/demo/restart', b'') in engine.requests
+
+    app.repo = FakeRepo('c2')
+    with pytest.raises(RuntimeError, match='pulled'):
+        app.launch()
+    assert app.repo.pulls == 1
+
+
+def test_resource_profile_reaches_container_and_build(engine, tmp_path):
+    resources = validate_resources({ 'cpus': '1.5', 'memory': 512, 'cpuset': '0-1', 'build_cpus': 2, 'build_cpuset': '2,3', 'build_memory': '' })
+    engine.routes[('POST', '/containers/create')] = (201, b'{"Id": "abc"}')
+    engine.routes[('POST', '/build')] = (200, b'{"stream": "ok"}\n')
+    (tmp_path / 'Dockerfile').write_text('FROM alpine\n')
+    backend = EngineBackend(engine.docker_host)
+
+    backend.run('demo', 'demo:latest', { 8001: 80 }, resources)
+    backend.build(['demo:latest'], BuildContext(str(tmp_path), 'Dockerfile'), resources=resources)
+
+    host_config = json.loads(engine.requests[0][2])['HostConfig']
+    assert host_config['NanoCpus'] == 1_500_000_000 and host_config['CpusetCpus'] == '0-1'
+    assert host_config['Memory'] == host_config['MemorySwap'] == 512 * 1024 ** 2
+    build_path = engine.requests[-1][1]
+    assert 'cpuquota=200000' in build_path and 'cpusetcpus=2%2C3' in build_path and 'memory=' not in build_path
+    assert CliBackend._limit_args(resources) == '--cpu-period 100000 --cpu-quota 150000 --memory 512m --memory-swap 512m --cpuset-cpus 0-1'
+    for invalid in ({ 'cpus': 0 }, { 'memory': 'lots' }, { 'cpuset': 'all' }, { 'gpus': 1 }):
+        with pytest.raises(ValueError): validate_resources(invalid)
+
+
+def test_limited_cli_build_uses_classic_builder(tmp_path, monkeypatch):
+    docker = tmp_path / 'bin' / 'docker'
+    docker.parent.mkdir()
+    docker.write_text('#!/bin/sh\ncat > /dev/null\necho "buildkit=$DOCKER_BUILDKIT $*"\n')
+    docker.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{docker.parent}{os.pathsep}{os.environ["PATH"]}')
+    (tmp_path / 'Dockerfile').write_text('FROM alpine\n')
+    backend, lines = CliBackend(wsl=False), []
+
+    backend.build(['demo:latest'], BuildContext(str(tmp_path), 'Dockerfile'), on_line=lines.append, resources={ 'build_cpus': 1.0 })
+    backend.build(['demo:latest'], BuildContext(str(tmp_path), 'Dockerfile'), on_line=lines.append)
+
+    assert lines[0].startswith('buildkit=0 build') and '--cpu-quota 100000' in lines[0] and '--progress' not in lines[0]
+    assert lines[1].startswith('buildkit= build') and '--progress=plain' in lines[1]
+
+
+def test_build_slots_cap_concurrent_builds(monkeypatch):
+    monkeypatch.setattr(ContainerBackend, '_build_slots', threading.BoundedSemaphore(1))
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def build():
+        with ContainerBackend.build_slot():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.1)
+            with lock: running[0] -= 1
+
+    threads = [threading.Thread(target=build) for _ in range(3)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert peak[0] == 1
+
+    cancel = threading.Event()
+    cancel.set()
+    with ContainerBackend.build_slot():
+        with pytest.raises(ValueError, match='cancelled'):
+            with ContainerBackend.build_slot(cancel): pass
+
+
+class PulledRepo:
+    """
+    GitHubRepo stand-in whose pull only creates src/
+    """
+    def __init__(self, commit):
+        self.url = 'https://api.github.com/repos/u/demo'
+        self._snapshot = RepoSnapshot(commit, [{ 'path': 'Dockerfile', 'type': 'blob', 'sha': 'd0' }])
+
+    def probe(self, refresh=False, commit=None):
+        return self._snapshot
+
+    def pull(self, dir_path, **kwargs):
+        os.makedirs(os.path.join(dir_path, 'src'), exist_ok=True)
+
+
+def test_interrupted_launch_resumes_after_pull(tmp_path, monkeypatch):
+    monkeypatch.setattr(AppRegistry, '_instance', AppRegistry(str(tmp_path / 'apps.sqlite3'), apps_dir=str(tmp_path)))
+    app = DockerApp.__new__(DockerApp)
+    app.name, app.port, app.dk_file_path, app.dir_path = 'demo', 80, 'Dockerfile', str(tmp_path)
+    app.repo = PulledRepo('c1')
+    app.pull()
+    # the server dies here, before the build
+    del app
+
+    restored = DockerApp.load('demo')
+    assert restored.status == 'pulled' and restored.pulled_commit == 'c1'
+    restored.repo = PulledRepo('c1')
+    assert restored.resume_stage() == 'build' and restored._pulled.commit == 'c1'
+    restored.repo = PulledRepo('c2')
+    assert restored.resume_stage() == 'pull'
+
+
+def test_engine_backend_needs_opt_in_and_plain_host(monkeypatch):
+    for name in ('DOCKER_HOST', 'DOCKER_TLS_VERIFY', 'SPCS_DOCKER_ENGINE'): monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('DOCKER_HOST', 'tcp://host:2375')
+    assert isinstance(ContainerBackend.from_env(), CliBackend)
+
+    monkeypatch.setenv('SPCS_DOCKER_ENGINE', '1')
+    assert isinstance(ContainerBackend.from_env(), EngineBackend)
+    for docker_host in ('npipe:////./pipe/docker_engine', 'ssh://user@host'):
+        monkeypatch.setenv('DOCKER_HOST', docker_host)
+        assert isinstance(ContainerBackend.from_env(), CliBackend)
+    monkeypatch.setenv('DOCKER_HOST', 'tcp://host:2376')
+    monkeypatch.setenv('DOCKER_TLS_VERIFY', '1')
+    assert isinstance(ContainerBackend.from_env(), CliBackend)
+    with pytest.raises(TypeError): ContainerBackend()
@@ -0,0 +1,89 @@
+# run command: pytest
+
+import json, time, pytest, threading
+from core.jobs import JobQueue
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'condition not met in time'
+        time.sleep(0.02)
+
+
+def test_jobs_are_deduplicated_and_capped(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'jobs.json'), workers=2)
+    release = threading.Event()
+    running, max_running = [], []
+    lock = threading.Lock()
+
+    def launch(params, on_line, cancel):
+        with lock:
+            running.append(params['name'])
+            max_running.append(len(running))
+        on_line(f"building {params['name']}")
+        release.wait(5)
+        with lock: running.remove(params['name'])
+        return { 'pc_port': params['port'] }
+
+    jobs.register('launch', launch)
+    jobs.start()
+    ids = [jobs.submit('launch', name, { 'name': name, 'port': port }) for port, name in enumerate('abc')]
+
+    assert jobs.submit('launch', 'a', { 'name': 'a', 'port': 9 }) == ids[0]
+    wait_for(lambda: len(running) == 2)
+    assert jobs.get(ids[2])['status'] == 'queued'
+    assert jobs.get(ids[0])['log'] == ['building a']
+    release.set()
+    wait_for(lambda: all(jobs.get(job_id)['status'] == 'done' for job_id in ids))
+    assert max(max_running) == 2 and jobs.get(ids[1])['result'] == { 'pc_port': 1 }
+
+
+def test_cancel_running_and_queued_jobs(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'jobs.json'), workers=1)
+
+    def launch(params, on_line, cancel):
+        if not cancel.wait(5): return None
+        raise RuntimeError('build cancelled')
+
+    jobs.register('launch', launch)
+    jobs.start()
+    running = jobs.submit('launch', 'a', {})
+    queued = jobs.submit('launch', 'b', {})
+    wait_for(lambda: jobs.get(running)['status'] == 'running')
+
+    assert jobs.cancel(queued)['status'] == 'cancelled'
+    jobs.cancel(running)
+    wait_for(lambda: jobs.get(running)['status'] == 'cancelled')
+    assert jobs.get(running)['error'] == 'build cancelled'
+
+
+def test_queued_jobs_survive_restart(tmp_path):
+    path = str(tmp_path / 'jobs.json')
+    jobs = JobQueue(path)
+    jobs.register('launch', lambda params, on_line, cancel: params['name'])
+    queued = jobs.submit('launch', 'a', { 'name': 'a', 'token': 'secret' })
+    # a job killed together with the server
+    interrupted = jobs.submit('launch', 'b', { 'name': 'b' })
+    jobs.jobs[interrupted]['status'] = 'running'
+    jobs._save()
+
+    restarted = JobQueue(path)
+    restarted.register('launch', lambda params, on_line, cancel: params['name'])
+    restarted.start()
+
+    wait_for(lambda: all(restarted.get(job_id)['status'] == 'done' for job_id in (queued, interrupted)))
+    assert restarted.get(queued)['result'] == 'a'
+    with open(path) as f: saved = json.load(f)
+    assert all(job['params'] == {} for job in saved)
+
+
+def test_jobs_sharing_an_app_are_refused(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'jobs.json'))
+    jobs.register('launch', lambda params, on_line, cancel: None)
+    jobs.register('deploy', lambda params, on_line, cancel: None)
+
+    deploy = jobs.submit('deploy', 'deploy:a,b', {}, apps=['b', 'a'])
+    assert jobs.submit('deploy', 'deploy:a,b', {}, apps=['a', 'b']) == deploy
+    with pytest.raises(ValueError, match='a busy'): jobs.submit('launch', 'a', {})
+    assert jobs.submit('launch', 'c', {}) != deploy
@@ -0,0 +1,58 @@
+# run command: pytest
+
+import json, time, socket
+from concurrent.futures import ThreadPoolExecutor
+from core.ports import PortAllocator
+
+
+def allocator(tmp_path, *apps):
+    for app in apps: (tmp_path / 'apps' / app).mkdir(parents=True, exist_ok=True)
+    return PortAllocator(str(tmp_path / 'ports.json'), apps_dir=str(tmp_path / 'apps'))
+
+
+def test_concurrent_leases_never_collide(tmp_path):
+    apps = [f'app{i}' for i in range(20)]
+    ports = allocator(tmp_path, *apps)
+
+    # every app asks for the same port at once
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        leased = list(executor.map(lambda app: ports.lease(app, preferred=18080), apps))
+
+    assert len(set(leased)) == 20 and leased.count(18080) <= 1
+    assert ports.lease('app3', preferred=18080) == leased[3]
+    assert ports.lease('app3', keep=False) not in leased
+
+
+def test_busy_port_is_skipped(tmp_path):
+    ports = allocator(tmp_path, 'web')
+    with socket.socket() as sock:
+        sock.bind(('', 0))
+        sock.listen()
+        busy = sock.getsockname()[1]
+        assert not PortAllocator.is_free(busy)
+        assert ports.lease('web', preferred=busy) != busy
+
+
+def test_leases_persist_and_are_reclaimed(tmp_path):
+    ports = allocator(tmp_path, 'kept', 'removed')
+    kept = ports.lease('kept')
+    ports.lease('removed')
+    (tmp_path / 'apps' / 'removed').rmdir()
+
+    reloaded = allocator(tmp_path)
+
+    assert reloaded.ports('kept') == [kept] and reloaded.ports('removed') == []
+    with open(tmp_path / 'ports.json') as f: assert list(json.load(f)) == [str(kept)]
+    reloaded.release('kept')
+    assert reloaded.leases == {}
+
+
+def test_shared_allocator_is_created_once(monkeypatch):
+    created = []
+    monkeypatch.setattr(PortAllocator, '_instance', None)
+    monkeypatch.setattr(PortAllocator, '__init__', lambda self: created.append(time.sleep(0.05)))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        instances = set(pool.map(lambda _: PortAllocator.shared(), range(8)))
+
+    assert len(instances) == 1 and len(created) == 1
@@ -0,0 +1,82 @@
+# run command: pytest
+
+import json, threading
+from core.registry import AppRegistry
+
+
+def test_info_json_files_are_migrated_once(tmp_path):
+    apps_dir = tmp_path / 'apps'
+    for name, attrs in (('a', { 'app': { 'name': 'a', 'pc_port': 8001 } }), ('b', { 'attrs': { 'name': 'b' } })):
+        (apps_dir / name).mkdir(parents=True)
+        (apps_dir / name / 'info.json').write_text(json.dumps(attrs))
+    (apps_dir / 'broken').mkdir()
+    (apps_dir / 'broken' / 'info.json').write_text('{')
+
+    registry = AppRegistry(str(tmp_path / 'apps.sqlite3'), apps_dir=str(apps_dir))
+    assert registry.names() == ['a', 'b'] and registry.get('a')['pc_port'] == 8001
+
+    registry.delete('a')
+    reopened = AppRegistry(str(tmp_path / 'apps.sqlite3'), apps_dir=str(apps_dir))
+    assert reopened.names() == ['b']
+
+
+def test_find_by_indexed_columns(tmp_path):
+    registry = AppRegistry(str(tmp_path / 'apps.sqlite3'), apps_dir=str(tmp_path))
+    registry.save('a', { 'name': 'a', 'port': 80, 'pc_port': 8001, 'status': 'running', 'repo': { 'page_url': 'https://github.com/u/a' } })
+    registry.save('b', { 'name': 'b', 'port': 80, 'pc_port': 8002, 'status': 'built' })
+    registry.save('b', { 'name': 'b', 'port': 80, 'pc_port': 8002, 'status': 'running' })
+
+    assert [app['name'] for app in registry.find(port=80, status='running')] == ['a', 'b']
+    assert [app['name'] for app in registry.find(pc_port='8002')] == ['b']
+    assert [app['name'] for app in registry.find(repo='https://github.com/u/a')] == ['a']
+    assert registry.get('missing') is None
+    try:
+        registry.find(data='x')
+        assert False, 'unknown filter accepted'
+    except ValueError: pass
+
+
+def test_threads_write_concurrently(tmp_path):
+    registry = AppRegistry(str(tmp_path / 'apps.sqlite3'), apps_dir=str(tmp_path))
+    errors = []
+
+    def save(i):
+        try:
+            for n in range(20): registry.save(f'app{i}', { 'name': f'app{i}', 'pc_port': 8000 + i, 'n': n })
+        except Exception as e: errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(i,)) for i in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+    assert not errors and len(registry.names()) == 8
+    assert all(registry.get(f'app{i}')['n'] == 19 for i in range(8))
+
+
+def test_updates_are_coalesced(tmp_path, monkeypatch):
+    registry = AppRegistry(str(tmp_path / 'apps.sqlite3'), apps_dir=str(tmp_path))
+    registry.DEBOUNCE = 60
+    writes = []
+    real_write = registry._write
+    monkeypatch.setattr(registry, '_write', lambda rows, durable=False: writes.append((len(rows), durable)) or real_write(rows, durable))
+
+    for n in range(5): registry.update('a', { 'name': 'a', 'n': n })
+    registry.update('b', { 'name': 'b' })
+    assert registry.get('a')['n'] == 4 and writes == []
+
+    assert registry.flush() == 2 and writes == [(2, False)]
+    registry.update('a', { 'name': 'a', 'n': 5 })
+    registry.save('a', { 'name': 'a', 'status': 'built' })
+    assert registry.flush() == 0 and registry.get('a') == { 'name': 'a', 'status': 'built' }
+    assert writes[-1] == (1, True)
+
+
+def test_credentials_are_not_stored(tmp_path):
+    registry = AppRegistry(str(tmp_path / 'apps.sqlite3'), apps_dir=str(tmp_path))
+    attrs = { 'name': 'a', 'repo': { 'page_url': 'https://github.com/u/a', 'api_headers': { 'Authorization': 'token secret' } } }
+    registry.save('a', attrs)
+    registry.update('b', { **attrs, 'name': 'b' })
+
+    assert registry.get('b')['repo'] == { 'page_url': 'https://github.com/u/a' }
+    assert 'secret' not in json.dumps(registry.find())
+    for path in tmp_path.glob('apps.sqlite3*'): assert b'token secret' not in path.read_bytes()
@@ -0,0 +1,147 @@
+# run command: pytest
+
+import os, sys, json, time, pytest, threading
+from core import utils
+from core.utils import BaseJsonFile, Executer, JsonStore, ShellPool, ShellSession
+
+
+def make_config(tmp_path, data: dict):
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps(data))
+    return type('TestConfig', (BaseJsonFile,), { 'FILE_PATH': str(path) })()
+
+
+def test_lookups_keep_root_and_use_cache(tmp_path, monkeypatch):
+    config = make_config(tmp_path, { 'account': { 'id': 'a1' }, 'tunnel': { 'zone': { 'id': 'z1' } } })
+    loads = []
+    real_load = json.load
+    monkeypatch.setattr(utils.json, 'load', lambda file: loads.append(1) or real_load(file))
+
+    assert config('account', 'id') == 'a1'
+    assert config('tunnel', 'zone', 'id') == 'z1'
+    assert config('missing', 'id') is None
+    assert len(loads) == 1
+    with pytest.raises(TypeError):
+        config('account')['id'] = 'changed'
+
+
+def test_external_change_is_seen_and_set_writes_atomically(tmp_path):
+    config = make_config(tmp_path, { 'account': { 'id': 'a1' } })
+    assert config('account', 'id') == 'a1'
+
+    time.sleep(0.01)
+    with open(config.FILE_PATH, 'w') as f: json.dump({ 'account': { 'id': 'a2' } }, f)
+    assert config('account', 'id') == 'a2'
+
+    config.set('tunnel', 'id', value='t1')
+    with open(config.FILE_PATH) as f: assert json.load(f) == { 'account': { 'id': 'a2' }, 'tunnel': { 'id': 't1' } }
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.tmp')] == []
+
+
+def test_readers_never_see_half_written_file(tmp_path):
+    path = str(tmp_path / 'big.json')
+    JsonStore.write(path, { 'items': list(range(20000)) })
+    stop, errors = threading.Event(), []
+
+    def read():
+        while not stop.is_set():
+            try:
+                with open(path) as f: json.load(f)
+            except json.JSONDecodeError as e: errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    for reader in readers: reader.start()
+    for i in range(20): JsonStore.write(path, { 'items': list(range(20000 + i)) })
+    stop.set()
+    for reader in readers: reader.join()
+
+    assert errors == [] and len(JsonStore.read(path)['items']) == 20019
+
+
+def test_written_files_are_not_cached(tmp_path):
+    path = str(tmp_path / 'manifest.json')
+    JsonStore.write(path, { 'files': ['a'] })
+    assert path not in JsonStore._cache
+
+    assert JsonStore.read(path)['files'] == ('a',)
+    JsonStore.write(path, { 'files': ['b'] })
+    assert path not in JsonStore._cache and JsonStore.read(path)['files'] == ('b',)
+
+
+def test_stream_kill_reaches_shell_children():
+    process = Executer.stream('sleep 30 | cat', timeout=0.3)
+    started = time.monotonic()
+    assert process.wait().returncode != 0 and process.error == 'timeout'
+    assert time.monotonic() - started < 5
+
+
+def test_kill_tree_uses_taskkill_on_windows(monkeypatch):
+    calls = []
+    monkeypatch.setattr(utils.os, 'name', 'nt')
+    monkeypatch.setattr(utils.subprocess, 'run', lambda args, **kwargs: calls.append(args))
+    process = type('Process', (), { 'pid': 42, 'poll': lambda self: 0 })()
+
+    Executer.kill_tree(process)
+
+    assert calls == [['taskkill', '/T', '/F', '/PID', '42']]
+
+
+def test_executer_stream_yields_lines_while_running(tmp_path):
+    script = 'import sys, time\nprint("step 1", flush=True)\nprint("warn", file=sys.stderr, flush=True)\ntime.sleep(0.5)\nprint("step 2")\nsys.exit(3)'
+    process = Executer.stream([sys.executable, '-c', script], tail_size=2)
+    started = time.monotonic()
+    lines = iter(process)
+    first = next(lines)
+
+    assert first == ('stdout', 'step 1') and time.monotonic() - started < 0.5
+    rest = list(lines)
+    assert ('stdout', 'step 2') in rest and ('stderr', 'warn') in [first, *rest]
+    assert process.returncode == 3 and len(process.tail) == 2
+
+
+def test_executer_stream_timeout_and_cancel():
+    process = Executer.stream([sys.executable, '-c', 'import time; time.sleep(30)'], timeout=0.3)
+    result = process.wait()
+    assert process.error == 'timeout' and result.returncode != 0 and 'timeout' in result.stderr
+
+    cancel = threading.Event()
+    process = Executer.stream([sys.executable, '-c', 'import time; time.sleep(30)'], cancel=cancel)
+    threading.Timer(0.2, cancel.set).start()
+    started = time.monotonic()
+    assert process.wait().returncode != 0 and process.error == 'cancelled'
+    assert time.monotonic() - started < 5
+
+
+def test_shell_session_frames_commands():
+    session = ShellSession(['bash', '--noprofile', '--norc'])
+    try:
+        first = session.run('echo out; echo err >&2; exit 3')
+        assert (first.returncode, first.stdout, first.stderr) == (3, 'out\n', 'err\n')
+        assert session.run('printf partial').stdout == 'partial'
+        # commands don't read the session's own input, state doesn't leak between them
+        assert session.run('cat; cd /; X=1').returncode == 0
+        assert session.run('echo "$X"').stdout == '\n' and session.run('pwd').stdout != '/\n'
+        timed_out = session.run('sleep 5', timeout=0.2)
+        assert timed_out.returncode == -1 and not session.alive
+    finally:
+        session.close()
+
+
+def test_run_cmd_uses_sessions_for_prefixed_commands():
+    Executer.enable_sessions(size=2, shell=['bash', '--noprofile', '--norc'], prefix='wsl ')
+    try:
+        pids = { Executer.run_cmd('wsl echo $$').stdout for _ in range(3) }
+        outside = Executer.run_cmd('echo $$').stdout
+        assert len(pids) == 1 and outside not in pids
+        assert Executer.run_cmd('wsl exit 4').returncode == 4
+    finally:
+        Executer.disable_sessions()
+
+
+def test_pool_refuses_foreign_commands_without_a_session():
+    pool = ShellPool(1, ['bash', '--noprofile', '--norc'], prefix='wsl ')
+    try:
+        assert pool.run('echo outside') is None and pool._created == 0
+        assert pool.run('wsl echo inside').stdout == 'inside\n' and pool._created == 1
+    finally:
+        pool.close()